@@ -1,10 +1,55 @@
 from unittest import mock
 import unittest
+import asyncio
+import gzip
+import io
+import json
 import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
+# Fake credentials so that moto never talks to real AWS
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+import boto3
+from moto import mock_aws
+import access_logs
+import async_remote
+import autoscaler
+import aws_clients
+import batch_cli
+import check_webserver
+import content_deploy
+import fleet_spec
+import health_checks
+import inventory
+import load_test
+import log_parser
+import log_store
+import metrics
+import rate_limits
+import run_newwebserver
+import s3_bulk_delete
+import s3_sync
+import ssh_sessions
+import state_files
+import summarize_logs
+import waiters
 from run_newwebserver import get_input
 from run_newwebserver import import_key_pair
 
 
+# Run in another process, it needs to be importable
+def add_state_entry(path, key):
+    state_files.update(path, lambda data: data.update({str(key): key}))
+
+
 class TestFunctions(unittest.TestCase):
 
     @classmethod
@@ -22,6 +67,10 @@ class TestFunctions(unittest.TestCase):
         # Remove .pem file
         os.system("rm -rf ./keys")
 
+    def setUp(self):
+        # Every test gets clients built inside its own moto mock
+        aws_clients.reset()
+
     def test_get_input(self):
         with mock.patch('builtins.input', return_value='The quick brown fox jumps over the lazy dog'):
             self.assertEqual(input(), get_input('The quick brown fox jumps over the lazy dog'))
@@ -30,6 +79,847 @@ class TestFunctions(unittest.TestCase):
         with mock.patch('builtins.input', return_value=('key_pair', 'keys/key_pair.pem')):
             self.assertEqual(input(), import_key_pair('keys/key_pair.pem'))
 
+    @mock_aws
+    def test_create_instance_fleet(self):
+        group_id = run_newwebserver.create_security_group("fleet-test")
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/boot_times.jsonl'):
+            results = run_newwebserver.create_instance(('key_pair', 'keys/key_pair.pem'), group_id, 'fleet', count=3)
+        self.assertEqual(3, len(results))
+        self.assertTrue(all(result['web_server'] for result in results))
+        self.assertEqual(3, len(run_newwebserver.load_boot_times('keys/boot_times.jsonl')['base']))
+
+    def test_wait_for_public_ips_batches_describe_calls(self):
+        client = mock.Mock()
+        client.describe_instances.side_effect = [
+            {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'PublicIpAddress': '1.1.1.1'},
+                                             {'InstanceId': 'i-2'}]}]},
+            {'Reservations': [{'Instances': [{'InstanceId': 'i-2', 'PublicIpAddress': '2.2.2.2'}]}]},
+        ]
+        sleep = mock.Mock()
+        public_ips = waiters.wait_for_public_ips(client, ['i-1', 'i-2'], sleep=sleep)
+        self.assertEqual({'i-1': '1.1.1.1', 'i-2': '2.2.2.2'}, public_ips)
+        # One call per round for all pending instances, only the pending ones are polled again
+        self.assertEqual(2, client.describe_instances.call_count)
+        self.assertEqual(['i-2'], client.describe_instances.call_args.kwargs['InstanceIds'])
+        self.assertEqual(1, sleep.call_count)
+
+    def test_retry_command_stops_at_deadline(self):
+        with mock.patch('async_remote.run_command', mock.AsyncMock(return_value=(255, 'Connection refused'))) as command:
+            status, output, attempts = async_remote.run(async_remote.retry_command(
+                'ssh host true', deadline=0.2, base_delay=0.01, max_delay=0.05))
+        self.assertEqual(255, status)
+        self.assertEqual(attempts, command.call_count)
+        self.assertGreater(attempts, 1)
+
+    def test_ssh_commands_share_one_session_per_host(self):
+        ssh = ssh_sessions.ssh_command('keys/key_pair.pem', '10.0.0.1', 'sudo ls -a')
+        scp = ssh_sessions.scp_command('keys/key_pair.pem', '10.0.0.1', 'check_webserver.py')
+        control_dir = ssh_sessions.get_control_dir()
+        control_path = f"ControlPath={control_dir}/%C"
+        self.assertIn(control_path, ssh)
+        self.assertIn(control_path, scp)
+        self.assertIn(f"ControlPersist={ssh_sessions.CONTROL_PERSIST}", ssh)
+        # Commands never take over the local terminal or prompt for a password
+        self.assertTrue(ssh.startswith("ssh -T "))
+        self.assertIn("BatchMode=yes", scp)
+        self.assertIn(('keys/key_pair.pem', '10.0.0.1'), ssh_sessions.open_sessions)
+
+        with mock.patch('subprocess.getstatusoutput', return_value=(0, '')) as command:
+            ssh_sessions.close_all()
+        self.assertTrue(any('-O exit ec2-user@10.0.0.1' in call.args[0] for call in command.call_args_list))
+        self.assertFalse(ssh_sessions.open_sessions)
+        # The control directory is removed, a new one is made for the next session
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertIsNone(ssh_sessions.control_dir)
+
+    def test_stream_log_lines_fetches_only_appended_lines(self):
+        log_path = "keys/access_log"
+        # A recent request, older ones would be deleted by the retention of the log store
+        received = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime())
+        line = f'1.2.3.4 - - [{received}] "GET / HTTP/1.1" 200 2326\n'
+        with open(log_path, "w") as f:
+            f.write(line * 2)
+
+        # Run the remote script locally instead of over ssh, on the test log whatever the path asked for
+        def local_tail(key_path, pub_ip, remote_log_path, inode, offset):
+            return "sh -c " + shlex.quote(access_logs.tail_script(log_path, inode, offset))
+
+        async def fetch(position):
+            return [line async for line in async_remote.stream_log_lines('key', '10.0.0.1', position)]
+
+        position = {}
+        with mock.patch('access_logs.tail_command', side_effect=local_tail):
+            first = async_remote.run(fetch(position))
+            with open(log_path, "a") as f:
+                f.write(line + line[:20])
+            second = async_remote.run(fetch(position))
+            full = async_remote.run(fetch({}))
+
+        self.assertEqual([line] * 2, first)
+        # The partial line at the end is left for the next query
+        self.assertEqual([line], second)
+        self.assertEqual([line] * 3, full)
+        self.assertEqual(len(line) * 3, position['offset'])
+
+        # A host which stops sending is given up on, its position is kept
+        with mock.patch('access_logs.tail_command', return_value="sleep 5"), \
+                mock.patch('async_remote.STREAM_IDLE_TIMEOUT', 0.2):
+            with self.assertRaises(RuntimeError):
+                async_remote.run(fetch(position))
+        self.assertEqual(len(line) * 3, position['offset'])
+
+        # A fetch which stops after its first batch (e.g. piped into head) stores that batch with its position,
+        # the next fetch continues after it and no request is stored twice
+        async def first_batch():
+            batches = run_newwebserver.fetch_and_store_logs('key', '10.0.0.2')
+            await batches.__anext__()
+            await batches.aclose()
+
+        open_store = log_store.open_store
+        with mock.patch('access_logs.tail_command', side_effect=local_tail), \
+                mock.patch('run_newwebserver.LOG_BATCH_SIZE', 1), \
+                mock.patch('access_logs.OFFSETS_FILE', 'keys/no_offsets.json'), \
+                mock.patch('log_store.open_store', side_effect=lambda: open_store('keys/positions.db')):
+            async_remote.run(first_batch())
+            self.assertEqual(2, async_remote.run(run_newwebserver.store_logs('key', '10.0.0.2')))
+            conn = open_store('keys/positions.db')
+            self.assertEqual(3, log_store.count_requests(conn, '10.0.0.2', 0))
+            self.assertEqual(len(line) * 3, log_store.load_position(conn, '10.0.0.2')['offset'])
+            conn.close()
+
+        # Processes updating the same state file at the same time keep each other's entries
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            list(executor.map(add_state_entry, ["keys/state.json"] * 20, range(20)))
+        self.assertEqual(20, len(state_files.load("keys/state.json")))
+        self.assertEqual([], [name for name in os.listdir("keys") if name.endswith(".tmp")])
+
+    def test_log_store_time_index_queries(self):
+        conn = log_store.open_store(":memory:")
+        now = 1570000000
+        log_store.append_records(conn, '10.0.0.1', [
+            ('1.2.3.4', now - 60, 'GET', '/', 200, 100),
+            ('1.2.3.4', now - 120, 'GET', '/broken', 503, 0),
+            ('5.6.7.8', now - 3600, 'GET', '/broken', 500, 0),
+            ('1.2.3.4', now - 40 * 24 * 3600, 'GET', '/', 200, 100),
+        ])
+        log_store.append_records(conn, '10.0.0.2', [('1.2.3.4', now - 60, 'GET', '/', 500, 0)])
+
+        self.assertEqual([('1.2.3.4', now - 120, 'GET', '/broken', 503, 0)],
+                         log_store.recent_errors(conn, '10.0.0.1', minutes=15, now=now))
+        self.assertEqual(1, log_store.apply_retention(conn, retention_days=30, now=now))
+        self.assertEqual(2, len(log_store.query_records(conn, '10.0.0.1', remote_host='1.2.3.4')))
+        # The index is used for time range queries
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM requests WHERE instance = ? AND time >= ?",
+                            ('10.0.0.1', now)).fetchall()
+        self.assertIn('requests_time', str(plan))
+
+    def test_parse_lines_and_aggregations(self):
+        batch = log_parser.parse_lines([
+            '1.2.3.4 - - [10/Oct/2019:13:55:36 +0200] "GET /index.html?lang=en HTTP/1.1" 200 2326\n',
+            '1.2.3.4 - - [10/Oct/2019:13:55:36 +0200] "GET /missing HTTP/1.1" 404 -\n',
+            '5.6.7.8 - frank [29/Feb/2020:00:00:01 -0530] "POST /login HTTP/1.0" 200 10 "http://a/" "Mozilla"\n',
+            # Quotes in the request are escaped by Apache
+            '1.2.3.4 - - [10/Oct/2019:13:55:37 +0200] "GET /a\\"b?q=\\"x HTTP/1.1" 200 5\n',
+            'not a log line\n',
+            # Malformed timestamps are skipped like any other malformed line
+            '1.2.3.4 - - [10/Abc/2019:13:55:36 +0200] "GET / HTTP/1.1" 200 1\n',
+            '1.2.3.4 - - [10/Zzz/2019:13:55:36 +0200] "GET / HTTP/1.1" 200 1\n',
+            '1.2.3.4 - - [10/Ok\u00e9/2019:13:55:36 +0200] "GET / HTTP/1.1" 200 1\n',
+            '1.2.3.4 - - [\u0661\u0660/Oct/2019:13:55:36 +0200] "GET / HTTP/1.1" 200 1\n',
+        ])
+        self.assertEqual([1570708536, 1570708536, 1582954201, 1570708537], batch['time'].tolist())
+        self.assertEqual(['/index.html', '/missing', '/login', '/a\\"b'], batch['path'].tolist())
+        self.assertEqual({200: 3, 404: 1}, log_parser.status_histogram(batch))
+        self.assertEqual([('1.2.3.4', 3)], log_parser.top_n(batch, 'remote_host', n=1))
+        self.assertEqual(2341, log_parser.bytes_served(batch))
+        seconds, counts = log_parser.requests_per_second(batch)
+        self.assertEqual(2, counts[0])
+        self.assertEqual(4, counts.sum())
+        self.assertTrue(summarize_logs.LOG_LINE.match('1.2.3.4 - - [10/Oct/2019:13:55:37 +0200] "\\"x\\"" 400 -'))
+
+    def test_query_fleet_logs_merges_instances_in_time_order(self):
+        logs = {
+            '10.0.0.1': ['1.1.1.1 - - [10/Oct/2019:13:55:36 +0000] "GET / HTTP/1.1" 200 10\n',
+                         '1.1.1.1 - - [10/Oct/2019:13:55:40 +0000] "GET / HTTP/1.1" 200 10\n'],
+            '10.0.0.2': ['2.2.2.2 - - [10/Oct/2019:13:55:38 +0000] "GET / HTTP/1.1" 404 10\n'],
+        }
+
+        async def stream(key_path, ip_address, incremental=True, limit=None, stats=None):
+            if ip_address not in logs:
+                raise RuntimeError("Connection refused")
+            for line in logs[ip_address]:
+                yield line
+
+        open_store = log_store.open_store
+        with mock.patch('async_remote.stream_log_lines', side_effect=stream), \
+                mock.patch('log_store.open_store', side_effect=lambda: open_store('keys/fleet_logs.db')), \
+                mock.patch('builtins.print') as printed:
+            run_newwebserver.query_fleet_logs('key', ['10.0.0.1', '10.0.0.2', '10.0.0.3'], True)
+
+        output = [str(call.args[0]) for call in printed.call_args_list]
+        rows = [line for line in output if line.startswith('\t10.0.0.')]
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.1'], [row.split()[0] for row in rows])
+        self.assertTrue(any('10.0.0.3' in line and 'Connection refused' in line for line in output))
+
+    def test_probe_all_against_local_web_servers(self):
+        class QuietHandler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # Nothing listens on the port of a closed server
+        closed = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        closed.server_close()
+        try:
+            results = health_checks.probe_all(['127.0.0.1'], port=server.server_port, path='/README.md')
+            failed = health_checks.probe('127.0.0.1', port=closed.server_port)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(200, results[0]['status'])
+        self.assertTrue(health_checks.is_healthy(results[0]))
+        self.assertLessEqual(results[0]['connect'], results[0]['ttfb'])
+        self.assertLessEqual(results[0]['ttfb'], results[0]['total'])
+        self.assertFalse(health_checks.is_healthy(failed))
+        self.assertIsNotNone(failed['error'])
+        self.assertEqual([50, 90, 99], list(health_checks.latency_percentiles(results)))
+
+    def test_agent_watches_httpd_through_proc(self):
+        proc_root = "keys/proc"
+        os.makedirs(f"{proc_root}/123", exist_ok=True)
+        with open(f"{proc_root}/123/comm", "w") as f:
+            f.write("httpd\n")
+        with open(f"{proc_root}/123/stat", "w") as f:
+            f.write("123 (httpd) S " + " ".join(["0"] * 18) + " 500 0 0\n")
+        with open(f"{proc_root}/uptime", "w") as f:
+            f.write("1005.00 0.00\n")
+        with open("keys/httpd.pid", "w") as f:
+            f.write("123\n")
+        with open("keys/access_log", "w") as f:
+            f.write("request\n" * 3)
+
+        position = {}
+        with mock.patch('subprocess.getstatusoutput') as command:
+            check_webserver.watch_httpd(position, 1, "keys/httpd.pid", proc_root, "keys/access_log")
+        # No process is spawned while httpd is running
+        command.assert_not_called()
+        status = check_webserver.agent_status()
+        self.assertTrue(status['running'])
+        self.assertEqual(123, status['pid'])
+        self.assertEqual(3, status['requests_total'])
+        self.assertAlmostEqual(1005 - 500 / os.sysconf("SC_CLK_TCK"), status['httpd_uptime'])
+
+        # A new agent starts at the end of the log, the appended requests are counted a chunk at a time
+        position = check_webserver.end_of_log("keys/access_log")
+        with open("keys/access_log", "a") as f:
+            f.write("request\n" * 5)
+        with mock.patch('check_webserver.READ_CHUNK_SIZE', 4):
+            self.assertEqual(5, check_webserver.count_new_requests(position, "keys/access_log"))
+        self.assertEqual(os.path.getsize("keys/access_log"), position['offset'])
+
+        # httpd died, the agent restarts it
+        def start_httpd(command):
+            with open(f"{proc_root}/123/comm", "w") as f:
+                f.write("httpd\n")
+            return 0, ''
+
+        os.remove(f"{proc_root}/123/comm")
+        with mock.patch('subprocess.getstatusoutput', side_effect=start_httpd) as command:
+            check_webserver.watch_httpd(position, 1, "keys/httpd.pid", proc_root, "keys/access_log")
+        command.assert_called_once_with("service httpd start")
+        self.assertEqual(1, check_webserver.agent_status()['restart_count'])
+
+        # A restart which fails is not counted, its output is kept
+        os.remove(f"{proc_root}/123/comm")
+        with mock.patch('subprocess.getstatusoutput', return_value=(1, 'Job for httpd.service failed.')):
+            check_webserver.watch_httpd(position, 1, "keys/httpd.pid", proc_root, "keys/access_log")
+        status = check_webserver.agent_status()
+        self.assertEqual([False, 1], [status['running'], status['restart_count']])
+        self.assertEqual('Job for httpd.service failed.', status['last_error'])
+
+    @mock_aws
+    def test_terminate_instances_by_name_in_one_call(self):
+        for name in ['web', 'web', 'db']:
+            run_newwebserver.ec2().create_instances(
+                ImageId="ami-08935252a36e25f85", MinCount=1, MaxCount=1,
+                TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': name}]}])
+
+        client = run_newwebserver.ec2_client()
+        with mock.patch.object(client, 'terminate_instances', wraps=client.terminate_instances) as terminate:
+            terminated = run_newwebserver.terminate_instances('web')
+        self.assertEqual(2, len(terminated))
+        terminate.assert_called_once()
+
+        self.assertEqual(1, len(run_newwebserver.list_instances(name='db')))
+        self.assertIsNone(run_newwebserver.list_instances(name='web'))
+
+    @mock_aws
+    def test_empty_bucket_deletes_versions_and_uploads_in_batches(self):
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='bulk-delete-test', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        client.put_bucket_versioning(Bucket='bulk-delete-test', VersioningConfiguration={'Status': 'Enabled'})
+        for i in range(5):
+            client.put_object(Bucket='bulk-delete-test', Key=f'log-{i}', Body=b'v1')
+            client.put_object(Bucket='bulk-delete-test', Key=f'log-{i}', Body=b'v2')
+        client.delete_object(Bucket='bulk-delete-test', Key='log-0')
+        client.create_multipart_upload(Bucket='bulk-delete-test', Key='big-upload')
+
+        with mock.patch.object(client, 'delete_objects', wraps=client.delete_objects) as delete_objects:
+            stats = s3_bulk_delete.empty_bucket(client, 'bulk-delete-test', batch_size=4, max_in_flight=2)
+        # 10 versions and 1 delete marker
+        self.assertEqual(11, stats['deleted'])
+        self.assertEqual(3, delete_objects.call_count)
+        self.assertEqual(1, stats['aborted_uploads'])
+        self.assertFalse(stats['errors'])
+        client.delete_bucket(Bucket='bulk-delete-test')
+
+    @mock_aws
+    def test_sync_directory_skips_unchanged_files(self):
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='static-assets', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        os.makedirs("keys/site/css", exist_ok=True)
+        for path, content in [("keys/site/index.html", "<h1>Hi</h1>"), ("keys/site/css/main.css", "h1 {}")]:
+            with open(path, "w") as f:
+                f.write(content)
+        manifest = "keys/manifest.json"
+
+        first = s3_sync.sync_directory(client, 'static-assets', "keys/site", "www", manifest_path=manifest)
+        second = s3_sync.sync_directory(client, 'static-assets', "keys/site", "www", manifest_path=manifest)
+        with open("keys/site/index.html", "w") as f:
+            f.write("<h1>Hello</h1>")
+        # Without a manifest the remote ETag is used
+        third = s3_sync.sync_directory(client, 'static-assets', "keys/site", "www", manifest_path="keys/none.json")
+
+        self.assertEqual((2, 0), (first['uploaded'], first['skipped']))
+        self.assertEqual((0, 2), (second['uploaded'], second['skipped']))
+        self.assertEqual((1, 1), (third['uploaded'], third['skipped']))
+        # An object deleted since the last sync is uploaded again, whatever the manifest says
+        client.delete_object(Bucket='static-assets', Key='www/css/main.css')
+        fourth = s3_sync.sync_directory(client, 'static-assets', "keys/site", "www", manifest_path=manifest)
+        self.assertEqual((1, 1), (fourth['uploaded'], fourth['skipped']))
+        self.assertEqual('text/css', client.head_object(Bucket='static-assets', Key='www/css/main.css')['ContentType'])
+
+    def test_import_does_not_load_boto3(self):
+        output = subprocess.check_output([sys.executable, "-c",
+                                          "import sys, run_newwebserver; print('boto3' in sys.modules)"],
+                                         env={'PATH': os.environ.get('PATH', '')}, universal_newlines=True)
+        self.assertEqual("False", output.strip())
+
+    @mock_aws
+    def test_aws_clients_are_cached(self):
+        self.assertIs(aws_clients.client('ec2'), aws_clients.client('ec2'))
+        self.assertIs(run_newwebserver.s3(), aws_clients.resource('s3'))
+
+    @mock_aws
+    def test_golden_image_is_built_and_used_for_launches(self):
+        group_id = run_newwebserver.create_security_group("golden-test")
+        key = ('key_pair', 'keys/key_pair.pem')
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/golden_boot_times.jsonl'):
+            # No image is made from a builder whose logs could not be emptied
+            with mock.patch('subprocess.getstatusoutput', return_value=(1, 'Permission denied')) as command:
+                self.assertIsNone(run_newwebserver.build_golden_image(key, group_id))
+            self.assertIn("sudo sh -c", command.call_args.args[0])
+            self.assertIsNone(run_newwebserver.find_golden_image())
+            with mock.patch('subprocess.getstatusoutput', return_value=(0, '')):
+                image_id = run_newwebserver.build_golden_image(key, group_id)
+            self.assertEqual(image_id, run_newwebserver.find_golden_image())
+            results = run_newwebserver.create_instance(key, group_id, 'web', image_id=image_id)
+
+        instance = run_newwebserver.ec2().Instance(results[0]['id'])
+        self.assertEqual(image_id, instance.image_id)
+        # The builder instance is terminated, only the new instance is running
+        self.assertEqual(1, len(run_newwebserver.list_instances()))
+        boot_times = run_newwebserver.load_boot_times('keys/golden_boot_times.jsonl')
+        # Both builders were launched from the base image
+        self.assertEqual([2, 1], [len(boot_times['base']), len(boot_times['golden'])])
+
+    @mock_aws
+    def test_metrics_record_phases_and_api_calls(self):
+        group_id = run_newwebserver.create_security_group("metrics-test")
+        # Every remote command is replaced by a local echo, run by the real asyncio engine
+        echo = "echo 'Apache Web Server is running.'"
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('ssh_sessions.ssh_command', return_value=echo), \
+                mock.patch('ssh_sessions.scp_command', return_value=echo), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/metrics_boot_times.jsonl'), \
+                mock.patch('builtins.print'):
+            with metrics.operation('create_instance', path='keys/metrics.jsonl'):
+                run_newwebserver.create_instance(('key_pair', 'keys/key_pair.pem'), group_id, 'web', count=2)
+
+        with open('keys/metrics.jsonl') as f:
+            summary = metrics.summarize(json.loads(line) for line in f)
+        self.assertEqual(1, summary['run_instances']['api_calls'])
+        self.assertGreaterEqual(summary['wait_public_ip']['api_calls'], 1)
+        self.assertEqual(2, summary['scp']['runs'])
+        self.assertEqual(2, summary['check_webserver']['commands'])
+        self.assertEqual(0, summary['check_webserver']['retries'])
+
+    def test_run_command_kills_commands_which_time_out(self):
+        status, output = async_remote.run(async_remote.run_command("sleep 5", timeout=0.2))
+        self.assertEqual(async_remote.TIMEOUT_STATUS, status)
+        self.assertEqual((0, 'done'), async_remote.run(async_remote.run_command("echo done")))
+
+    def test_run_on_hosts_caps_connections_and_collects_errors(self):
+        running = []
+        peak = []
+
+        async def operation(host, limit):
+            async with limit:
+                running.append(host)
+                peak.append(len(running))
+                await asyncio.sleep(0.05)
+                running.remove(host)
+            if host == 'broken':
+                raise RuntimeError("Connection refused")
+            return host.upper()
+
+        results = async_remote.run(async_remote.run_on_hosts(operation, ['a', 'b', 'c', 'broken'], max_connections=2))
+        self.assertEqual(2, max(peak))
+        self.assertEqual('A', results['a'])
+        self.assertIsInstance(results['broken'], RuntimeError)
+
+    def test_deploy_swaps_changed_pages_and_skips_unchanged_ones(self):
+        path = os.path.abspath("keys/index.html")
+
+        # Run the remote script locally instead of over ssh, 10.0.0.9 cannot be reached
+        def local_deploy(key_path, pub_ip, path, digest):
+            if pub_ip == '10.0.0.9':
+                return "echo 'Connection refused'; exit 255"
+            return "sh -c " + shlex.quote(content_deploy.swap_script(path, digest))
+
+        def deploy(content, hosts):
+            return async_remote.run(content_deploy.deploy('key', hosts, content, path, deadline=0))
+
+        with mock.patch('content_deploy.deploy_command', side_effect=local_deploy):
+            first = deploy(b'<img src="a">\n', ['10.0.0.1', '10.0.0.9'])
+            second = deploy(b'<img src="a">\n', ['10.0.0.1'])
+            third = deploy(content_deploy.index_page(['http://b/"x"']).encode(), ['10.0.0.1'])
+
+        self.assertEqual(['updated', 'failed'], [result['result'] for result in first])
+        self.assertIn('Connection refused', first[1]['error'])
+        self.assertEqual('unchanged', second[0]['result'])
+        self.assertEqual('updated', third[0]['result'])
+        with open(path) as f:
+            self.assertEqual('<img src="http://b/&quot;x&quot;" alt="http://b/&quot;x&quot;">\n', f.read())
+        # No temporary files are left next to the page
+        self.assertEqual([], [name for name in os.listdir("keys") if name.startswith(".deploy")])
+
+    def test_log_range_reads_rotated_and_compressed_logs(self):
+        log_path = os.path.abspath("keys/range_access_log")
+        line = '1.2.3.4 - - [{} +0000] "GET / HTTP/1.1" 200 10\n'
+        # Oldest first: a compressed rotated log, a plain rotated log and the live log
+        files = [(log_path + "-20191008.gz", "08/Oct/2019:12:00:00", 1570536000 + 3600),
+                 (log_path + "-20191009", "09/Oct/2019:12:00:00", 1570622400 + 3600),
+                 (log_path, "10/Oct/2019:12:00:00", 1570708800 + 3600)]
+        for path, timestamp, mtime in files:
+            with (gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")) as f:
+                f.write(line.format(timestamp) * 100)
+            os.utime(path, (mtime, mtime))
+
+        # Run the remote script locally on the test files instead of over ssh
+        def local_range(key_path, pub_ip, remote_log_path, since, until=None):
+            return "sh -c " + shlex.quote(access_logs.range_script(log_path, since, until))
+
+        def query(since, until=None):
+            stats = {}
+            with mock.patch('access_logs.range_command', side_effect=local_range), \
+                    tempfile.TemporaryFile("w+") as spool:
+                count = async_remote.run(run_newwebserver.spool_log_range('key', '10.0.0.1', since, until, spool,
+                                                                          stats=stats))
+                self.assertEqual(count, len(list(run_newwebserver.read_spool(spool, '10.0.0.1'))))
+            return count, stats
+
+        # The first file ends before the range starts and is not transferred
+        count, stats = query(1570600000)
+        self.assertEqual(200, count)
+        self.assertEqual(len(line.format(files[0][1])) * 200, stats['decoded'])
+        self.assertLess(stats['received'], stats['decoded'] / 5)
+        # Only the requests inside the range are counted
+        self.assertEqual(100, query(1570600000, 1570700000)[0])
+        self.assertEqual(300, query(0)[0])
+
+        # The requests of several instances are printed as one stream in time order
+        with mock.patch('access_logs.range_command', side_effect=local_range), \
+                mock.patch('builtins.print') as printed:
+            run_newwebserver.query_log_range('key', ['10.0.0.1', '10.0.0.2'], 1570600000)
+        rows = [str(call.args[0]).split() for call in printed.call_args_list
+                if str(call.args[0]).startswith('\t10.0.0.')]
+        self.assertEqual(400, len(rows))
+        self.assertEqual(sorted(row[2] for row in rows), [row[2] for row in rows])
+        self.assertEqual({'10.0.0.1', '10.0.0.2'}, {row[0] for row in rows[:200]})
+
+    def test_remote_log_summaries_are_merged(self):
+        log_path = "keys/summary_access_log"
+        with open(log_path, "w") as f:
+            f.write('1.1.1.1 - - [10/Oct/2019:13:55:36 +0000] "GET /a HTTP/1.1" 200 100\n' * 3)
+            f.write('2.2.2.2 - - [10/Oct/2019:13:56:10 +0000] "POST /b HTTP/1.1" 500 -\n')
+            f.write('not a log line\n')
+
+        # The helper runs on the instance as a script and prints one JSON line
+        output = subprocess.check_output([sys.executable, "summarize_logs.py", "--log", log_path, "--top", "1"])
+        summary = json.loads(output)
+        self.assertEqual([4, 1, 300], [summary['requests'], summary['unparsed'], summary['bytes']])
+        self.assertEqual([['1.1.1.1', 3]], summary['clients'])
+        self.assertEqual({'1570715700': 3, '1570715760': 1}, summary['per_minute'])
+
+        other = summarize_logs.summarize([log_path], since=1570715760)
+        merged = summarize_logs.merge_summaries([summary, other])
+        self.assertEqual([2, 5], [merged['instances'], merged['requests']])
+        self.assertEqual({'200': 3, '500': 2}, merged['status'])
+        self.assertEqual({1570715700: 3, 1570715760: 2}, merged['per_minute'])
+        self.assertEqual(('2.2.2.2', 1), merged['clients'][1])
+
+    @mock_aws
+    def test_fleet_spec_plan_and_apply(self):
+        spec_path = "keys/fleet.json"
+        spec = {'security_groups': [{'name': 'spec-web', 'ports': [22, 80, 443]}],
+                'instances': [{'name': 'spec-web', 'count': 3}],
+                'buckets': [{'name': 'spec-static'}]}
+        with open(spec_path, "w") as f:
+            json.dump(spec, f)
+
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/spec_boot_times.jsonl'), \
+                mock.patch('builtins.print'):
+            first = run_newwebserver.apply_fleet_spec(('key_pair', 'keys/key_pair.pem'), spec_path, confirm=False)
+            # Nothing left to do once the fleet matches the spec
+            second = run_newwebserver.apply_fleet_spec(('key_pair', 'keys/key_pair.pem'), spec_path, confirm=False)
+            spec['instances'][0]['count'] = 1
+            with open(spec_path, "w") as f:
+                json.dump(spec, f)
+            third = run_newwebserver.apply_fleet_spec(('key_pair', 'keys/key_pair.pem'), spec_path, confirm=False)
+
+        self.assertEqual(['create_security_group', 'launch', 'create_bucket'], [c['action'] for c in first])
+        self.assertFalse([change for change in first if 'error' in change])
+        self.assertEqual([], second)
+        self.assertEqual(['terminate'], [change['action'] for change in third])
+        self.assertEqual(2, len(third[0]['instance_ids']))
+        self.assertEqual(1, len(run_newwebserver.list_instances('spec-web')))
+
+        state = fleet_spec.describe_state(run_newwebserver.ec2_client(), aws_clients.client('s3'),
+                                          fleet_spec.validate_spec({'security_groups': [{'name': 'spec-web'}]}))
+        self.assertTrue({22, 80, 443} <= state['security_groups']['spec-web']['ports'])
+
+        # The spec given is not changed, entries without a name are rejected
+        groups = [{'name': 'spec-api'}]
+        self.assertEqual(fleet_spec.DEFAULT_PORTS, fleet_spec.validate_spec({'security_groups': groups})
+                         ['security_groups'][0]['ports'])
+        self.assertEqual([{'name': 'spec-api'}], groups)
+        with self.assertRaises(ValueError):
+            fleet_spec.validate_spec({'instances': [{'count': 1, 'security_group': 'spec-web'}]})
+
+    @mock_aws
+    def test_inventory_is_cached_indexed_and_invalidated(self):
+        group_id = run_newwebserver.create_security_group("inventory-test")
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/inventory_boot_times.jsonl'), \
+                mock.patch('builtins.print'):
+            run_newwebserver.create_instance(('key_pair', 'keys/key_pair.pem'), group_id, 'inv-web', count=2)
+            loads = inventory.stats['loads']
+            first = run_newwebserver.list_instances()
+            # Repeated listings and lookups are served from the inventory
+            self.assertEqual(first, run_newwebserver.list_instances())
+            self.assertEqual(first, run_newwebserver.list_instances('inv-*'))
+            self.assertEqual(loads + 1, inventory.stats['loads'])
+
+            instance = inventory.instance_by_ip(first['1'])
+            self.assertEqual('inv-web', instance['name'])
+            self.assertIs(instance, inventory.instance_by_id(instance['id']))
+            self.assertEqual(2, len(inventory.instances_by_name('inv-web')))
+            self.assertEqual(group_id, inventory.find_security_group('inventory-test')['id'])
+
+            # Our own changes invalidate the inventory
+            run_newwebserver.terminate_instances('inv-web')
+            self.assertIsNone(run_newwebserver.list_instances())
+
+        with mock.patch('inventory.INVENTORY_TTL', 0), mock.patch('builtins.print'):
+            loads = inventory.stats['loads']
+            run_newwebserver.list_buckets()
+            run_newwebserver.list_buckets()
+            self.assertEqual(loads + 2, inventory.stats['loads'])
+
+    def test_token_bucket_waits_and_adapts_to_throttling(self):
+        limiter = rate_limits.TokenBucket(rate=10, burst=2)
+        delays = [limiter.reserve() for i in range(3)]
+        self.assertEqual([0.0, 0.0], delays[:2])
+        self.assertAlmostEqual(0.1, delays[2], places=2)
+
+        limiter.throttled()
+        self.assertEqual(5, limiter.rate)
+        for i in range(30):
+            limiter.throttled()
+        self.assertEqual(10 * rate_limits.MIN_RATE_SHARE, limiter.rate)
+        for i in range(30):
+            limiter.succeeded()
+        self.assertEqual(10, limiter.rate)
+
+        # Throttling responses seen by botocore slow the whole service down
+        rate_limits.buckets.pop('test-service', None)
+        throttle = (mock.Mock(status_code=400), {'Error': {'Code': 'RequestLimitExceeded'}})
+        rate_limits.needs_retry('needs-retry.test-service.DescribeInstances', response=throttle)
+        self.assertEqual(1, rate_limits.stats()['test-service']['throttled'])
+        self.assertEqual(rate_limits.DEFAULT_BUDGET['rate'] / 2, rate_limits.stats()['test-service']['rate'])
+
+        # Every host has its own ssh budget, one host dropping connections does not slow the others down
+        rate_limits.throttled('ssh', '10.0.5.1')
+        self.assertEqual(rate_limits.BUDGETS['ssh']['rate'], rate_limits.bucket('ssh', '10.0.5.2').rate)
+        self.assertEqual(0.0, rate_limits.reserve('ssh', '10.0.5.2'))
+
+    @mock_aws
+    def test_identical_describe_calls_in_flight_are_coalesced(self):
+        client = aws_clients.client('ec2')
+        sent = []
+
+        # Slow down the request actually sent, so every other thread arrives while it is in flight
+        def slow_send(**kwargs):
+            sent.append(1)
+            time.sleep(0.3)
+
+        client.meta.events.register('before-send.ec2.DescribeSecurityGroups', slow_send)
+        coalesced = rate_limits.stats().get('ec2', {}).get('coalesced', 0)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def describe():
+            barrier.wait()
+            results.append(client.describe_security_groups()['SecurityGroups'])
+
+        threads = [threading.Thread(target=describe) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(sent))
+        self.assertEqual(7, rate_limits.stats()['ec2']['coalesced'] - coalesced)
+        self.assertTrue(all(result == results[0] for result in results))
+        # Every thread got a copy of the response
+        self.assertIsNot(results[0], results[1])
+
+        # An interrupted call is forgotten, the next identical call is made at once
+        def interrupt(**kwargs):
+            raise KeyboardInterrupt
+
+        client.meta.events.unregister('before-send.ec2.DescribeSecurityGroups', slow_send)
+        client.meta.events.register('before-send.ec2.DescribeSecurityGroups', interrupt)
+        with self.assertRaises(KeyboardInterrupt):
+            client.describe_security_groups()
+        self.assertEqual({}, rate_limits.in_flight)
+        client.meta.events.unregister('before-send.ec2.DescribeSecurityGroups', interrupt)
+        self.assertEqual(results[0], client.describe_security_groups()['SecurityGroups'])
+        # Clients of other regions do not share responses
+        other_region = boto3.client('ec2', region_name='us-west-2')
+        self.assertNotEqual(rate_limits.coalesce_key(client, 'DescribeSecurityGroups', {}),
+                            rate_limits.coalesce_key(other_region, 'DescribeSecurityGroups', {}))
+
+    def test_load_test_against_local_web_server_matches_its_log(self):
+        log_path = "keys/load_access_log"
+        log_lock = threading.Lock()
+
+        # Keep-alive web server which writes an Apache access log
+        class ApacheHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = b"<img src='photo.jpeg'>"
+                self.send_response(200 if self.path == "/" else 404)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_request(self, code='-', size='-'):
+                received = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime())
+                with log_lock, open(log_path, "a") as f:
+                    f.write(f'{self.client_address[0]} - - [{received}] "{self.requestline}" {int(code)} 22\n')
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ApacheHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        closed = ThreadingHTTPServer(('127.0.0.1', 0), ApacheHandler)
+        closed_port = closed.server_address[1]
+        closed.server_close()
+        try:
+            closed_loop = async_remote.run(load_test.load_host('127.0.0.1', server.server_address[1], duration=0.5,
+                                                               concurrency=4))
+            open_loop = async_remote.run(load_test.load_host('127.0.0.1', server.server_address[1], path="/missing",
+                                                             duration=0.5, concurrency=2, rate=40))
+            refused = async_remote.run(load_test.load_host('127.0.0.1', closed_port, duration=0.2, concurrency=2))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertGreater(closed_loop['requests'], 10)
+        self.assertEqual(0, closed_loop['errors'])
+        self.assertEqual({200: closed_loop['requests']}, dict(closed_loop['statuses']))
+        self.assertLessEqual(closed_loop['latency'][50], closed_loop['latency'][99])
+        # 40 requests/s for half a second
+        self.assertEqual(20, open_loop['requests'])
+        self.assertEqual({404: 20}, dict(open_loop['statuses']))
+        self.assertEqual(1.0, refused['error_rate'])
+        self.assertIn('ConnectionRefusedError', refused['error_types'])
+
+        # Every answered request is in the access log of the load test window
+        since, until = load_test.log_window(closed_loop)
+        summary = summarize_logs.summarize([log_path], since=since, until=until)
+        check = load_test.cross_check(closed_loop, summary)
+        self.assertEqual(0, check['not_logged'])
+        self.assertTrue(check['statuses_match'])
+
+    @mock_aws
+    def test_autoscaler_follows_request_rates_from_the_logs(self):
+        group_id = run_newwebserver.create_security_group("autoscale-test")
+        # 1 request/s per instance, rates are measured over 10 seconds of log
+        policy = autoscaler.make_policy(target_rps=1, min_instances=1, max_instances=3, scale_out_cooldown=0,
+                                        scale_in_cooldown=0, window=10, interval=0)
+        # Synthetic access logs: number of new requests made to every IP address, stamped with the current time
+        requests = {}
+        stores = ['keys/autoscale_1.db']
+
+        async def stream(key_path, ip_address, incremental=True, limit=None, stats=None):
+            received = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime())
+            for i in range(requests.get(ip_address, 0)):
+                yield f'3.3.3.3 - - [{received}] "GET / HTTP/1.1" 200 10\n'
+
+        def fleet():
+            return {instance['public_ip']: instance['id']
+                    for instance in inventory.instances(fleet_spec.LIVE_STATES, 'auto-web')}
+
+        open_store = log_store.open_store
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.stream_log_lines', side_effect=stream), \
+                mock.patch('log_store.open_store', side_effect=lambda: open_store(stores[-1])), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/autoscale_boot_times.jsonl'), \
+                mock.patch('autoscaler.DECISIONS_FILE', 'keys/autoscaler.jsonl'), \
+                mock.patch('builtins.print'):
+            key = ('key_pair', 'keys/key_pair.pem')
+            # No instances yet, the minimum is launched
+            run_newwebserver.autoscale(key, group_id, 'auto-web', policy, rounds=1)
+            first_ip = list(fleet())[0]
+            # 2.5 requests/s need 3 instances
+            requests[first_ip] = 25
+            run_newwebserver.autoscale(key, group_id, 'auto-web', policy, rounds=1)
+            self.assertEqual(3, len(fleet()))
+            # Traffic drops to 0.5 requests/s on the first instance, the idle ones are terminated
+            stores.append('keys/autoscale_2.db')
+            requests[first_ip] = 5
+            decisions = run_newwebserver.autoscale(key, group_id, 'auto-web', policy, rounds=1)
+
+        self.assertEqual([first_ip], list(fleet()))
+        self.assertEqual(2, len(decisions[0]['instance_ids']))
+        with open('keys/autoscaler.jsonl') as f:
+            logged = [json.loads(line) for line in f]
+        self.assertEqual(['launch', 'launch', 'terminate'], [decision['action'] for decision in logged])
+        self.assertEqual([0, 2.5, 0.5], [decision['total_rps'] for decision in logged])
+        self.assertEqual(2, logged[1]['count'])
+        self.assertEqual(2, logged[1]['launched'])
+
+        # Cooldowns hold back changes, missing rates hold back scale in, the bounds are kept whatever the rates
+        state = {'last_scale_out': 100, 'last_change': 100}
+        busy = autoscaler.decide({'i-1': 5.0}, dict(policy, scale_out_cooldown=60), state, now=120)
+        self.assertEqual('none', busy['action'])
+        self.assertEqual('launch', autoscaler.decide({'i-1': 5.0}, policy, state, now=120)['action'])
+        idle = autoscaler.decide({'i-1': 0.0, 'i-2': None}, policy, state, now=120)
+        self.assertEqual('none', idle['action'])
+        too_many = autoscaler.decide({f'i-{i}': 9.0 for i in range(5)}, policy, state, now=120)
+        self.assertEqual(('terminate', 2), (too_many['action'], too_many['count']))
+
+        # A launch whose instances did not get ready is an error and does not start the cooldown
+        state = autoscaler.new_state()
+        failed = autoscaler.step(policy, state, lambda: [], lambda instance_ids: {}, lambda count: 0,
+                                 lambda instance_ids: None, log_path='keys/autoscaler.jsonl')
+        self.assertEqual(0, failed['launched'])
+        self.assertIn('error', failed)
+        self.assertEqual(autoscaler.new_state(), state)
+
+        # A fleet which cannot be listed or sampled is left alone until the next round
+        def fail(*args):
+            raise RuntimeError("DescribeInstances failed")
+
+        for list_fleet, sample in [(fail, lambda instance_ids: {}), (lambda: ['i-1'], fail)]:
+            skipped = autoscaler.step(policy, state, list_fleet, sample, fail, fail, log_path='keys/autoscaler.jsonl')
+            self.assertEqual(('none', 'DescribeInstances failed'), (skipped['action'], skipped['error']))
+            with mock.patch('builtins.print'):
+                run_newwebserver.print_decision(skipped)
+
+    @mock_aws
+    def test_batch_cli_writes_json_results(self):
+        def cli(*argv):
+            stdout = io.StringIO()
+            with mock.patch('sys.stderr', io.StringIO()):
+                exit_status = batch_cli.main(list(argv), stdout)
+            return exit_status, stdout.getvalue()
+
+        # Timings of the test runs are not added to the real metrics file
+        metrics_file = mock.patch('metrics.METRICS_FILE', 'keys/cli_metrics.jsonl')
+        metrics_file.start()
+        self.addCleanup(metrics_file.stop)
+
+        def ndjson(output):
+            return [json.loads(line) for line in output.splitlines()]
+
+        run_newwebserver.create_security_group("cli-web")
+        with mock.patch('async_remote.ssh_test', mock.AsyncMock(return_value=True)), \
+                mock.patch('async_remote.copy_file_to_instance', mock.AsyncMock(return_value=True)), \
+                mock.patch('run_newwebserver.BOOT_TIMES_FILE', 'keys/cli_boot_times.jsonl'):
+            exit_status, output = cli("launch", "--key", "keys/key_pair.pem", "--security-group", "cli-web",
+                                      "--name", "cli-web", "--count", "2")
+        self.assertEqual(0, exit_status)
+        launched = ndjson(output)
+        self.assertEqual(2, len(launched))
+
+        exit_status, output = cli("--format", "json", "list", "instances", "--name", "cli-*")
+        self.assertEqual(sorted(result['id'] for result in launched),
+                         sorted(instance['id'] for instance in json.loads(output)))
+        self.assertEqual([], json.loads(cli("--format", "json", "list", "buckets")[1]))
+        # run_newwebserver.py with arguments runs the same operations
+        with mock.patch('sys.stdout', io.StringIO()) as stdout, mock.patch('sys.stderr', io.StringIO()):
+            self.assertEqual(0, run_newwebserver.main(["list", "buckets"]))
+        self.assertEqual("", stdout.getvalue())
+
+        # Requests are streamed from every instance, a host which cannot be read is reported and fails the run
+        ip_addresses = [result['ip'] for result in launched]
+
+        async def stream(key_path, ip_address, incremental=True, limit=None, stats=None):
+            if ip_address not in ip_addresses:
+                raise RuntimeError("Connection refused")
+            yield '1.1.1.1 - - [10/Oct/2019:13:55:36 +0000] "GET / HTTP/1.1" 200 10\n'
+            yield '1.1.1.1 - - [10/Oct/2019:13:55:37 +0000] "POST /form HTTP/1.1" 302 0\n'
+
+        open_store = log_store.open_store
+        with mock.patch('async_remote.stream_log_lines', side_effect=stream), \
+                mock.patch('log_store.open_store', side_effect=lambda: open_store('keys/cli_logs.db')):
+            exit_status, output = cli("query-logs", "--key", "keys/key_pair.pem", "--name", "cli-web",
+                                      "--method", "GET")
+            self.assertEqual(0, exit_status)
+            self.assertEqual(sorted(ip_addresses), sorted(record['instance'] for record in ndjson(output)))
+            self.assertEqual({'GET'}, {record['method'] for record in ndjson(output)})
+            exit_status, output = cli("query-logs", "--key", "keys/key_pair.pem", "--ip", "10.9.9.9")
+            self.assertEqual(batch_cli.FAILED_STATUS, exit_status)
+            self.assertIn('Connection refused', ndjson(output)[0]['error'])
+
+        fleet_spec.create_bucket(aws_clients.client('s3'), 'cli-bucket')
+        with open('keys/cli_upload.txt', 'w') as f:
+            f.write('hello')
+        exit_status, output = cli("upload", "cli-bucket", "keys/cli_upload.txt", "--prefix", "docs")
+        self.assertEqual('docs/cli_upload.txt', ndjson(output)[0]['key'])
+        exit_status, output = cli("delete-bucket", "cli-bucket")
+        self.assertEqual([True, 1], [ndjson(output)[0]['deleted'], ndjson(output)[0]['objects']])
+
+        # Nothing is terminated without a name, a tag or --all
+        self.assertEqual(batch_cli.ERROR_STATUS, cli("terminate")[0])
+        exit_status, output = cli("terminate", "--name", "cli-web")
+        self.assertEqual(sorted(result['id'] for result in launched), sorted(item['id'] for item in ndjson(output)))
+        self.assertEqual("[]\n", cli("--format", "json", "list", "instances", "--name", "cli-web")[1])
+        self.assertTrue(os.path.exists('keys/cli_metrics.jsonl'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shlex
+import zlib
+import ssh_sessions
+import state_files
+
+ACCESS_LOG = "/var/log/httpd/access_log"
+# Byte offset and inode of the access log of each instance, kept here before they moved into the log store.
+# Only read for instances the log store has no position for yet.
+OFFSETS_FILE = os.path.expanduser("~/.aws/access_log_offsets.json")
+# Bytes read from ssh at a time, memory use does not grow with the size of the log
+CHUNK_SIZE = 64 * 1024
+# Time range queries with no end
+NO_END = 2 ** 31 - 1
+
+
+def load_offsets(path=None):
+    return state_files.load(path or OFFSETS_FILE)
+
+
+# Shell script run on the instance. It prints "inode size offset" on the first line, followed by the
+# bytes appended to the log since the offset. If the log was rotated (new inode) or truncated, it starts from 0.
+# The output is compressed on the wire, access logs shrink about 10 times.
+def tail_script(log_path, inode, offset):
+    return (f"{{ set -- $(stat -c '%i %s' {log_path}); "
+            f"if [ \"$1\" = '{inode}' ] && [ \"$2\" -ge {offset} ]; then offset={offset}; else offset=0; fi; "
+            f"echo \"$1 $2 $offset\"; "
+            f"tail -c +$((offset + 1)) {log_path} | head -c $(($2 - offset)); }} | gzip -1")
+
+
+# Shell script printing every log file (rotated access_log-* files and the live log) which may hold requests
+# made between since and until, oldest first. A file holds the requests made between the mtime of the file
+# before it and its own mtime. Files which are already compressed are sent as they are, the others are
+# compressed on the fly, the output is one gzip member per file.
+def range_script(log_path, since, until=None):
+    return (f"prev=0; ls -tr {log_path} {log_path}-* 2>/dev/null | while read f; do "
+            f"m=$(stat -c %Y \"$f\"); "
+            f"if [ \"$m\" -ge {int(since)} ] && [ \"$prev\" -le {int(until or NO_END)} ]; then "
+            f"case \"$f\" in *.gz) cat \"$f\";; *) gzip -1 -c \"$f\";; esac; fi; "
+            f"prev=$m; done")
+
+
+def remote_command(key_path, pub_ip, script):
+    # The command is parsed by the local shell first and then by the remote shell
+    remote = "sudo sh -c " + shlex.quote(script)
+    # No pseudo-terminal, it would turn every '\n' into '\r\n' and break the byte offsets and the content piped
+    # through stdin (see content_deploy.py)
+    return ssh_sessions.ssh_command(key_path, pub_ip, shlex.quote(remote), flags="-T -q")
+
+
+def tail_command(key_path, pub_ip, log_path, inode, offset):
+    return remote_command(key_path, pub_ip, tail_script(log_path, inode, offset))
+
+
+def range_command(key_path, pub_ip, log_path, since, until=None):
+    return remote_command(key_path, pub_ip, range_script(log_path, since, until))
+
+
+# Decompress a stream of gzip members chunk by chunk and split it into lines.
+# A line without its '\n' yet is kept until the rest of it arrives.
+class GzipLines:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.partial = b""
+        self.received = 0
+        self.decoded = 0
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        data = []
+        while chunk:
+            # Every file of a range query is a gzip member of its own
+            if self.decompressor.eof:
+                self.decompressor = zlib.decompressobj(wbits=31)
+            data.append(self.decompressor.decompress(chunk))
+            chunk = self.decompressor.unused_data
+        data = self.partial + b"".join(data)
+        self.decoded += len(data) - len(self.partial)
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        return [line + b"\n" for line in lines]
+
+    def stats(self):
+        return {'received': self.received, 'decoded': self.decoded}
+
+
+def add_stats(stats, decoder):
+    if stats is not None:
+        for key, value in decoder.stats().items():
+            stats[key] = stats.get(key, 0) + value
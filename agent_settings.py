@@ -0,0 +1,5 @@
+# Settings shared by check_webserver.py on the instances and the controller. Copied onto every instance
+# next to check_webserver.py, keep it importable by python36.
+
+# The agent only listens on localhost, the controller reads it over SSH
+AGENT_PORT = 8181
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import shlex
+import time
+import access_logs
+import agent_settings
+import metrics
+import rate_limits
+import ssh_sessions
+import waiters
+
+# Upper limit of SSH connections (and other remote commands) running at the same time
+MAX_CONNECTIONS = 20
+# A single remote command is killed after this many seconds
+COMMAND_TIMEOUT = 60
+# A log stream can run for longer, it is killed when no data arrived for this many seconds
+STREAM_IDLE_TIMEOUT = 60
+# Deadlines (seconds) for instances to become ready
+SSH_DEADLINE = 120
+CHECK_WEBSERVER_DEADLINE = 300
+# Exit status of a command which was killed because it took too long, the same as timeout(1)
+TIMEOUT_STATUS = 124
+# Exit status of ssh when the connection failed, and the messages of a connection dropped by a busy sshd
+SSH_ERROR_STATUS = 255
+SSH_THROTTLE_MESSAGES = ["kex_exchange_identification", "Connection reset by peer", "Connection closed by remote host"]
+# Scripts copied onto every instance
+HELPER_SCRIPTS = ["check_webserver.py", "agent_settings.py", "summarize_logs.py"]
+# Exit status of a remote command when a helper script is missing from the instance
+MISSING_STATUS = 127
+
+
+# Async version of subprocess.getstatusoutput, with a timeout and an optional semaphore capping concurrency.
+# host is the instance the command connects to, it picks the rate limit the command is charged to.
+# input (bytes) is written to the stdin of the command, otherwise stdin is /dev/null: many commands run at the
+# same time and none of them may read the keystrokes of the menu or change the mode of its terminal.
+# The process is killed when it times out or when the coroutine is cancelled.
+async def run_command(command, timeout=COMMAND_TIMEOUT, limit=None, input=None, host=None):
+    if limit is not None:
+        async with limit:
+            return await run_command(command, timeout, input=input, host=host)
+
+    # SSH commands are rate limited per host, the sshd of each host drops connections beyond its MaxStartups
+    await asyncio.sleep(rate_limits.reserve('ssh', host))
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT,
+                                                    stdin=asyncio.subprocess.PIPE if input is not None
+                                                    else asyncio.subprocess.DEVNULL)
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return TIMEOUT_STATUS, f"Command timed out after {timeout}s."
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    finally:
+        metrics.count('commands')
+        metrics.count('command_seconds', time.perf_counter() - start)
+
+    output = stdout.decode(errors="replace")
+    if process.returncode == SSH_ERROR_STATUS and any(message in output for message in SSH_THROTTLE_MESSAGES):
+        rate_limits.throttled('ssh', host)
+    elif process.returncode == 0:
+        rate_limits.succeeded('ssh', host)
+    return process.returncode, output[:-1] if output.endswith("\n") else output
+
+
+# Run a command until it exits with status 0 or the deadline runs out, sleeping with backoff between attempts
+# without blocking other hosts. on_retry(attempt, status, output) is called after every failed attempt.
+async def retry_command(command, deadline, limit=None, on_retry=None,
+                        base_delay=waiters.BASE_DELAY, max_delay=waiters.MAX_DELAY, input=None, host=None):
+    end = time.monotonic() + deadline
+    delays = waiters.backoff_delays(base_delay, max_delay)
+    attempts = 0
+    while True:
+        (status, output) = await run_command(command, timeout=min(COMMAND_TIMEOUT, max(1, end - time.monotonic())),
+                                             limit=limit, input=input, host=host)
+        attempts += 1
+        if status == 0 or time.monotonic() >= end:
+            break
+        if on_retry:
+            on_retry(attempts, status, output)
+        await asyncio.sleep(min(next(delays), max(0, end - time.monotonic())))
+    metrics.count('retries', attempts - 1)
+    return status, output, attempts
+
+
+async def ssh_test(key_path, pub_ip, limit=None):
+    # Test command sent to the instance using ssh, retried with backoff until the deadline
+    (status, output, attempts) = await retry_command(
+        ssh_sessions.ssh_command(key_path, pub_ip, "sudo ls -a"),
+        deadline=SSH_DEADLINE, limit=limit, host=pub_ip,
+        on_retry=lambda attempt, status, output: print(f"\nSSH test attempt #{attempt} ({pub_ip})"))
+
+    # SSH command was successful
+    if status == 0:
+        print(f"\nThe instance ({pub_ip}) is ready to SSH.")
+        return True
+    else:
+        print(f"\nSSH test is taking too long to complete.{output}")
+        return False
+
+
+async def copy_file_to_instance(key_path, pub_ip, limit=None):
+    with metrics.phase("scp", host=pub_ip):
+        (status, output) = await run_command(
+            ssh_sessions.scp_command(key_path, pub_ip, " ".join(HELPER_SCRIPTS)), limit=limit, host=pub_ip)
+    print("\nAttempting to copy check_webserver.py onto the instance.")
+    if status == 0:
+        print("\nCopied check_webserver.py onto the instance.")
+
+        # Make scripts executable
+        (status, output) = await run_command(
+            ssh_sessions.ssh_command(key_path, pub_ip, "chmod 700 " + " ".join(HELPER_SCRIPTS)),
+            limit=limit, host=pub_ip)
+        print("\nAttempting to run check_webserver.py on the instance. Please wait, it might take up to a minute...")
+
+        if status == 0:
+            # Retry until yum has finished installing Apache and python on the instance
+            with metrics.phase("check_webserver", host=pub_ip):
+                (status, output, attempts) = await retry_command(
+                    ssh_sessions.ssh_command(key_path, pub_ip, "./check_webserver.py"),
+                    deadline=CHECK_WEBSERVER_DEADLINE, limit=limit, host=pub_ip)
+
+            # Command was successful
+            if status == 0:
+                print(f"\nSuccessfully ran check_webserver.py on the instance.\n\nStatus: {output}\n")
+                with metrics.phase("start_agent", host=pub_ip):
+                    await start_agent(key_path, pub_ip, limit)
+            else:
+                print(f"\nTook to long to run check_webserver.py on the instance.\n{output}\n")
+        else:
+            print(f"\nFailed to change permissions.\n{output}")
+    else:
+        print(f"\nCopying check_webserver.py failed.\n{output}")
+
+    return status == 0
+
+
+# Start check_webserver.py in agent mode, it keeps running after the SSH session is closed
+async def start_agent(key_path, pub_ip, limit=None):
+    command = "sudo setsid nohup ./check_webserver.py --agent > /dev/null 2>&1 < /dev/null &"
+    (status, output) = await run_command(ssh_sessions.ssh_command(key_path, pub_ip, shlex.quote(command)),
+                                         limit=limit, host=pub_ip)
+    if status == 0:
+        print(f"\nStarted the status agent on the instance ({pub_ip}).")
+    else:
+        print(f"\nFailed to start the status agent.\n{output}")
+    return status == 0
+
+
+# Test SSH, copy check_webserver.py and start the agent on a freshly launched instance
+async def bootstrap_instance(key_path, instance_id, public_ip, limit=None):
+    if not public_ip:
+        return {'id': instance_id, 'ip': '-', 'ssh': False, 'web_server': False, 'ready_time': None}
+    # Test ssh by running 'sudo ls -a' on the instance
+    with metrics.phase("ssh_test", host=public_ip):
+        ssh_ready = await ssh_test(key_path, public_ip, limit)
+    # Copy check_webserver.py onto the instance
+    web_server_ready = ssh_ready and await copy_file_to_instance(key_path, public_ip, limit)
+    return {'id': instance_id, 'ip': public_ip, 'ssh': ssh_ready, 'web_server': web_server_ready,
+            'ready_time': time.time()}
+
+
+# Read the status served by the agent, returns None if the agent is not running
+async def read_agent_status(key_path, pub_ip, limit=None):
+    (status, output) = await run_command(ssh_sessions.ssh_command(
+        key_path, pub_ip, f"curl -s http://127.0.0.1:{agent_settings.AGENT_PORT}/", flags="-T -q"),
+        limit=limit, host=pub_ip)
+    if status != 0:
+        return None
+    try:
+        return json.loads(output)
+    except ValueError:
+        return None
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    return time.strftime('%H:%M:%S', time.gmtime(seconds)) if seconds < 86400 else f"{seconds / 86400:.1f} days"
+
+
+async def check_web_server(pub_ip, key_path, limit=None):
+    # Ask the status agent first, it answers without starting a python interpreter on the instance
+    agent = await read_agent_status(key_path, pub_ip, limit)
+    if agent:
+        print(f"\nStatus agent on the instance ({pub_ip}):\n\n"
+              f"Apache Web Server is {'running' if agent['running'] else 'not running'}.\n"
+              f"PID: {agent['pid']}\tUptime: {format_duration(agent['httpd_uptime'])}"
+              f"\tRestarts: {agent['restart_count']}\n"
+              f"Requests: {agent['requests_total']}\tRequests/sec: {agent['requests_per_second']:.2f}\n")
+        return True
+
+    # Run check_webserver.py
+    (status, output) = await run_command(
+        ssh_sessions.ssh_command(key_path, pub_ip, "./check_webserver.py", flags="-T -q"), limit=limit, host=pub_ip)
+
+    # Command was successful
+    if status == 0:
+        print(f"\nSuccessfully ran check_webserver.py on the instance.\n\nStatus: {output}\n")
+    else:
+        print(output)
+    return status == 0
+
+
+# Read the compressed output of a log command and yield its decompressed lines. A host which stalls raises
+# instead of holding its connection slot forever, the caller kills the process.
+async def read_gzip_lines(process, decoder, timeout=None):
+    timeout = STREAM_IDLE_TIMEOUT if timeout is None else timeout
+    while True:
+        try:
+            chunk = await asyncio.wait_for(process.stdout.read(access_logs.CHUNK_SIZE), timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"\nNo log data was received for {timeout}s.") from None
+        if not chunk:
+            break
+        for line in decoder.feed(chunk):
+            yield line
+
+
+# Yield the lines of the access log as they arrive over the network, from position on: the inode and byte offset
+# ({'inode', 'offset'}) of a previous read, or {} for the whole current log. position is moved past every line
+# before it is yielded, the caller saves it together with what it did with the lines.
+# Bytes received and decompressed are added to stats, if given.
+async def stream_log_lines(key_path, pub_ip, position, limit=None, log_path=access_logs.ACCESS_LOG, stats=None):
+    command = access_logs.tail_command(key_path, pub_ip, log_path, position.get('inode', ''),
+                                       position.get('offset', 0))
+    if limit is not None:
+        await limit.acquire()
+    process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE,
+                                                    stdin=asyncio.subprocess.DEVNULL)
+    metrics.count('commands')
+    decoder = access_logs.GzipLines()
+    finished = False
+    try:
+        header = None
+        # A line which is still being written by Apache is never yielded, it is left for the next query
+        async for line in read_gzip_lines(process, decoder):
+            if header is None:
+                header = line.split()
+                if len(header) != 3:
+                    break
+                # The log may have been rotated or truncated, the script starts from 0 then
+                position['inode'], position['offset'] = header[0].decode(), int(header[2])
+                continue
+            position['offset'] += len(line)
+            yield line.decode(errors="replace")
+        if header is None or len(header) != 3:
+            raise RuntimeError(f"\nCould not read {log_path} on the instance ({pub_ip}).")
+        finished = True
+    finally:
+        await finish_stream(process, finished, limit)
+        access_logs.add_stats(stats, decoder)
+
+
+# Yield the lines of every log file, rotated or live, which may hold requests made between since and until.
+# Lines outside of the range are not filtered out. The offsets of incremental queries are not changed.
+async def stream_log_range(key_path, pub_ip, since, until=None, limit=None, log_path=access_logs.ACCESS_LOG,
+                           stats=None):
+    if limit is not None:
+        await limit.acquire()
+    process = await asyncio.create_subprocess_shell(
+        access_logs.range_command(key_path, pub_ip, log_path, since, until), stdout=asyncio.subprocess.PIPE,
+        stdin=asyncio.subprocess.DEVNULL)
+    metrics.count('commands')
+    decoder = access_logs.GzipLines()
+    finished = False
+    try:
+        async for line in read_gzip_lines(process, decoder):
+            yield line.decode(errors="replace")
+        finished = True
+    finally:
+        await finish_stream(process, finished, limit)
+        access_logs.add_stats(stats, decoder)
+
+
+async def finish_stream(process, finished, limit):
+    # Stopped early, e.g. cancelled or the consumer did not read every line
+    if not finished and process.returncode is None:
+        process.kill()
+    await process.wait()
+    if limit is not None:
+        limit.release()
+
+
+# Summarize the access log on the instance, only the JSON summary crosses the network.
+# Instances launched before summarize_logs.py existed get it copied on first use.
+async def fetch_log_summary(key_path, pub_ip, since=None, until=None, limit=None):
+    args = "".join(f" --{name} {int(value)}" for name, value in [('since', since), ('until', until)]
+                   if value is not None)
+    command = ssh_sessions.ssh_command(
+        key_path, pub_ip, shlex.quote(f"test -x summarize_logs.py || exit {MISSING_STATUS}; "
+                                      f"sudo ./summarize_logs.py{args}"), flags="-T -q")
+    (status, output) = await run_command(command, limit=limit, host=pub_ip)
+    if status == MISSING_STATUS:
+        (status, output) = await run_command(ssh_sessions.scp_command(key_path, pub_ip, "summarize_logs.py"),
+                                             limit=limit, host=pub_ip)
+        if status == 0:
+            (status, output) = await run_command(
+                ssh_sessions.ssh_command(key_path, pub_ip, "chmod 700 summarize_logs.py"), limit=limit, host=pub_ip)
+        if status == 0:
+            (status, output) = await run_command(command, limit=limit, host=pub_ip)
+    if status != 0 or not output:
+        raise RuntimeError(f"\nCould not summarize the logs on the instance ({pub_ip}).\n{output}")
+    return json.loads(output.splitlines()[-1])
+
+
+# Run one coroutine per host, at most max_connections remote commands at a time.
+# Returns a dictionary of host -> result, or the exception raised for that host.
+async def run_on_hosts(operation, hosts, max_connections=MAX_CONNECTIONS, timeout=None):
+    limit = asyncio.Semaphore(max_connections)
+    tasks = [asyncio.wait_for(operation(host, limit), timeout) for host in hosts]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return dict(zip(hosts, results))
+
+
+# Run a coroutine from the synchronous menu code
+def run(coroutine):
+    return asyncio.run(coroutine)
@@ -0,0 +1,151 @@
+import json
+import math
+import os
+import time
+
+# Requests per second one web server is sized for
+TARGET_RPS = 50
+MIN_INSTANCES = 1
+MAX_INSTANCES = 10
+# Seconds after a launch before the next launch, and after any change before instances are terminated.
+# New instances need time to boot and to show up in the rates.
+SCALE_OUT_COOLDOWN = 300
+SCALE_IN_COOLDOWN = 600
+# Instances are terminated only when the others would stay under this share of the target, so the fleet
+# does not launch and terminate in turns around the target
+SCALE_IN_UTILIZATION = 0.7
+# Seconds of access log the rate is measured over, and seconds between two samples
+SAMPLE_WINDOW = 60
+SAMPLE_INTERVAL = 60
+# Every decision with the rates which led to it, one JSON object per line
+DECISIONS_FILE = os.path.expanduser("~/.aws/autoscaler.jsonl")
+
+
+def make_policy(target_rps=TARGET_RPS, min_instances=MIN_INSTANCES, max_instances=MAX_INSTANCES,
+                scale_out_cooldown=SCALE_OUT_COOLDOWN, scale_in_cooldown=SCALE_IN_COOLDOWN,
+                scale_in_utilization=SCALE_IN_UTILIZATION, window=SAMPLE_WINDOW, interval=SAMPLE_INTERVAL):
+    if target_rps <= 0:
+        raise ValueError("The target needs to be more than 0 requests per second.")
+    if not 0 <= min_instances <= max_instances:
+        raise ValueError("The minimum number of instances needs to be between 0 and the maximum.")
+    return {'target_rps': target_rps, 'min_instances': min_instances, 'max_instances': max_instances,
+            'scale_out_cooldown': scale_out_cooldown, 'scale_in_cooldown': scale_in_cooldown,
+            'scale_in_utilization': scale_in_utilization, 'window': window, 'interval': interval}
+
+
+# Times of the last launch and of the last change of any kind
+def new_state():
+    return {'last_scale_out': None, 'last_change': None}
+
+
+def cooling_down(last, cooldown, now):
+    return last is not None and now - last < cooldown
+
+
+# Decide what to do from the request rate of every instance of the fleet (instance ID -> requests/s,
+# None for an instance which could not be sampled, e.g. still booting). Returns the decision with the
+# metrics behind it, decision['action'] is 'launch', 'terminate' or 'none'.
+def decide(rates, policy, state, now):
+    sampled = {instance_id: rate for instance_id, rate in rates.items() if rate is not None}
+    size = len(rates)
+    total = sum(sampled.values())
+    needed = min(policy['max_instances'], max(policy['min_instances'], math.ceil(total / policy['target_rps'])))
+    # Fewest instances which would stay under the scale in utilization
+    keep = min(policy['max_instances'], max(policy['min_instances'], math.ceil(
+        total / (policy['target_rps'] * policy['scale_in_utilization']))))
+    decision = {'time': now, 'instances': size, 'sampled': len(sampled), 'total_rps': round(total, 3),
+                'rps_per_instance': round(total / size, 3) if size else None, 'target_rps': policy['target_rps'],
+                'needed': needed, 'rates': {instance_id: None if rate is None else round(rate, 3)
+                                            for instance_id, rate in rates.items()},
+                'action': 'none', 'count': 0, 'instance_ids': []}
+
+    if size < policy['min_instances']:
+        # Bounds are enforced whatever the cooldowns
+        decision.update(action='launch', count=policy['min_instances'] - size, reason="below the minimum")
+    elif size > policy['max_instances']:
+        decision.update(action='terminate', count=size - policy['max_instances'], reason="above the maximum")
+    elif needed > size:
+        if cooling_down(state['last_scale_out'], policy['scale_out_cooldown'], now):
+            decision['reason'] = f"needs {needed} instances, waiting for the scale out cooldown"
+        else:
+            decision.update(action='launch', count=needed - size,
+                            reason=f"{total:.1f} requests/s is over the target of {size} instances")
+    elif keep < size:
+        if len(sampled) < size:
+            # Do not terminate on rates which are missing, the unsampled instances may be the busy ones
+            decision['reason'] = f"{size - len(sampled)} instances could not be sampled, not scaling in"
+        elif cooling_down(state['last_change'], policy['scale_in_cooldown'], now):
+            decision['reason'] = f"could run on {keep} instances, waiting for the scale in cooldown"
+        else:
+            decision.update(action='terminate', count=size - keep,
+                            reason=f"{total:.1f} requests/s fits on {keep} instances")
+    else:
+        decision['reason'] = f"{size} instances serve {total:.1f} requests/s"
+
+    if decision['action'] == 'terminate':
+        # The least loaded instances go first, instances without a rate count as idle
+        least_loaded = sorted(rates, key=lambda instance_id: (rates[instance_id] or 0.0, instance_id))
+        decision['instance_ids'] = least_loaded[:decision['count']]
+    return decision
+
+
+def record_decision(decision, path=None):
+    path = path or DECISIONS_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(decision, default=str) + "\n")
+
+
+# One round of the loop: list the fleet, sample the rates, decide and act.
+#   list_fleet() returns the IDs of the live instances of the fleet
+#   sample(instance_ids) returns instance ID -> requests/s, missing or None when not sampled
+#   launch(count) launches instances and returns how many of them got ready
+#   terminate(instance_ids) terminates instances
+# A failed action is recorded in decision['error'] and tried again in the next round. The scale out cooldown
+# only starts when at least one instance got ready. When the fleet cannot be listed or sampled nothing is
+# changed in that round, the error is recorded the same way.
+def step(policy, state, list_fleet, sample, launch, terminate, clock=time.time, log_path=None):
+    try:
+        instance_ids = list_fleet()
+        rates = sample(instance_ids) if instance_ids else {}
+    except Exception as error:
+        decision = {'time': clock(), 'action': 'none', 'count': 0, 'instance_ids': [],
+                    'reason': "could not read the fleet", 'error': str(error)}
+        record_decision(decision, log_path)
+        return decision
+    decision = decide({instance_id: rates.get(instance_id) for instance_id in instance_ids}, policy, state, clock())
+    try:
+        if decision['action'] == 'launch':
+            decision['launched'] = launch(decision['count'])
+            if decision['launched'] < decision['count']:
+                decision['error'] = f"{decision['count'] - decision['launched']} of {decision['count']} " \
+                                    f"instances did not get ready."
+            if decision['launched']:
+                # The cooldown starts once the new instances are up, launching waits for them
+                state['last_scale_out'] = state['last_change'] = clock()
+        elif decision['action'] == 'terminate':
+            terminate(decision['instance_ids'])
+            state['last_change'] = clock()
+    except Exception as error:
+        decision['error'] = str(error)
+    record_decision(decision, log_path)
+    return decision
+
+
+# Run rounds every policy['interval'] seconds, until interrupted or for a number of rounds.
+# on_decision(decision) is called after every round.
+def run(policy, list_fleet, sample, launch, terminate, on_decision=None, rounds=None, clock=time.time,
+        sleep=time.sleep, log_path=None):
+    state = new_state()
+    decisions = []
+    while True:
+        started = clock()
+        decision = step(policy, state, list_fleet, sample, launch, terminate, clock, log_path)
+        if on_decision:
+            on_decision(decision)
+        # Decisions are only kept for a bounded run, the log file has all of them
+        if rounds is not None:
+            decisions.append(decision)
+            if len(decisions) >= rounds:
+                return decisions
+        sleep(max(0.0, policy['interval'] - (clock() - started)))
@@ -0,0 +1,47 @@
+import threading
+import metrics
+import rate_limits
+
+# boto3 is imported and the session is created on first use, importing this module is cheap.
+# Clients and resources are cached, every service is built once and shared by the whole script.
+session = None
+clients = {}
+resources = {}
+clients_lock = threading.Lock()
+
+
+def get_session():
+    global session
+    if session is None:
+        import boto3
+        session = boto3.session.Session()
+        # Count and time every API call made by the clients of this session
+        metrics.register_api_hooks(session.events)
+        # Keep every client under the rate limits of its service
+        rate_limits.register_hooks(session.events)
+    return session
+
+
+def client(service):
+    with clients_lock:
+        if service not in clients:
+            # Identical describe calls in flight at the same time are made once
+            clients[service] = rate_limits.coalesce_calls(get_session().client(service))
+        return clients[service]
+
+
+def resource(service):
+    with clients_lock:
+        if service not in resources:
+            resources[service] = get_session().resource(service)
+            rate_limits.coalesce_calls(resources[service].meta.client)
+        return resources[service]
+
+
+# Forget the session and every cached client, e.g. after the credentials changed
+def reset():
+    global session
+    with clients_lock:
+        session = None
+        clients.clear()
+        resources.clear()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import async_remote
+import aws_clients
+import health_checks
+import inventory
+import log_parser
+import metrics
+import run_newwebserver
+import s3_bulk_delete
+import s3_sync
+
+# Exit status when some of the items failed, e.g. one host out of many could not be reached
+FAILED_STATUS = 1
+# Exit status of an operation which could not start, e.g. an unknown security group
+ERROR_STATUS = 2
+
+
+# Items are written as soon as they are known. NDJSON is one JSON object per line, JSON is a single array
+# whose elements are written one by one, so neither format keeps a listing or a log query in memory.
+class Output:
+    def __init__(self, stream, output_format="ndjson"):
+        self.stream = stream
+        self.output_format = output_format
+        self.count = 0
+        self.failed = 0
+
+    def write(self, item, failed=False):
+        line = json.dumps(item, default=str, separators=(",", ":"))
+        if self.output_format == "json":
+            line = ("[" if self.count == 0 else ",\n") + line
+        else:
+            line += "\n"
+        self.stream.write(line)
+        self.stream.flush()
+        self.count += 1
+        self.failed += bool(failed)
+
+    def close(self):
+        if self.output_format == "json":
+            self.stream.write("[]\n" if self.count == 0 else "]\n")
+            self.stream.flush()
+
+
+def key_pair(key_path):
+    key_path = os.path.expanduser(key_path)
+    if not key_path.endswith(".pem") or not os.path.isfile(key_path):
+        raise ValueError(f"{key_path} is not a .pem file.")
+    return os.path.basename(key_path)[:-4], key_path
+
+
+# Public IP addresses given with --ip, or of the running instances matching --name
+def select_hosts(args):
+    if args.ip:
+        return args.ip
+    hosts = [instance['public_ip'] for instance in inventory.instances(['running'], args.name)
+             if instance['public_ip']]
+    if not hosts:
+        raise ValueError("No running instances match.")
+    return hosts
+
+
+def launch(args, output):
+    group = inventory.find_security_group(args.security_group)
+    if group is None:
+        raise ValueError(f"Security group {args.security_group} was not found.")
+    image_id = run_newwebserver.find_golden_image() if args.image == "golden" else args.image
+    for result in run_newwebserver.create_instance(key_pair(args.key), group['id'], args.name, args.count,
+                                                   image_id):
+        output.write(dict(result, name=args.name), failed=not result['web_server'])
+
+
+# Every page is written as it arrives, the listing is not cached
+def list_resources(args, output):
+    if args.kind == "instances":
+        paginator = run_newwebserver.ec2_client().get_paginator('describe_instances')
+        filters = run_newwebserver.instance_filters(args.state or ['running'], args.name, dict(args.tag or []))
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    output.write(inventory.instance_record(instance))
+    elif args.kind == "buckets":
+        for page in aws_clients.client("s3").get_paginator('list_buckets').paginate():
+            for bucket in page['Buckets']:
+                output.write({'name': bucket['Name'], 'created': bucket['CreationDate']})
+    else:
+        for page in run_newwebserver.ec2_client().get_paginator('describe_security_groups').paginate():
+            for group in page['SecurityGroups']:
+                output.write({'id': group['GroupId'], 'name': group['GroupName'], 'vpc_id': group.get('VpcId')})
+
+
+# A file is uploaded as it is, a directory is synced and unchanged files are skipped
+def upload(args, output):
+    if os.path.isdir(args.path):
+        def write_file(key, uploaded, error):
+            output.write({'bucket': args.bucket, 'key': key, 'uploaded': uploaded,
+                          'error': str(error) if error else None}, failed=error is not None)
+
+        s3_sync.sync_directory(aws_clients.client("s3"), args.bucket, args.path, args.prefix.strip("/"),
+                               extra_args={'ACL': 'public-read'}, on_file=write_file)
+    elif os.path.isfile(args.path):
+        key = "/".join(part for part in [args.prefix.strip("/"), os.path.basename(args.path)] if part)
+        aws_clients.client("s3").upload_file(args.path, args.bucket, key, ExtraArgs={'ACL': 'public-read'})
+        output.write({'bucket': args.bucket, 'key': key, 'uploaded': True, 'bytes': os.path.getsize(args.path),
+                      'url': f"http://s3-eu-west-1.amazonaws.com/{args.bucket}/{key}"})
+    else:
+        raise ValueError(f"{args.path} is not a file or a directory.")
+
+
+def delete_bucket(args, output):
+    client = aws_clients.client("s3")
+    stats = s3_bulk_delete.empty_bucket(client, args.bucket)
+    if not stats['errors']:
+        client.delete_bucket(Bucket=args.bucket)
+        inventory.invalidate('buckets')
+    output.write({'bucket': args.bucket, 'deleted': not stats['errors'], 'objects': stats['deleted'],
+                  'aborted_uploads': stats['aborted_uploads'], 'seconds': round(stats['seconds'], 3),
+                  'errors': [{'key': error['Key'], 'message': error['Message']} for error in stats['errors']]},
+                 failed=bool(stats['errors']))
+
+
+def terminate(args, output):
+    if not args.name and not args.tag and not args.all:
+        raise ValueError("Give --name or --tag, or --all to terminate every instance.")
+    for instance_id in run_newwebserver.terminate_instances(args.name, dict(args.tag or [])):
+        output.write({'id': instance_id, 'terminated': True})
+
+
+# Probe every web server over HTTP. With --repair, check_webserver.py is run over SSH on the unhealthy ones,
+# which restarts Apache if it is not running.
+def status(args, output):
+    results = health_checks.probe_all(select_hosts(args))
+    unhealthy = [result['host'] for result in results if not health_checks.is_healthy(result)]
+    repaired = {}
+    if args.repair and unhealthy:
+        key_path = key_pair(args.key)[1]
+        repaired = async_remote.run(async_remote.run_on_hosts(
+            lambda ip_address, limit: async_remote.check_web_server(ip_address, key_path, limit), unhealthy))
+    for result in results:
+        result['healthy'] = health_checks.is_healthy(result)
+        if result['host'] in repaired:
+            result['repaired'] = repaired[result['host']] is True
+        output.write(result, failed=not result['healthy'] and not result.get('repaired'))
+
+
+# Requests of one instance, written batch by batch as the log is parsed. Without a time range the new lines
+# since the last query (or the whole current log with --full) are read and stored, like menu option 10.
+# With a time range the rotated logs are read too and nothing is stored.
+async def query_host(args, key_path, ip_address, output, limit, stats):
+    if args.since is not None:
+        lines = async_remote.stream_log_range(key_path, ip_address, args.since, args.until, limit, stats=stats)
+        batches = log_parser.parse_async_stream(lines, run_newwebserver.LOG_BATCH_SIZE)
+    else:
+        batches = run_newwebserver.fetch_and_store_logs(key_path, ip_address, not args.full, limit, stats)
+    count = 0
+    async for batch in batches:
+        if args.method:
+            batch = log_parser.filter_batch(batch, batch['method'] == args.method)
+        if args.since is not None:
+            batch = log_parser.filter_batch(batch, batch['time'] >= args.since)
+        if args.until is not None:
+            batch = log_parser.filter_batch(batch, batch['time'] <= args.until)
+        for record in log_parser.records_from_batch(batch):
+            output.write(dict(zip(log_parser.FIELDS, record), instance=ip_address))
+            count += 1
+    return count
+
+
+def query_logs(args, output):
+    key_path = key_pair(args.key)[1]
+    if args.hours is not None:
+        args.since = time.time() - args.hours * 3600
+    stats = {}
+    results = async_remote.run(async_remote.run_on_hosts(
+        lambda ip_address, limit: query_host(args, key_path, ip_address, output, limit, stats),
+        select_hosts(args), max_connections=run_newwebserver.LOG_QUERY_MAX_CONNECTIONS))
+    for ip_address, result in results.items():
+        if isinstance(result, Exception):
+            output.write({'instance': ip_address, 'error': str(result).strip()}, failed=True)
+    run_newwebserver.print_transfer_stats(stats)
+
+
+COMMANDS = {'launch': launch, 'list': list_resources, 'upload': upload, 'delete-bucket': delete_bucket,
+            'terminate': terminate, 'status': status, 'query-logs': query_logs}
+
+
+def tag(value):
+    if "=" not in value:
+        raise argparse.ArgumentTypeError("tags are given as KEY=VALUE")
+    return tuple(value.split("=", 1))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Run one operation without the menu. Results are written to stdout as JSON, "
+                    "progress and timings to stderr.")
+    parser.add_argument("--format", choices=["ndjson", "json"], default="ndjson",
+                        help="one JSON object per line (default), or a single JSON array")
+    parser.add_argument("--timings", action="store_true", help="print the timings of the operation to stderr")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("launch", help="launch instances and wait for their web servers")
+    command.add_argument("--key", required=True, help="path to the .pem key pair")
+    command.add_argument("--security-group", required=True, help="ID or name")
+    command.add_argument("--name", required=True)
+    command.add_argument("--count", type=int, default=1)
+    command.add_argument("--image", help="AMI ID, or 'golden' for the newest golden image")
+
+    command = commands.add_parser("list", help="list instances, buckets or security groups")
+    command.add_argument("kind", choices=["instances", "buckets", "security-groups"])
+    command.add_argument("--name", help="name tag of the instances, wildcards are allowed")
+    command.add_argument("--tag", type=tag, action="append", help="KEY=VALUE, can be repeated")
+    command.add_argument("--state", action="append", help="instance state (default running), can be repeated")
+
+    command = commands.add_parser("upload", help="upload a file or sync a directory to a bucket")
+    command.add_argument("bucket")
+    command.add_argument("path")
+    command.add_argument("--prefix", default="")
+
+    command = commands.add_parser("delete-bucket", help="empty a bucket and delete it")
+    command.add_argument("bucket")
+
+    command = commands.add_parser("terminate", help="terminate instances by name or tag")
+    command.add_argument("--name", help="wildcards are allowed")
+    command.add_argument("--tag", type=tag, action="append", help="KEY=VALUE, can be repeated")
+    command.add_argument("--all", action="store_true", help="terminate every instance")
+
+    for name, help_text in [("status", "probe the web servers over HTTP"),
+                            ("query-logs", "stream the requests from the access logs")]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--ip", action="append", help="public IP address, can be repeated")
+        command.add_argument("--name", help="running instances with this name tag, used when no --ip is given")
+        if name == "status":
+            command.add_argument("--key", help="path to the .pem key pair, needed by --repair")
+            command.add_argument("--repair", action="store_true",
+                                 help="run check_webserver.py on the web servers which did not answer")
+        else:
+            command.add_argument("--key", required=True, help="path to the .pem key pair")
+            command.add_argument("--full", action="store_true",
+                                 help="read the whole current log instead of the lines since the last query")
+            command.add_argument("--since", type=int, help="epoch seconds, rotated logs are read too")
+            command.add_argument("--until", type=int, help="epoch seconds")
+            command.add_argument("--hours", type=float, help="same as --since, in hours back from now")
+            command.add_argument("--method", help="only requests with this method, e.g. GET")
+    return parser
+
+
+def main(argv=None, stdout=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "status" and args.repair and not args.key:
+        build_parser().error("--repair needs --key")
+    output = Output(stdout or sys.stdout, args.format)
+    # Messages of the menu functions go to stderr, stdout only has the results
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            with metrics.operation(f"cli {args.command}", quiet=not args.timings):
+                COMMANDS[args.command](args, output)
+        except Exception as error:
+            print(f"\n{error}")
+            return ERROR_STATUS
+        finally:
+            output.close()
+    return FAILED_STATUS if output.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
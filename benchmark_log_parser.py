@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Compare the batch NumPy parser with the per-line apache_log_parser path on a generated log.
+# Usage: ./benchmark_log_parser.py [number of lines]
+import random
+import sys
+import time
+import log_parser
+
+STATUSES = ['200', '200', '200', '304', '404', '500']
+PATHS = ['/', '/index.html', '/photo.jpeg', '/about?lang=en', '/missing']
+METHODS = ['GET', 'GET', 'GET', 'POST', 'HEAD']
+
+
+def generate_log(line_count):
+    start = 1570000000
+    lines = []
+    for i in range(line_count):
+        received = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(start + i // 50))
+        lines.append(f'10.0.{random.randint(0, 255)}.{random.randint(0, 255)} - - [{received}] '
+                     f'"{random.choice(METHODS)} {random.choice(PATHS)} HTTP/1.1" '
+                     f'{random.choice(STATUSES)} {random.randint(0, 50000)}\n')
+    return lines
+
+
+def benchmark_per_line(lines):
+    import apache_log_parser
+    line_parser = apache_log_parser.make_parser("%h %l %u %t \"%r\" %>s %b")
+    start = time.perf_counter()
+    statuses = {}
+    for line in lines:
+        log_line_data = line_parser(line)
+        statuses[log_line_data['status']] = statuses.get(log_line_data['status'], 0) + 1
+    return time.perf_counter() - start
+
+
+def benchmark_batch(lines):
+    start = time.perf_counter()
+    batch = log_parser.concat_batches(log_parser.parse_stream(lines))
+    log_parser.status_histogram(batch)
+    return time.perf_counter() - start
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print(f"\nGenerating {line_count} log lines...")
+    lines = generate_log(line_count)
+
+    batch_time = benchmark_batch(lines)
+    print(f"\nBatch NumPy parser:\t{batch_time:.2f}s\t({line_count / batch_time:.0f} lines/s)")
+    try:
+        per_line_time = benchmark_per_line(lines)
+    except ImportError:
+        print("\napache-log-parser is not installed, skipping the per-line benchmark.")
+        return
+    print(f"Per-line apache_log_parser:\t{per_line_time:.2f}s\t({line_count / per_line_time:.0f} lines/s)")
+    print(f"\nSpeedup: {per_line_time / batch_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Track the cold-start cost of the script: importing it, and building the first AWS client.
+# Every measurement runs in a fresh interpreter. Usage: ./benchmark_startup.py [runs]
+import statistics
+import subprocess
+import sys
+
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import run_newwebserver
+print(time.perf_counter() - start)
+'''
+
+FIRST_CLIENT_SCRIPT = '''
+import time
+import run_newwebserver
+start = time.perf_counter()
+run_newwebserver.ec2_client()
+print(time.perf_counter() - start)
+'''
+
+BOTO3_SCRIPT = '''
+import time
+start = time.perf_counter()
+import boto3
+print(time.perf_counter() - start)
+'''
+
+
+def measure(script, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", script], universal_newlines=True)
+        timings.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"\nMedian of {runs} cold starts:\n")
+    print(f"\timport run_newwebserver\t{measure(IMPORT_SCRIPT, runs) * 1000:.0f}ms")
+    print(f"\timport boto3\t\t{measure(BOTO3_SCRIPT, runs) * 1000:.0f}ms")
+    try:
+        print(f"\tfirst EC2 client\t{measure(FIRST_CLIENT_SCRIPT, runs) * 1000:.0f}ms")
+    except subprocess.CalledProcessError:
+        print("\tfirst EC2 client\tfailed, configure a region with 'aws configure'")
+
+
+if __name__ == '__main__':
+    main()
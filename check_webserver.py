@@ -1,5 +1,33 @@
 #!/usr/bin/env python36
+import json
+import os
 import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import agent_settings
+
+HTTPD_PIDFILE = "/var/run/httpd/httpd.pid"
+ACCESS_LOG = "/var/log/httpd/access_log"
+# Seconds between two checks of the agent
+AGENT_INTERVAL = 5
+# Bytes of the access log read at a time when counting requests
+READ_CHUNK_SIZE = 64 * 1024
+
+# Shared between the watcher thread and the status endpoint of the agent
+agent_state = {
+    'running': False,
+    'pid': None,
+    'httpd_uptime': None,
+    'restart_count': 0,
+    # Output of the last restart which failed, None until one fails
+    'last_error': None,
+    'requests_total': 0,
+    'requests_per_second': 0.0,
+    'started': time.time(),
+}
+agent_lock = threading.Lock()
 
 
 def run_apache():
@@ -12,13 +40,49 @@ def run_apache():
         pass
 
 
+# Find the PID of httpd from its pidfile, or by scanning /proc if the pidfile is missing or stale
+def httpd_pid(pidfile=HTTPD_PIDFILE, proc_root="/proc"):
+    try:
+        with open(pidfile) as f:
+            pid = int(f.read().strip())
+        if process_name(pid, proc_root) == "httpd":
+            return pid
+    except (OSError, ValueError):
+        pass
+
+    for entry in os.listdir(proc_root):
+        if entry.isdigit() and process_name(int(entry), proc_root) == "httpd":
+            return int(entry)
+    return None
+
+
+def process_name(pid, proc_root="/proc"):
+    try:
+        with open(os.path.join(proc_root, str(pid), "comm")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# Seconds since the process was started
+def process_uptime(pid, proc_root="/proc"):
+    try:
+        with open(os.path.join(proc_root, str(pid), "stat")) as f:
+            # The process name can contain spaces, the fields after it are space separated
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open(os.path.join(proc_root, "uptime")) as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
 # Check if Apache is running
 def check_apache():
-    (status, output) = subprocess.getstatusoutput("ps -A | grep httpd")
-    if status == 0:
+    if httpd_pid():
         print("Apache Web Server is running.")
     else:
-        print(f"Apache Web Server is not running.{output}")
+        print("Apache Web Server is not running.")
         run_apache()
 
 
@@ -36,8 +100,104 @@ def install_apache():
         print("Closing...")
 
 
+# Count the requests appended to the access log since the last call.
+# position is a dictionary with the inode and offset of the previous call, it is updated in place.
+def count_new_requests(position, log_path=ACCESS_LOG):
+    try:
+        stat = os.stat(log_path)
+        # The log was rotated or truncated, start from the beginning
+        if stat.st_ino != position.get('inode') or stat.st_size < position.get('offset', 0):
+            position['inode'], position['offset'] = stat.st_ino, 0
+        count = 0
+        # Read in chunks, a busy log can grow by a lot between two checks
+        with open(log_path, "rb") as f:
+            f.seek(position['offset'])
+            remaining = stat.st_size - position['offset']
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                count += chunk.count(b"\n")
+                position['offset'] += len(chunk)
+                remaining -= len(chunk)
+        return count
+    except OSError:
+        return 0
+
+
+# Position at the end of the log, the requests already in it are not counted
+def end_of_log(log_path=ACCESS_LOG):
+    try:
+        stat = os.stat(log_path)
+        return {'inode': stat.st_ino, 'offset': stat.st_size}
+    except OSError:
+        return {}
+
+
+# One check of the agent: restart httpd if it died and update the counters
+def watch_httpd(position, interval, pidfile=HTTPD_PIDFILE, proc_root="/proc", log_path=ACCESS_LOG):
+    pid = httpd_pid(pidfile, proc_root)
+    restarted = False
+    error = None
+    if not pid:
+        # Restarting is the only step which needs a new process
+        (status, output) = subprocess.getstatusoutput("service httpd start")
+        pid = httpd_pid(pidfile, proc_root)
+        # Only a restart after which httpd is running counts
+        restarted = status == 0 and pid is not None
+        if not restarted:
+            error = output.strip() or "service httpd start exited with status {}".format(status)
+
+    new_requests = count_new_requests(position, log_path)
+    with agent_lock:
+        agent_state['running'] = pid is not None
+        agent_state['pid'] = pid
+        agent_state['httpd_uptime'] = process_uptime(pid, proc_root) if pid else None
+        agent_state['restart_count'] += 1 if restarted else 0
+        if error:
+            agent_state['last_error'] = error
+        agent_state['requests_total'] += new_requests
+        agent_state['requests_per_second'] = new_requests / interval
+
+
+def agent_status():
+    with agent_lock:
+        status = dict(agent_state)
+    status['uptime'] = time.time() - status.pop('started')
+    return status
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(agent_status()).encode()
+        self.send_response(200 if agent_state['running'] else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Long-running mode: watch httpd without spawning processes and serve its status on localhost
+def run_agent(port=agent_settings.AGENT_PORT, interval=AGENT_INTERVAL):
+    server = HTTPServer(("127.0.0.1", port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Agent is serving Apache Web Server status on port {}.".format(port))
+
+    # Only count the requests made while the agent is running
+    position = end_of_log()
+    while True:
+        watch_httpd(position, interval)
+        time.sleep(interval)
+
+
 def main():
-    check_apache()
+    if "--agent" in sys.argv:
+        run_agent()
+    else:
+        check_apache()
 
 
 if __name__ == '__main__':
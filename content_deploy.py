@@ -0,0 +1,68 @@
+import hashlib
+import html
+import shlex
+import time
+import access_logs
+import async_remote
+
+INDEX_PATH = "/var/www/html/index.html"
+# Upper limit of hosts deployed to at the same time
+DEPLOY_MAX_CONNECTIONS = 50
+# A host which is still failing after this many seconds is reported as failed
+DEPLOY_DEADLINE = 60
+# Longest sleep (seconds) between two attempts on one host
+DEPLOY_MAX_DELAY = 5
+
+
+def index_page(urls):
+    return "".join(f'<img src="{html.escape(url)}" alt="{html.escape(url)}">\n' for url in urls)
+
+
+def content_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+# Read the new content from stdin into a temporary file next to the page, then rename it over the page.
+# The rename is atomic, Apache serves either the old or the new page and never a partial one.
+# Nothing is replaced if the page already has the same content. Prints "<updated|unchanged> <sha256>".
+def swap_script(path, digest):
+    directory = shlex.quote(path.rsplit("/", 1)[0] or "/")
+    path = shlex.quote(path)
+    return (f"tmp=$(mktemp {directory}/.deploy.XXXXXX) || exit 1; "
+            f"cat > \"$tmp\"; "
+            f"new=$(sha256sum < \"$tmp\" | cut -d' ' -f1); "
+            f"old=$(cat {path} 2>/dev/null | sha256sum | cut -d' ' -f1); "
+            f"if [ \"$new\" != '{digest}' ]; then rm -f \"$tmp\"; echo \"corrupt $new\"; exit 1; fi; "
+            f"if [ \"$old\" = \"$new\" ]; then rm -f \"$tmp\"; echo \"unchanged $new\"; exit 0; fi; "
+            f"chmod 644 \"$tmp\" && mv -f \"$tmp\" {path} || {{ rm -f \"$tmp\"; exit 1; }}; "
+            f"echo \"updated $new\"")
+
+
+def deploy_command(key_path, pub_ip, path, digest):
+    return access_logs.remote_command(key_path, pub_ip, swap_script(path, digest))
+
+
+# Push the content to one host in a single round trip, retried with bounded backoff until the deadline
+async def deploy_to_host(key_path, pub_ip, content, path=INDEX_PATH, limit=None, deadline=DEPLOY_DEADLINE):
+    digest = content_digest(content)
+    start = time.perf_counter()
+    (status, output, attempts) = await async_remote.retry_command(
+        deploy_command(key_path, pub_ip, path, digest), deadline=deadline, limit=limit,
+        max_delay=DEPLOY_MAX_DELAY, input=content, host=pub_ip)
+    words = output.split()
+    if status == 0 and words[-2:] in [["updated", digest], ["unchanged", digest]]:
+        result = words[-2]
+    else:
+        result = "failed"
+    return {'host': pub_ip, 'result': result, 'attempts': attempts, 'seconds': time.perf_counter() - start,
+            'error': None if result != "failed" else output}
+
+
+# Push the content to every host in parallel. Returns one result per host, in the order of hosts.
+async def deploy(key_path, hosts, content, path=INDEX_PATH, max_connections=DEPLOY_MAX_CONNECTIONS,
+                 deadline=DEPLOY_DEADLINE):
+    results = await async_remote.run_on_hosts(
+        lambda host, limit: deploy_to_host(key_path, host, content, path, limit, deadline), hosts, max_connections)
+    return [result if not isinstance(result, Exception) else
+            {'host': host, 'result': "failed", 'attempts': 0, 'seconds': 0.0, 'error': str(result)}
+            for host, result in results.items()]
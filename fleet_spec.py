@@ -0,0 +1,181 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Ports opened to the world when a security group of the spec does not list any
+DEFAULT_PORTS = [22, 80]
+# Instances of these states count towards the desired number of instances
+LIVE_STATES = ['pending', 'running']
+# Number of changes applied at the same time
+APPLY_MAX_WORKERS = 16
+
+
+# A spec is a JSON file such as:
+# {
+#     "security_groups": [{"name": "web", "ports": [22, 80]}],
+#     "instances": [{"name": "web", "count": 3, "security_group": "web", "image": "golden"}],
+#     "buckets": [{"name": "my-static-assets"}]
+# }
+# Only the resources named in the spec are managed, everything else is left alone.
+def load_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    return validate_spec(spec)
+
+
+# Returns a checked copy of the spec with the defaults filled in, the spec given is not changed
+def validate_spec(spec):
+    spec = {kind: [dict(entry) if isinstance(entry, dict) else entry for entry in spec.get(kind, [])]
+            for kind in ['security_groups', 'instances', 'buckets']}
+    for kind, entries in spec.items():
+        for entry in entries:
+            if not isinstance(entry, dict) or not isinstance(entry.get('name'), str) or not entry['name']:
+                raise ValueError(f"Every entry of {kind} needs a name.")
+    group_names = [group['name'] for group in spec['security_groups']]
+    for group in spec['security_groups']:
+        group.setdefault('ports', DEFAULT_PORTS)
+    for instances in spec['instances']:
+        if not isinstance(instances.get('count'), int) or instances['count'] < 0:
+            raise ValueError(f"Instances '{instances['name']}' need a count of 0 or more.")
+        # The group is either managed by the spec or already exists
+        instances.setdefault('security_group', group_names[0] if group_names else None)
+        if not instances['security_group']:
+            raise ValueError(f"Instances '{instances['name']}' need a security group.")
+    names = [instances['name'] for instances in spec['instances']]
+    if len(names) != len(set(names)):
+        raise ValueError("Every instance name can only appear once in the spec.")
+    return spec
+
+
+# Current state of the resources named in the spec, with one paginated describe per resource type
+def describe_state(ec2_client, s3_client, spec):
+    state = {'security_groups': {}, 'instances': {}, 'buckets': set()}
+    group_names = sorted({group['name'] for group in spec['security_groups']} |
+                         {instances['security_group'] for instances in spec['instances']})
+    if group_names:
+        for page in ec2_client.get_paginator('describe_security_groups').paginate(
+                Filters=[{'Name': 'group-name', 'Values': group_names}]):
+            for group in page['SecurityGroups']:
+                state['security_groups'][group['GroupName']] = {'id': group['GroupId'],
+                                                                'ports': open_ports(group['IpPermissions'])}
+
+    names = [instances['name'] for instances in spec['instances']]
+    if names:
+        filters = [{'Name': 'tag:Name', 'Values': names}, {'Name': 'instance-state-name', 'Values': LIVE_STATES}]
+        for page in ec2_client.get_paginator('describe_instances').paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    name = next(tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name')
+                    state['instances'].setdefault(name, []).append(instance)
+
+    if spec['buckets']:
+        state['buckets'] = {bucket['Name'] for bucket in s3_client.list_buckets()['Buckets']}
+    return state
+
+
+# TCP ports open to 0.0.0.0/0
+def open_ports(permissions):
+    ports = set()
+    for permission in permissions:
+        if permission.get('IpProtocol') in ['tcp', '-1'] and \
+                any(ip_range.get('CidrIp') == "0.0.0.0/0" for ip_range in permission.get('IpRanges', [])):
+            if permission['IpProtocol'] == '-1':
+                return set(range(0, 65536))
+            ports.update(range(permission['FromPort'], permission['ToPort'] + 1))
+    return ports
+
+
+# Diff the spec against the current state. Returns the list of changes needed, an empty list means none.
+def plan(spec, state):
+    changes = []
+    for group in spec['security_groups']:
+        current = state['security_groups'].get(group['name'])
+        if current is None:
+            changes.append({'action': 'create_security_group', 'name': group['name'], 'ports': group['ports']})
+        else:
+            missing = sorted(set(group['ports']) - current['ports'])
+            if missing:
+                changes.append({'action': 'open_ports', 'name': group['name'], 'group_id': current['id'],
+                                'ports': missing})
+
+    for instances in spec['instances']:
+        current = state['instances'].get(instances['name'], [])
+        if len(current) < instances['count']:
+            changes.append({'action': 'launch', 'name': instances['name'], 'count': instances['count'] - len(current),
+                            'security_group': instances['security_group'], 'image': instances.get('image')})
+        elif len(current) > instances['count']:
+            # The newest instances go first, the older ones are warmed up
+            newest = sorted(current, key=lambda instance: instance['LaunchTime'], reverse=True)
+            changes.append({'action': 'terminate', 'name': instances['name'],
+                            'instance_ids': [instance['InstanceId']
+                                             for instance in newest[:len(current) - instances['count']]]})
+
+    for bucket in spec['buckets']:
+        if bucket['name'] not in state['buckets']:
+            changes.append({'action': 'create_bucket', 'name': bucket['name']})
+    return changes
+
+
+def describe_change(change):
+    if change['action'] == 'create_security_group':
+        return f"+ create security group {change['name']} (ports {', '.join(map(str, change['ports']))})"
+    elif change['action'] == 'open_ports':
+        return f"~ open ports {', '.join(map(str, change['ports']))} of security group {change['name']}"
+    elif change['action'] == 'launch':
+        return f"+ launch {change['count']} instances named {change['name']}"
+    elif change['action'] == 'terminate':
+        return f"- terminate {len(change['instance_ids'])} instances named {change['name']}"
+    elif change['action'] == 'create_bucket':
+        return f"+ create bucket {change['name']}"
+
+
+def create_bucket(s3_client, name):
+    region = s3_client.meta.region_name
+    # us-east-1 is the default location and is not accepted as a constraint
+    if region == "us-east-1":
+        return s3_client.create_bucket(Bucket=name)
+    return s3_client.create_bucket(Bucket=name, CreateBucketConfiguration={'LocationConstraint': region})
+
+
+# Apply the changes of a plan. Security groups come first, the instances are launched into them.
+# Everything else runs in parallel. The EC2 changes are made by the callables given:
+#   create_security_group(name, ports) returns the ID of the new group
+#   authorize_ports(group_id, ports) opens ports of a group
+#   launch(change, group_id) launches change['count'] instances
+#   terminate(instance_ids) terminates instances
+# Returns the changes with a 'result' or an 'error' each, on_change(change) is called after every change.
+def apply(changes, state, s3_client, create_security_group, authorize_ports, launch, terminate,
+          max_workers=APPLY_MAX_WORKERS, on_change=None):
+    group_ids = {name: group['id'] for name, group in state['security_groups'].items()}
+
+    def run(change):
+        if change['action'] == 'create_security_group':
+            return create_security_group(change['name'], change['ports'])
+        elif change['action'] == 'open_ports':
+            return authorize_ports(change['group_id'], change['ports'])
+        elif change['action'] == 'launch':
+            if change['security_group'] not in group_ids:
+                raise RuntimeError(f"Security group {change['security_group']} does not exist.")
+            return launch(change, group_ids[change['security_group']])
+        elif change['action'] == 'terminate':
+            return terminate(change['instance_ids'])
+        elif change['action'] == 'create_bucket':
+            return create_bucket(s3_client, change['name'])
+
+    def run_all(batch):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(change, executor.submit(run, change)) for change in batch]
+            for change, future in futures:
+                try:
+                    change['result'] = future.result()
+                except Exception as error:
+                    change['error'] = error
+                if on_change:
+                    on_change(change)
+
+    group_actions = ['create_security_group', 'open_ports']
+    groups = [change for change in changes if change['action'] in group_actions]
+    run_all(groups)
+    group_ids.update({change['name']: change['result'] for change in groups
+                      if change['action'] == 'create_security_group' and 'result' in change})
+    run_all([change for change in changes if change['action'] not in group_actions])
+    return changes
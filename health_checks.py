@@ -0,0 +1,49 @@
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Upper limit of web servers probed at the same time
+PROBE_MAX_WORKERS = 50
+PROBE_TIMEOUT = 5
+
+
+# Send a plain HTTP GET request and time the connect, time to first byte and total latency (seconds)
+def probe(host, port=80, path="/", timeout=PROBE_TIMEOUT):
+    result = {'host': host, 'status': None, 'connect': None, 'ttfb': None, 'total': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            result['connect'] = time.perf_counter() - start
+            sock.sendall(f"GET {path} HTTP/1.0\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            response = sock.recv(4096)
+            result['ttfb'] = time.perf_counter() - start
+            # Read the rest of the page
+            while sock.recv(65536):
+                pass
+            result['total'] = time.perf_counter() - start
+        status_line = response.split(b"\r\n", 1)[0].split()
+        result['status'] = int(status_line[1])
+    except (OSError, IndexError, ValueError) as error:
+        result['error'] = str(error) or type(error).__name__
+    return result
+
+
+# Apache answers 403 for its test page when there is no index.html, so any response below 500 means it is up
+def is_healthy(result):
+    return result['status'] is not None and result['status'] < 500
+
+
+def probe_all(hosts, port=80, path="/", timeout=PROBE_TIMEOUT, max_workers=PROBE_MAX_WORKERS):
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(hosts), max_workers)) as executor:
+        return list(executor.map(lambda host: probe(host, port, path, timeout), hosts))
+
+
+# p50, p90 and p99 of a latency field of the probes that got a response
+def latency_percentiles(results, field='total', percentiles=(50, 90, 99)):
+    values = [result[field] for result in results if result[field] is not None]
+    if not values:
+        return {}
+    return dict(zip(percentiles, np.percentile(values, percentiles).tolist()))
@@ -0,0 +1,130 @@
+import fnmatch
+import threading
+import time
+import aws_clients
+
+# Seconds a listing is reused before it is read from AWS again
+INVENTORY_TTL = 60
+# Instances in these states are listed, terminated ones are left out
+INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Listing and indexes of every kind of resource, e.g. entries['instances'] = {'items': [...], 'by_id': {...}, ...}
+entries = {}
+inventory_lock = threading.Lock()
+# Number of listings read from AWS and served from the cache
+stats = {'loads': 0, 'hits': 0}
+
+
+def load_instances():
+    instances = []
+    paginator = aws_clients.client("ec2").get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': INSTANCE_STATES}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instances.append(instance_record(instance))
+    return {'items': instances,
+            'by_id': {instance['id']: instance for instance in instances},
+            'by_name': group_by(instances, 'name'),
+            'by_ip': dict([(instance['private_ip'], instance) for instance in instances if instance['private_ip']] +
+                          [(instance['public_ip'], instance) for instance in instances if instance['public_ip']])}
+
+
+def load_buckets():
+    buckets = []
+    for page in aws_clients.client("s3").get_paginator('list_buckets').paginate():
+        buckets.extend({'name': bucket['Name'], 'created': bucket['CreationDate']} for bucket in page['Buckets'])
+    return {'items': buckets}
+
+
+def load_security_groups():
+    groups = []
+    for page in aws_clients.client("ec2").get_paginator('describe_security_groups').paginate():
+        groups.extend({'id': group['GroupId'], 'name': group['GroupName'], 'vpc_id': group.get('VpcId')}
+                      for group in page['SecurityGroups'])
+    return {'items': groups,
+            'by_id': {group['id']: group for group in groups},
+            'by_name': group_by(groups, 'name')}
+
+
+# Fields of a DescribeInstances result which are kept
+def instance_record(instance):
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+    return {'id': instance['InstanceId'], 'name': tags.get('Name'), 'tags': tags,
+            'state': instance['State']['Name'], 'public_ip': instance.get('PublicIpAddress'),
+            'private_ip': instance.get('PrivateIpAddress'), 'image_id': instance['ImageId'],
+            'launch_time': instance['LaunchTime']}
+
+
+LOADERS = {'instances': load_instances, 'buckets': load_buckets, 'security_groups': load_security_groups}
+
+
+def group_by(items, field):
+    index = {}
+    for item in items:
+        index.setdefault(item[field], []).append(item)
+    return index
+
+
+# Listing of one kind of resource, read again from AWS if it is older than the TTL or was invalidated.
+# A new boto3 session (e.g. other credentials) never sees the listing of the previous one.
+def get(kind, ttl=None):
+    session = aws_clients.get_session()
+    ttl = INVENTORY_TTL if ttl is None else ttl
+    with inventory_lock:
+        entry = entries.get(kind)
+        if entry and entry['session'] is session and time.monotonic() - entry['loaded'] < ttl:
+            stats['hits'] += 1
+            return entry
+    entry = dict(LOADERS[kind](), session=session, loaded=time.monotonic())
+    with inventory_lock:
+        entries[kind] = entry
+        stats['loads'] += 1
+    return entry
+
+
+# Forget the listings of the given kinds, or of every kind. Called after our own changes to AWS.
+def invalidate(*kinds):
+    with inventory_lock:
+        for kind in kinds or list(entries):
+            entries.pop(kind, None)
+
+
+# Instances matching the states, the name (wildcards such as 'web-*' are allowed, like EC2 filters) and the tags
+def instances(states=None, name=None, tags=None):
+    return [instance for instance in get('instances')['items']
+            if (states is None or instance['state'] in states)
+            and (name is None or fnmatch.fnmatchcase(instance['name'] or "", name))
+            and all(instance['tags'].get(key) == value for key, value in (tags or {}).items())]
+
+
+def instance_by_id(instance_id):
+    return get('instances')['by_id'].get(instance_id)
+
+
+# Public or private IP address
+def instance_by_ip(ip_address):
+    return get('instances')['by_ip'].get(ip_address)
+
+
+def instances_by_name(name):
+    return get('instances')['by_name'].get(name, [])
+
+
+def buckets():
+    return get('buckets')['items']
+
+
+def security_groups():
+    return get('security_groups')['items']
+
+
+# Find a security group by ID or by name. A miss reads the groups again, in case the group is new.
+def find_security_group(id_or_name):
+    for refresh in [False, True]:
+        if refresh:
+            invalidate('security_groups')
+        entry = get('security_groups')
+        group = entry['by_id'].get(id_or_name) or (entry['by_name'].get(id_or_name) or [None])[0]
+        if group:
+            return group
+    return None
@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import math
+import time
+from collections import Counter
+import numpy as np
+
+# Defaults of a load test: closed loop with 10 connections per web server for 10 seconds
+LOAD_CONCURRENCY = 10
+LOAD_DURATION = 10
+REQUEST_TIMEOUT = 5
+PERCENTILES = (50, 95, 99)
+USER_AGENT = "aws-webserver-automation-loadtest"
+# Pause of a closed loop connection after a failed request, a refused connection would otherwise spin
+ERROR_PAUSE = 0.05
+
+
+async def open_connection(host, port, timeout):
+    return await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+
+def close_connection(connection):
+    if connection:
+        connection[1].close()
+
+
+# Send one GET request on a keep-alive connection and read the whole response.
+# Returns (status, body bytes, keep the connection open).
+async def http_get(connection, host, path):
+    reader, writer = connection
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: {USER_AGENT}\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    version, status = lines[0].split()[:2]
+    headers = dict(line.split(":", 1) for line in lines[1:] if ":" in line)
+    headers = {name.strip().lower(): value.strip().lower() for name, value in headers.items()}
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+        keep_alive = version == "HTTP/1.1" and headers.get('connection') != "close"
+    else:
+        # No length, the body ends when the server closes the connection
+        body = await reader.read()
+        keep_alive = False
+    return int(status), len(body), keep_alive
+
+
+def new_result(host):
+    return {'host': host, 'requests': 0, 'errors': 0, 'bytes': 0, 'statuses': Counter(), 'error_types': Counter(),
+            'latencies': [], 'started': None, 'finished': None}
+
+
+# One connection sending requests one after another until the end of the test.
+# With a rate, every request has a scheduled send time and its latency is counted from that time, so a slow
+# server is not hidden by requests which were sent late (coordinated omission).
+async def worker(host, port, path, end, result, schedule, timeout):
+    connection = None
+    try:
+        while True:
+            if schedule:
+                scheduled = schedule['start'] + next(schedule['counter']) / schedule['rate']
+                if scheduled >= end:
+                    break
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= end:
+                    break
+
+            failed = False
+            try:
+                if connection is None:
+                    connection = await open_connection(host, port, timeout)
+                status, size, keep_alive = await asyncio.wait_for(http_get(connection, host, path), timeout)
+                result['statuses'][status] += 1
+                result['bytes'] += size
+                # Apache failing to answer is an error, any other status is an answer of the web server
+                if status >= 500:
+                    result['errors'] += 1
+                if not keep_alive:
+                    close_connection(connection)
+                    connection = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    ValueError) as error:
+                result['errors'] += 1
+                result['error_types'][type(error).__name__] += 1
+                close_connection(connection)
+                connection = None
+                failed = True
+            result['requests'] += 1
+            result['latencies'].append(time.perf_counter() - scheduled)
+            if failed and not schedule:
+                await asyncio.sleep(ERROR_PAUSE)
+    finally:
+        close_connection(connection)
+
+
+# Load one web server. Closed loop: concurrency connections, each sends its next request when the previous
+# one is answered. Open loop (rate given): requests per second are sent on schedule, by up to concurrency
+# connections at a time.
+async def load_host(host, port=80, path="/", duration=LOAD_DURATION, concurrency=LOAD_CONCURRENCY, rate=None,
+                    timeout=REQUEST_TIMEOUT):
+    result = new_result(host)
+    start = time.perf_counter()
+    end = start + duration
+    schedule = {'start': start, 'rate': rate, 'counter': itertools.count()} if rate else None
+    result['started'] = time.time()
+    await asyncio.gather(*[worker(host, port, path, end, result, schedule, timeout) for i in range(concurrency)])
+    result['finished'] = time.time()
+    return summarize(result, time.perf_counter() - start)
+
+
+def summarize(result, seconds):
+    latencies = result.pop('latencies')
+    result['seconds'] = seconds
+    result['throughput'] = result['requests'] / seconds if seconds else 0.0
+    result['error_rate'] = result['errors'] / result['requests'] if result['requests'] else 0.0
+    result['latency'] = dict(zip(PERCENTILES, np.percentile(latencies, PERCENTILES).tolist())) if latencies else {}
+    result['max_latency'] = max(latencies) if latencies else None
+    return result
+
+
+# Load every web server at the same time. Returns one result per host.
+async def run_load(hosts, port=80, path="/", duration=LOAD_DURATION, concurrency=LOAD_CONCURRENCY, rate=None,
+                   timeout=REQUEST_TIMEOUT):
+    return list(await asyncio.gather(*[load_host(host, port, path, duration, concurrency, rate, timeout)
+                                       for host in hosts]))
+
+
+# Time range of a load test as seen by Apache, which logs whole seconds
+def log_window(result):
+    return math.floor(result['started']), math.ceil(result['finished'])
+
+
+# Compare what the load test sent with what the access log of the web server shows for the same time range.
+# Requests of other clients in that time range are counted by the log too.
+def cross_check(result, summary):
+    logged = Counter({int(status): count for status, count in summary['status'].items()})
+    answered = Counter({status: count for status, count in result['statuses'].items()})
+    return {'host': result['host'], 'sent': result['requests'], 'answered': sum(answered.values()),
+            'logged': summary['requests'], 'not_logged': sum((answered - logged).values()),
+            'statuses_match': not (answered - logged)}
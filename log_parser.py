@@ -0,0 +1,161 @@
+import re
+import numpy as np
+
+# Common log format ("%h %l %u %t \"%r\" %>s %b") with the optional referer and user agent of the combined format.
+# The query string is left out of the path. Apache escapes a quote inside a quoted field as \", requests with
+# one are kept with the escapes as logged. Only ASCII digits and the 12 month names are matched, every timestamp
+# which matches can be decoded by decode_timestamps.
+LOG_LINE = re.compile(
+    r'^(\S+) \S+ \S+ \[(\d{2}/(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)/\d{4}'
+    r':\d{2}:\d{2}:\d{2} [+-]\d{4})\] '
+    r'"(?:(\S+) ((?:[^\s?"\\]|\\.)*)(?:\?(?:[^\s"\\]|\\.)*)?(?: (?:[^"\\]|\\.)*)?|(?:[^"\\]|\\.)*)" (\d{3}) (\d+|-)'
+    r'(?: "(?:[^"\\]|\\.)*" "(?:[^"\\]|\\.)*")?\s*$',
+    re.MULTILINE | re.ASCII)
+
+MONTHS = [b'Jan', b'Feb', b'Mar', b'Apr', b'May', b'Jun', b'Jul', b'Aug', b'Sep', b'Oct', b'Nov', b'Dec']
+# Each month name packed into one integer, sorted for np.searchsorted
+MONTH_KEYS = np.array([m[0] << 16 | m[1] << 8 | m[2] for m in MONTHS])
+MONTH_ORDER = np.argsort(MONTH_KEYS)
+MONTH_NUMBERS = np.arange(1, 13)[MONTH_ORDER]
+MONTH_KEYS = MONTH_KEYS[MONTH_ORDER]
+
+FIELDS = ['remote_host', 'time', 'method', 'path', 'status', 'bytes']
+
+
+# Decode timestamps such as "10/Oct/2019:13:55:36 +0000" into epoch seconds, all at once
+def decode_timestamps(timestamps):
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64)
+    raw = np.array(timestamps, dtype='S26').view(np.uint8).reshape(-1, 26).astype(np.int64)
+    digits = raw - ord('0')
+
+    def number(start, end):
+        value = np.zeros(len(raw), dtype=np.int64)
+        for column in range(start, end):
+            value = value * 10 + digits[:, column]
+        return value
+
+    day, year = number(0, 2), number(7, 11)
+    hour, minute, second = number(12, 14), number(15, 17), number(18, 20)
+    month = MONTH_NUMBERS[np.searchsorted(MONTH_KEYS, raw[:, 3] << 16 | raw[:, 4] << 8 | raw[:, 5])]
+    sign = np.where(raw[:, 21] == ord('-'), -1, 1)
+    utc_offset = sign * (number(22, 24) * 3600 + number(24, 26) * 60)
+
+    # Days since 1970-01-01 of a proleptic Gregorian date
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+
+    return days * 86400 + hour * 3600 + minute * 60 + second - utc_offset
+
+
+# Parse a batch of log lines into a dictionary of NumPy arrays (one array per field).
+# Lines which are not in the common or combined log format are skipped.
+def parse_lines(lines):
+    rows = LOG_LINE.findall("".join(line if line.endswith("\n") else line + "\n" for line in lines))
+    if not rows:
+        return empty_batch()
+    remote_host, timestamp, method, path, status, response_bytes = zip(*rows)
+    return {
+        'remote_host': np.array(remote_host),
+        'time': decode_timestamps(timestamp),
+        'method': np.array(method),
+        'path': np.array(path),
+        'status': np.array(status).astype(np.int16),
+        'bytes': np.char.replace(np.array(response_bytes), '-', '0').astype(np.int64),
+    }
+
+
+def empty_batch():
+    return {
+        'remote_host': np.zeros(0, dtype='U1'),
+        'time': np.zeros(0, dtype=np.int64),
+        'method': np.zeros(0, dtype='U1'),
+        'path': np.zeros(0, dtype='U1'),
+        'status': np.zeros(0, dtype=np.int16),
+        'bytes': np.zeros(0, dtype=np.int64),
+    }
+
+
+# Split a stream of lines into parsed batches
+def parse_stream(lines, batch_size=10000):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield parse_lines(batch)
+            batch = []
+    if batch:
+        yield parse_lines(batch)
+
+
+# Same as parse_stream, for lines yielded by an async generator
+async def parse_async_stream(lines, batch_size=10000):
+    batch = []
+    async for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield parse_lines(batch)
+            batch = []
+    if batch:
+        yield parse_lines(batch)
+
+
+def concat_batches(batches):
+    batches = list(batches)
+    if not batches:
+        return empty_batch()
+    return {field: np.concatenate([batch[field] for batch in batches]) for field in FIELDS}
+
+
+# Build a batch from (remote_host, time, method, path, status, bytes) records, e.g. rows of the log store
+def batch_from_records(records):
+    if not records:
+        return empty_batch()
+    columns = list(zip(*records))
+    batch = {field: np.array(column) for field, column in zip(FIELDS, columns)}
+    batch['time'] = batch['time'].astype(np.int64)
+    batch['status'] = batch['status'].astype(np.int16)
+    batch['bytes'] = batch['bytes'].astype(np.int64)
+    return batch
+
+
+# Convert a batch back into (remote_host, time, method, path, status, bytes) records
+def records_from_batch(batch):
+    return zip(batch['remote_host'].tolist(), batch['time'].tolist(), batch['method'].tolist(),
+               batch['path'].tolist(), batch['status'].tolist(), batch['bytes'].tolist())
+
+
+def filter_batch(batch, mask):
+    return {field: batch[field][mask] for field in FIELDS}
+
+
+# Number of requests per status code
+def status_histogram(batch):
+    codes, counts = np.unique(batch['status'], return_counts=True)
+    return dict(zip(codes.tolist(), counts.tolist()))
+
+
+# Most frequent values of a field, e.g. top_n(batch, 'remote_host') for the top client IPs
+def top_n(batch, field, n=10):
+    values, counts = np.unique(batch[field], return_counts=True)
+    # Stable sort keeps ties in alphabetical order
+    order = np.argsort(-counts, kind='stable')[:n]
+    return list(zip(values[order].tolist(), counts[order].tolist()))
+
+
+# Requests per second (or any other bucket size) from the first to the last request.
+# Returns the start time of each bucket and the number of requests in it.
+def requests_per_second(batch, bucket_seconds=1):
+    if len(batch['time']) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    start = batch['time'].min()
+    counts = np.bincount((batch['time'] - start) // bucket_seconds)
+    return start + np.arange(len(counts)) * bucket_seconds, counts
+
+
+def bytes_served(batch):
+    return int(batch['bytes'].sum())
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import time
+
+# Parsed access log records of every instance
+STORE_FILE = os.path.expanduser("~/.aws/access_logs.db")
+# Records older than this are deleted
+RETENTION_DAYS = 30
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS requests (
+    instance TEXT NOT NULL,
+    remote_host TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    method TEXT,
+    path TEXT,
+    status INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS requests_time ON requests (instance, time);
+CREATE INDEX IF NOT EXISTS requests_host_time ON requests (instance, remote_host, time);
+-- Inode and byte offset the access log of each instance has been stored up to
+CREATE TABLE IF NOT EXISTS log_positions (
+    instance TEXT PRIMARY KEY,
+    inode TEXT NOT NULL,
+    byte_offset INTEGER NOT NULL
+);
+'''
+
+
+def open_store(path=STORE_FILE):
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Several threads can write at once, wait for the lock instead of failing.
+    # Coroutines hand their connection to worker threads (asyncio.to_thread), one thread at a time.
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# Records are (remote_host, time, method, path, status, bytes) tuples. position ({'inode', 'offset'}) is where
+# the log has been read up to, it is saved in the same transaction: a fetch which is interrupted never leaves
+# records behind which the next fetch would store again.
+def append_records(conn, instance, records, position=None):
+    with conn:
+        conn.executemany("INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         ((instance,) + tuple(record) for record in records))
+        if position:
+            conn.execute("INSERT OR REPLACE INTO log_positions VALUES (?, ?, ?)",
+                         (instance, position['inode'], position['offset']))
+
+
+# Where the next incremental fetch of an instance starts, None if its log was never stored
+def load_position(conn, instance):
+    row = conn.execute("SELECT inode, byte_offset FROM log_positions WHERE instance = ?", (instance,)).fetchone()
+    return {'inode': row[0], 'offset': row[1]} if row else None
+
+
+# Forget every record of an instance, used when its whole log is fetched again
+def clear_instance(conn, instance):
+    with conn:
+        conn.execute("DELETE FROM requests WHERE instance = ?", (instance,))
+        conn.execute("DELETE FROM log_positions WHERE instance = ?", (instance,))
+
+
+# Delete records older than the retention period to bound disk use
+def apply_retention(conn, retention_days=RETENTION_DAYS, now=None):
+    cutoff = int((now or time.time()) - retention_days * 24 * 60 * 60)
+    with conn:
+        deleted = conn.execute("DELETE FROM requests WHERE time < ?", (cutoff,)).rowcount
+    return deleted
+
+
+# Query records of an instance by time range, status range and client IP.
+# Every argument left as None is not filtered on.
+def query_records(conn, instance, since=None, until=None, min_status=None, max_status=None, remote_host=None):
+    sql = "SELECT remote_host, time, method, path, status, bytes FROM requests WHERE instance = ?"
+    params = [instance]
+    if remote_host is not None:
+        sql += " AND remote_host = ?"
+        params.append(remote_host)
+    if since is not None:
+        sql += " AND time >= ?"
+        params.append(int(since))
+    if until is not None:
+        sql += " AND time < ?"
+        params.append(int(until))
+    if min_status is not None:
+        sql += " AND status >= ?"
+        params.append(min_status)
+    if max_status is not None:
+        sql += " AND status <= ?"
+        params.append(max_status)
+    return conn.execute(sql + " ORDER BY time", params).fetchall()
+
+
+# Server errors (5xx) in the last number of minutes
+def recent_errors(conn, instance, minutes=15, now=None):
+    return query_records(conn, instance, since=(now or time.time()) - minutes * 60, min_status=500, max_status=599)
+
+
+# Requests from one client IP since midnight (local time)
+def requests_from_today(conn, instance, remote_host, now=None):
+    midnight = time.mktime(time.localtime(now or time.time())[:3] + (0, 0, 0, 0, 0, -1))
+    return query_records(conn, instance, since=midnight, remote_host=remote_host)
+
+
+# Number of requests an instance got in a time range, counted on the time index
+def count_requests(conn, instance, since, until=None):
+    sql = "SELECT COUNT(*) FROM requests WHERE instance = ? AND time >= ?"
+    params = [instance, int(since)]
+    if until is not None:
+        sql += " AND time < ?"
+        params.append(int(until))
+    return conn.execute(sql, params).fetchone()[0]
@@ -0,0 +1,130 @@
+import contextvars
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Every finished phase of every operation is appended here as one JSON line
+METRICS_FILE = os.path.expanduser("~/.aws/metrics.jsonl")
+
+COUNTERS = ['retries', 'api_calls', 'api_seconds', 'commands', 'command_seconds']
+
+events = []
+events_lock = threading.Lock()
+current_operation = {'name': None, 'started': time.time(), 'other': None}
+# Every thread and every asyncio task has its own stack of running phases, counters go to the innermost one
+phase_stack = contextvars.ContextVar('phase_stack', default=())
+
+
+def new_event(name, labels):
+    event = {'phase': name, 'seconds': 0.0}
+    event.update({counter: 0 for counter in COUNTERS})
+    event.update(labels)
+    return event
+
+
+# Time a phase of an operation, e.g. with metrics.phase("ssh_test", host=pub_ip):
+@contextmanager
+def phase(name, **labels):
+    event = new_event(name, labels)
+    token = phase_stack.set(phase_stack.get() + (event,))
+    start = time.perf_counter()
+    try:
+        yield event
+    finally:
+        event['seconds'] = time.perf_counter() - start
+        phase_stack.reset(token)
+        with events_lock:
+            events.append(event)
+
+
+# Add to a counter of the current phase. Outside of any phase it goes to the "other" phase of the operation.
+def count(counter, value=1):
+    stack = phase_stack.get()
+    if stack:
+        stack[-1][counter] += value
+    else:
+        with events_lock:
+            if current_operation['other'] is None:
+                current_operation['other'] = new_event('other', {})
+                events.append(current_operation['other'])
+            current_operation['other'][counter] += value
+
+
+# subprocess.getstatusoutput which is counted and timed
+def getstatusoutput(command):
+    start = time.perf_counter()
+    try:
+        return subprocess.getstatusoutput(command)
+    finally:
+        count('commands')
+        count('command_seconds', time.perf_counter() - start)
+
+
+# botocore event handlers, registered on the boto3 session by aws_clients
+def before_api_call(context, **kwargs):
+    context['metrics_start'] = time.perf_counter()
+
+
+def after_api_call(context, **kwargs):
+    count('api_calls')
+    if 'metrics_start' in context:
+        count('api_seconds', time.perf_counter() - context['metrics_start'])
+
+
+def register_api_hooks(events_emitter):
+    events_emitter.register('before-call', before_api_call)
+    events_emitter.register('after-call', after_api_call)
+    events_emitter.register('after-call-error', after_api_call)
+
+
+# Sum the events of every phase name: runs, total and max seconds and every counter
+def summarize(operation_events):
+    summary = {}
+    for event in operation_events:
+        phase_summary = summary.setdefault(event['phase'], dict({'runs': 0, 'seconds': 0.0, 'max_seconds': 0.0},
+                                                                **{counter: 0 for counter in COUNTERS}))
+        phase_summary['runs'] += 1
+        phase_summary['seconds'] += event['seconds']
+        phase_summary['max_seconds'] = max(phase_summary['max_seconds'], event['seconds'])
+        for counter in COUNTERS:
+            phase_summary[counter] += event[counter]
+    return summary
+
+
+def print_summary(name, summary, seconds):
+    print(f"\n\t*****  TIMINGS: {name} ({seconds:.1f}s)  *****")
+    print("\n\tPhase\t\t\tRuns\tTotal\tMax\tRetries\tAPI calls\tCommands")
+    for phase_name, phase_summary in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        print(f"\t{phase_name:<16}\t{phase_summary['runs']}\t{phase_summary['seconds']:.1f}s"
+              f"\t{phase_summary['max_seconds']:.1f}s\t{phase_summary['retries']}"
+              f"\t{phase_summary['api_calls']}\t\t{phase_summary['commands']}")
+
+
+def write_events(name, operation_events, path=None):
+    path = path or METRICS_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        for event in operation_events:
+            f.write(json.dumps(dict(event, operation=name, time=int(current_operation['started']))) + "\n")
+
+
+# Collect the metrics of one operation (e.g. one menu choice), then write them and print a summary
+@contextmanager
+def operation(name, path=None, quiet=False):
+    with events_lock:
+        events.clear()
+        current_operation.update(name=name, started=time.time(), other=None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with events_lock:
+            operation_events = list(events)
+            events.clear()
+        if operation_events:
+            write_events(name, operation_events, path)
+            if not quiet:
+                print_summary(name, summarize(operation_events), time.perf_counter() - start)
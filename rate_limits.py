@@ -0,0 +1,192 @@
+import copy
+import json
+import threading
+import time
+
+# Requests per second and burst size of every service. EC2 throttles API calls per account with token buckets
+# of its own, S3 throttles per prefix, and sshd drops new connections beyond MaxStartups (10 by default).
+# The ssh budget is per host, every sshd has its own MaxStartups.
+BUDGETS = {
+    'ec2': {'rate': 20, 'burst': 100},
+    's3': {'rate': 100, 'burst': 300},
+    'ssh': {'rate': 10, 'burst': 20},
+}
+DEFAULT_BUDGET = {'rate': 10, 'burst': 20}
+# On throttling the rate is halved, down to this share of the budget. Every success gives back 5% of the budget.
+MIN_RATE_SHARE = 0.05
+RATE_INCREASE_SHARE = 0.05
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                  'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException', 'SlowDown',
+                  'ProvisionedThroughputExceededException', 'EC2ThrottledException']
+# Only read-only calls with the same parameters are coalesced
+COALESCE_PREFIXES = ('Describe', 'List')
+# Seconds a coalesced call waits for the call it is sharing before making its own
+COALESCE_TIMEOUT = 120
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'waited_seconds': 0.0, 'throttled': 0, 'coalesced': 0}
+
+    # Take a token and return how long to wait before using it. The wait is not done here,
+    # so the same bucket works for threads (time.sleep) and for coroutines (asyncio.sleep).
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = max(0.0, -self.tokens / self.rate)
+            self.stats['calls'] += 1
+            self.stats['waited_seconds'] += delay
+            return delay
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_SHARE, self.rate / 2)
+            # Stop the burst which caused the throttling
+            self.tokens = min(self.tokens, 0.0)
+            self.stats['throttled'] += 1
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_SHARE)
+
+    def coalesced(self):
+        with self.lock:
+            self.stats['coalesced'] += 1
+
+
+buckets = {}
+buckets_lock = threading.Lock()
+# Read-only calls in flight, (service, endpoint, operation, parameters) -> {'done': Event, 'response': parsed}
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+# One bucket per service, or per service and host when a host is given (e.g. one per sshd)
+def bucket(service, host=None):
+    name = service if host is None else (service, host)
+    with buckets_lock:
+        if name not in buckets:
+            buckets[name] = TokenBucket(**BUDGETS.get(service, DEFAULT_BUDGET))
+        return buckets[name]
+
+
+def reserve(service, host=None):
+    return bucket(service, host).reserve()
+
+
+def acquire(service):
+    delay = reserve(service)
+    if delay:
+        time.sleep(delay)
+
+
+def throttled(service, host=None):
+    bucket(service, host).throttled()
+
+
+def succeeded(service, host=None):
+    bucket(service, host).succeeded()
+
+
+# Current rate and counters of every service used so far. The buckets of the hosts of a service are added up.
+def stats():
+    with buckets_lock:
+        services = dict(buckets)
+    totals = {}
+    for name, service_bucket in services.items():
+        service = name[0] if isinstance(name, tuple) else name
+        values = totals.setdefault(service, {'calls': 0, 'waited_seconds': 0.0, 'throttled': 0, 'coalesced': 0,
+                                             'rate': 0.0, 'max_rate': 0.0})
+        for field, value in service_bucket.stats.items():
+            values[field] += value
+        values['rate'] += service_bucket.rate
+        values['max_rate'] += service_bucket.max_rate
+    return totals
+
+
+def print_stats(service_stats):
+    print("\n\tService\tCalls\tCoalesced\tThrottled\tWaited\tRate (max)")
+    for service, values in sorted(service_stats.items()):
+        print(f"\t{service}\t{values['calls']}\t{values['coalesced']}\t\t{values['throttled']}"
+              f"\t\t{values['waited_seconds']:.1f}s\t{values['rate']:.0f} ({values['max_rate']:.0f})/s")
+
+
+def is_throttle_error(code):
+    return code in THROTTLE_CODES
+
+
+# botocore event handlers, registered on the boto3 session by aws_clients.
+# before-send runs for every HTTP attempt, retries by botocore included.
+def before_send(event_name, **kwargs):
+    acquire(event_name.split('.')[1])
+
+
+def needs_retry(event_name, response=None, **kwargs):
+    if response is None:
+        return None
+    service = event_name.split('.')[1]
+    if is_throttle_error(response[1].get('Error', {}).get('Code')):
+        throttled(service)
+    elif response[0].status_code < 300:
+        succeeded(service)
+    # Leave the retry decision to botocore
+    return None
+
+
+def coalesce_key(client, operation_name, api_params):
+    if not operation_name.startswith(COALESCE_PREFIXES):
+        return None
+    # Clients of other regions or endpoints never share a response
+    return (client.meta.service_model.service_name, client.meta.endpoint_url, operation_name,
+            json.dumps(api_params, sort_keys=True, default=str))
+
+
+# Wrap the API calls of a client: the first of several identical read-only calls is made, the others wait for
+# it and share a copy of its response. The call in flight is forgotten in a finally, so a call which is
+# interrupted (Ctrl+C included) or fails never leaves the others waiting.
+def coalesce_calls(client):
+    make_api_call = client._make_api_call
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def api_call(operation_name, api_params):
+        key = coalesce_key(client, operation_name, api_params)
+        if key is None:
+            return make_api_call(operation_name, api_params)
+        with in_flight_lock:
+            call = in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = in_flight[key] = {'done': threading.Event(), 'response': None}
+
+        if not leader:
+            if call['done'].wait(COALESCE_TIMEOUT) and call['response'] is not None:
+                bucket(service).coalesced()
+                return copy.deepcopy(call['response'])
+            # The shared call failed or is too slow, make this one on its own
+            return make_api_call(operation_name, api_params)
+
+        try:
+            response = make_api_call(operation_name, api_params)
+            call['response'] = copy.deepcopy(response)
+            return response
+        finally:
+            with in_flight_lock:
+                if in_flight.get(key) is call:
+                    del in_flight[key]
+            call['done'].set()
+
+    client._make_api_call = api_call
+    return client
+
+
+def register_hooks(events_emitter):
+    events_emitter.register('before-send', before_send)
+    events_emitter.register('needs-retry', needs_retry)
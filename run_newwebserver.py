@@ -1,64 +1,256 @@
 #!/usr/bin/env python3
+import asyncio
+import heapq
+import json
 import os
+import shlex
+import statistics
 import subprocess
 import sys
+import tempfile
 import time
-import boto3
-import importlib
-from botocore.exceptions import ClientError
-
-ec2_client = boto3.client("ec2")
-ec2 = boto3.resource("ec2")
-s3 = boto3.resource("s3")
-
-
-def create_instance(user_key, security_group, instance_name):
-    instance = ec2.create_instances(
-        ImageId="ami-08935252a36e25f85",
-        InstanceType="t2.micro",
-        KeyName=user_key[0],
-        MinCount=1,
-        MaxCount=1,
-        # Security group is pre-configured to allow public access
-        SecurityGroupIds=[security_group],
-        TagSpecifications=[
-            {
-                'ResourceType': 'instance',
-                'Tags': [
-                    {
-                        'Key': 'Name',
-                        'Value': instance_name
-                    },
-                ]
-            },
-        ],
-        UserData='''#!/bin/bash
+import access_logs
+import async_remote
+import autoscaler
+import aws_clients
+import content_deploy
+import fleet_spec
+import health_checks
+import inventory
+import load_test
+import log_parser
+import log_store
+import metrics
+import rate_limits
+import s3_bulk_delete
+import s3_sync
+import ssh_sessions
+import summarize_logs
+import waiters
+from botocore.exceptions import ClientError, ParamValidationError
+
+
+BASE_IMAGE_ID = "ami-08935252a36e25f85"
+BASE_USER_DATA = '''#!/bin/bash
                     sudo yum -y update
                     sudo yum -y install httpd
                     sudo yum -y install python36
                     sudo chkconfig httpd on
                     sudo /etc/init.d/httpd start'''
-    )
-
-    print(f"\nAn instance with ID {instance[0].id} is being created.")
+# Golden image is built once from the base image with everything above already installed
+GOLDEN_IMAGE_NAME = "webserver-golden-image"
+GOLDEN_USER_DATA = '''#!/bin/bash
+                    sudo /etc/init.d/httpd start'''
+# Boot-to-healthy time of every launch, for both kinds of images
+BOOT_TIMES_FILE = os.path.expanduser("~/.aws/boot_times.jsonl")
+
+# Upper limit of SSH connections opened at the same time while a fleet is bootstrapped
+FLEET_MAX_CONNECTIONS = 50
+
+# Deadline (seconds) for instances to get a public IP address
+PUBLIC_IP_DEADLINE = 300
+
+# Upper limit of instances whose logs are fetched at the same time
+LOG_QUERY_MAX_CONNECTIONS = 10
+
+# Maximum number of instances in one TerminateInstances call
+TERMINATE_BATCH_SIZE = 1000
+
+# Errors of CreateBucket which mean another name should be tried
+BUCKET_NAME_ERRORS = ['BucketAlreadyExists', 'BucketAlreadyOwnedByYou', 'InvalidBucketName']
+
+# Names of the menu options in the metrics
+OPERATION_NAMES = {
+    "1": "create_instance", "2": "create_bucket", "3": "upload_file", "4": "list_buckets", "5": "list_instances",
+    "6": "list_security_groups", "7": "delete_bucket", "8": "terminate_instances", "9": "web_server_status",
+    "10": "query_logs", "11": "query_stored_logs", "12": "build_golden_image", "13": "summarize_logs",
+    "14": "apply_fleet_spec", "15": "load_test", "16": "autoscale",
+}
+
+# Number of log lines parsed and written to the local log store at once
+LOG_BATCH_SIZE = 10000
+
+
+# AWS clients are built on first use and cached, importing this script does not load boto3
+def ec2_client():
+    return aws_clients.client("ec2")
+
+
+def ec2():
+    return aws_clients.resource("ec2")
+
+
+def s3():
+    return aws_clients.resource("s3")
+
+
+def create_instance(user_key, security_group, instance_name, count=1, image_id=None):
+    # A golden image already has Apache, python and check_webserver.py installed
+    user_data = GOLDEN_USER_DATA if image_id else BASE_USER_DATA
+    launch_time = time.time()
+    with metrics.phase("run_instances"):
+        instances = ec2().create_instances(
+            ImageId=image_id or BASE_IMAGE_ID,
+            InstanceType="t2.micro",
+            KeyName=user_key[0],
+            # Launch the whole fleet with a single RunInstances call
+            MinCount=count,
+            MaxCount=count,
+            # Security group is pre-configured to allow public access
+            SecurityGroupIds=[security_group],
+            TagSpecifications=[
+                {
+                    'ResourceType': 'instance',
+                    'Tags': [
+                        {
+                            'Key': 'Name',
+                            'Value': instance_name
+                        },
+                    ]
+                },
+            ],
+            UserData=user_data
+        )
+    inventory.invalidate('instances')
+
+    for instance in instances:
+        print(f"\nAn instance with ID {instance.id} is being created.")
     print("\nPlease wait while the public IP address of your instance is being fetched...")
 
-    # A loop that will go on until it gets the public IP address of the instance
-    while not instance[0].public_ip_address:
-        try:
-            instance[0].reload()
-            if instance[0].public_ip_address:
-                # Public IP address is available
-                public_ip = instance[0].public_ip_address
-                print(f"\nPublic IP address of instance {instance_name} ({instance[0].id}): {public_ip}")
+    # Poll all instances with one DescribeInstances call per round until they get a public IP address
+    with metrics.phase("wait_public_ip"):
+        public_ips = waiters.wait_for_public_ips(ec2_client(), [instance.id for instance in instances],
+                                                 deadline=PUBLIC_IP_DEADLINE)
+    # The listed instances had no IP address yet
+    inventory.invalidate('instances')
+    for instance in instances:
+        if instance.id in public_ips:
+            print(f"\nPublic IP address of instance {instance_name} ({instance.id}): {public_ips[instance.id]}")
+        else:
+            print(f"\nInstance {instance_name} ({instance.id}) did not get a public IP address in time.")
+
+    # Run the bootstrap of every instance at the same time, with a cap on the number of SSH connections
+    bootstrap = async_remote.run_on_hosts(
+        lambda instance, limit: async_remote.bootstrap_instance(user_key[1], instance.id,
+                                                                public_ips.get(instance.id), limit),
+        instances, max_connections=FLEET_MAX_CONNECTIONS)
+    results = list(async_remote.run(bootstrap).values())
+
+    # Time from the RunInstances call until the web server answered, for every healthy instance
+    for result in results:
+        result['boot_seconds'] = result.pop('ready_time') - launch_time if result['web_server'] else None
+        if result['boot_seconds'] is not None:
+            record_boot_time('golden' if image_id else 'base', result['boot_seconds'])
+
+    if len(results) > 1:
+        print_fleet_summary(results)
+    print_boot_times()
+    return results
+
+
+def print_fleet_summary(results):
+    print("\n\t*****  FLEET SUMMARY  *****")
+    print('\n#', '\tInstance ID', '\t\tIP Address', '\tSSH', '\tWeb server', '\tBoot to healthy')
+    for i, result in enumerate(results, start=1):
+        print(i, '\t' + result['id'], '\t' + result['ip'],
+              '\t' + ('ok' if result['ssh'] else 'failed'),
+              '\t' + ('ok' if result['web_server'] else 'failed'),
+              '\t' + (f"{result['boot_seconds']:.0f}s" if result['boot_seconds'] is not None else '-'))
+
+    ready_count = sum(1 for result in results if result['web_server'])
+    print(f"\n{ready_count} of {len(results)} instances are ready.")
+
+
+def record_boot_time(mode, seconds, path=None):
+    path = path or BOOT_TIMES_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps({'mode': mode, 'seconds': seconds, 'time': int(time.time())}) + "\n")
+
+
+def load_boot_times(path=None):
+    boot_times = {}
+    try:
+        with open(path or BOOT_TIMES_FILE) as f:
+            for line in f:
+                entry = json.loads(line)
+                boot_times.setdefault(entry['mode'], []).append(entry['seconds'])
+    except (OSError, ValueError):
+        pass
+    return boot_times
+
+
+# Compare boot-to-healthy time of instances launched from the base AMI and from the golden image
+def print_boot_times(path=None):
+    boot_times = load_boot_times(path)
+    if boot_times:
+        print("\n\tImage\tLaunches\tMedian boot to healthy")
+        for mode, seconds in sorted(boot_times.items()):
+            print(f"\t{mode}\t{len(seconds)}\t\t{statistics.median(seconds):.0f}s")
+
+
+# Launch an instance from the base AMI, wait until it is fully installed and save it as the golden image
+def build_golden_image(user_key, security_group):
+    print("\nLaunching an instance to build the golden image from...")
+    result = create_instance(user_key, security_group, f"{GOLDEN_IMAGE_NAME}-builder")[0]
+    try:
+        if not result['web_server']:
+            print("\nThe builder instance did not get ready, golden image was not created.")
+            return None
+        # Start new instances with an empty access log and no package cache. /var/log/httpd is only readable
+        # by root, so the glob is expanded by a root shell.
+        (status, output) = metrics.getstatusoutput(ssh_sessions.ssh_command(
+            user_key[1], result['ip'], shlex.quote("sudo sh -c 'yum clean all && truncate -s 0 /var/log/httpd/*'")))
+        if status != 0:
+            print(f"\nFailed to clean up the builder instance, golden image was not created.\n{output}")
+            return None
+
+        image_id = ec2_client().create_image(
+            InstanceId=result['id'],
+            Name=f"{GOLDEN_IMAGE_NAME}-{int(time.time())}",
+            Description="Amazon Linux with Apache, python36, check_webserver.py and summarize_logs.py",
+            TagSpecifications=[{'ResourceType': 'image', 'Tags': [{'Key': 'Name', 'Value': GOLDEN_IMAGE_NAME}]}]
+        )['ImageId']
+        print(f"\nCreating golden image {image_id}. Please wait, it might take a few minutes...")
+        ec2_client().get_waiter('image_available').wait(ImageIds=[image_id])
+        print(f"\nGolden image {image_id} is available.")
+        return image_id
+    finally:
+        ec2_client().terminate_instances(InstanceIds=[result['id']])
+        inventory.invalidate('instances')
+        print(f"\nTerminated builder instance: {result['id']}")
+
+
+# Newest available golden image, or None if none was built yet
+def find_golden_image():
+    response = ec2_client().describe_images(Owners=['self'], Filters=[
+        {'Name': 'tag:Name', 'Values': [GOLDEN_IMAGE_NAME]},
+        {'Name': 'state', 'Values': ['available']},
+    ])
+    images = sorted(response['Images'], key=lambda image: image['CreationDate'])
+    return images[-1]['ImageId'] if images else None
+
+
+# Ask the user whether to launch from the golden image, if there is one
+def select_image():
+    image_id = find_golden_image()
+    if image_id:
+        choice = get_input(f"\nLaunch from golden image {image_id}? (y/n)   ").lower()
+        if choice in ['yes', 'y']:
+            return image_id
+    return None
 
-                # Test ssh by running 'sudo ls -a' on the instance
-                ssh_test(user_key[1], public_ip)
 
-                # Copy check_webserver.py onto the instance
-                copy_file_to_instance(user_key[1], public_ip)
-        except Exception as e:
-            print("\n", e, "\n")
+def get_instance_count():
+    while True:
+        count = get_input("\nHow many instances would you like to launch? (default 1)\n") or "1"
+        try:
+            if int(count) < 1:
+                print("\nEnter a number greater than 0, please.")
+            else:
+                return int(count)
+        except ValueError:
+            print("\nYou have to enter an integer!")
 
 
 def menu():
@@ -68,14 +260,20 @@ def menu():
         |                                                                                |
         |   1.  Create an instance                                                       |
         |   2.  Create bucket (Optional: upload image + append to Apache's index.html)   |
-        |   3.  Upload file to a bucket                                                  |
+        |   3.  Upload file or sync directory to a bucket                                |
         |   4.  List buckets                                                             | 
         |   5.  List running instances                                                   |
         |   6.  List security groups                                                     |
         |   7.  Delete bucket                                                            |
         |   8.  Terminate instances                                                      |
-        |   9.  Web server status                                                        |
-        |   10. Query server access_log (display GET Requests)                           |
+        |   9.  Web server status (one or all instances)                                 |
+        |   10. Query server access_log (display GET Requests, one or all instances)     |
+        |   11. Query stored access_log (5xx errors / requests from an IP)               |
+        |   12. Build golden image (pre-installed Apache for faster launches)            |
+        |   13. Summarize access_log on the instances (status, top clients, req/min)     |
+        |   14. Plan and apply a fleet spec (security groups, instances, buckets)        |
+        |   15. Load test web servers (throughput, errors, p50/p95/p99 latency)          |
+        |   16. Autoscale instances by name from their access_log request rates          |
         |                                                                                |
         |   0. Exit                                                                      |
         + — — — — — — — — — — — — — — — — — — — — — — — — — — —— — — — — — — — — — — — — +''')
@@ -101,41 +299,36 @@ def import_key_pair(key_path):
 # Get security group by name or id
 def get_security_group():
     group_name = get_input("\nEnter security group name, please.\n")
-    if group_name.startswith('sg-') and len(group_name) == 20:
-        try:
-            response = ec2_client.describe_security_groups(GroupIds=[group_name])
-            print(
-                f"\nSecurity group found by ID. Selected security group: {response['SecurityGroups'][0]['GroupName']}.")
-            return response['SecurityGroups'][0]['GroupId']
-        except ClientError as e:
-            print("\n", e)
-            return create_security_group(group_name)
-    else:
-        try:
-            response = ec2_client.describe_security_groups(GroupNames=[group_name])
-            print(f"\nSecurity group found by name. Selected security group: {group_name}.")
-            return response['SecurityGroups'][0]['GroupId']
-        except ClientError as e:
-            print("\n", e)
-            return create_security_group(group_name)
+    try:
+        # Groups are looked up by ID or by name in the inventory, no describe call per lookup
+        group = inventory.find_security_group(group_name)
+    except ClientError as e:
+        # Only a missing group is created, not one which could not be read (e.g. no permission)
+        print("\n", e)
+        return None
+    if group:
+        found_by = "ID" if group['id'] == group_name else "name"
+        print(f"\nSecurity group found by {found_by}. Selected security group: {group['name']}.")
+        return group['id']
+    print(f"\nSecurity group {group_name} not found.")
+    return create_security_group(group_name)
 
 
 def list_security_groups():
     # Empty dictionary to store security group IDs
     sec_groups_dict = {}
-    response = ec2_client.describe_security_groups()
     # Start the for loop from 1
     i = 1
     # Print header
     print('\n#', '\tSecurityGroup ID', '\t\tSecurityGroup Name')
-    # Iterate through all security groups
-    for group in response['SecurityGroups']:
+    # Iterate through all security groups, every page of them is in the inventory
+    for group in inventory.security_groups():
         # Map i as key to security group ID value
-        sec_groups_dict[str(i)] = group['GroupId']
-        if len(group['GroupId']) > 11:
-            print(i, '\t' + group['GroupId'], '\t\t' + group['GroupName'])
+        sec_groups_dict[str(i)] = group['id']
+        if len(group['id']) > 11:
+            print(i, '\t' + group['id'], '\t\t' + group['name'])
         else:
-            print(i, '\t' + group['GroupId'], '\t\t\t' + group['GroupName'])
+            print(i, '\t' + group['id'], '\t\t\t' + group['name'])
         i += 1
 
     # No security groups found
@@ -166,71 +359,34 @@ def select_security_group(sec_groups_dict):
 
 def create_security_group(group_name):
     try:
-        sec_group = ec2.create_security_group(GroupName=group_name, Description=group_name)
-        sec_group.authorize_ingress(IpProtocol="tcp", CidrIp="0.0.0.0/0", FromPort=80, ToPort=80)
-        sec_group.authorize_ingress(IpProtocol="tcp", CidrIp="0.0.0.0/0", FromPort=22, ToPort=22)
-        print(f'\nCreated security group {group_name} (id:{sec_group.id}) with ports 80 & 22 open.')
-        return sec_group.id
+        group_id = add_security_group(group_name, [80, 22])
+        print(f'\nCreated security group {group_name} (id:{group_id}) with ports 80 & 22 open.')
+        return group_id
     except ClientError as e:
         print(e)
 
 
+# Create a security group with the TCP ports open to the world and return its ID, errors are raised
+def add_security_group(group_name, ports):
+    group_id = ec2_client().create_security_group(GroupName=group_name, Description=group_name)['GroupId']
+    inventory.invalidate('security_groups')
+    authorize_ports(group_id, ports)
+    return group_id
+
+
+# Open TCP ports of a security group to the world, with one API call for all of them
+def authorize_ports(group_id, ports):
+    ec2_client().authorize_security_group_ingress(GroupId=group_id, IpPermissions=[
+        {'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port, 'IpRanges': [{'CidrIp': "0.0.0.0/0"}]}
+        for port in ports])
+
+
 def ssh_test(key_path, pub_ip):
-    timer = 1
-    # Keep on looping
-    while True:
-        # Test command sent to the instance using ssh
-        (status, output) = subprocess.getstatusoutput("ssh -t -o StrictHostKeyChecking=no -i " + key_path +
-                                                      " ec2-user@" + pub_ip + " sudo ls -a")
-        print(f"\nSSH test attempt #{timer}")
-
-        # SSH command was successful
-        if status == 0:
-            print("\nThe instance is ready to SSH.")
-            break
-        elif timer == 10:
-            print(f"\nSSH test is taking too long to complete.{output}")
-            break
-        else:
-            timer += 1
-            time.sleep(10)
+    return async_remote.run(async_remote.ssh_test(key_path, pub_ip))
 
 
 def copy_file_to_instance(key_path, pub_ip):
-    (status, output) = subprocess.getstatusoutput(
-        "scp -i " + key_path + " check_webserver.py ec2-user@" + pub_ip + ":.")
-    print("\nAttempting to copy check_webserver.py onto the instance.")
-    if status == 0:
-        print("\nCopied check_webserver.py onto the instance.")
-
-        # Make script executable
-        (status, output) = subprocess.getstatusoutput("ssh -t -o StrictHostKeyChecking=no -i " + key_path +
-                                                      " ec2-user@" + pub_ip + " chmod 700 ./check_webserver.py")
-        print("\nAttempting to run check_webserver.py on the instance. Please wait, it might take up to a minute...")
-
-        if status == 0:
-            (status, output) = subprocess.getstatusoutput("ssh -t -o StrictHostKeyChecking=no -i " + key_path +
-                                                          " ec2-user@" + pub_ip + " ./check_webserver.py")
-            countdown = 9
-
-            # Loop until the script is finished being copied onto the instance
-            while not status == 0:
-                (status, output) = subprocess.getstatusoutput("ssh -t -o StrictHostKeyChecking=no -i " + key_path +
-                                                              " ec2-user@" + pub_ip + " ./check_webserver.py")
-                time.sleep(10)
-                countdown -= 1
-
-                # Command was successful
-                if status == 0:
-                    print(f"\nSuccessfully ran check_webserver.py on the instance.\n\nStatus: {output}\n")
-                    break
-                elif countdown == 0:
-                    print(f"\nTook to long to run check_webserver.py on the instance.\n{output}\n")
-                    break
-        else:
-            print(f"\nFailed to change permissions.\n{output}")
-    else:
-        print(f"\nCopying check_webserver.py failed.\n{output}")
+    return async_remote.run(async_remote.copy_file_to_instance(key_path, pub_ip))
 
 
 def create_bucket(key_path):
@@ -242,9 +398,10 @@ def create_bucket(key_path):
         else:
             bucket_name = (get_input("\nChoose bucket name, please. (tip: lowercase, do not use underscores)\n")).lower()
             try:
-                response = s3.create_bucket(
+                response = s3().create_bucket(
                     Bucket=bucket_name,
                     CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+                inventory.invalidate('buckets')
 
                 print(f"\nCreated bucket with name {response.name}.")
 
@@ -263,13 +420,19 @@ def create_bucket(key_path):
                             print("\nEnter 'y' or 'n', please.")
                     except Exception as error:
                         print(error)
-            except Exception as error:
+            except ClientError as error:
+                print("\n", error, "\n")
+                # Ask for another name only if the name was the problem, throttling was already retried
+                if error.response['Error']['Code'] not in BUCKET_NAME_ERRORS:
+                    break
+            except ParamValidationError as error:
+                # The name was rejected before it was sent, e.g. it has underscores
                 print("\n", error, "\n")
 
 
 def upload_file(bucket_name, key_path, file_path='./photo.jpeg', key_name='photo.jpeg'):
     try:
-        s3.Bucket(bucket_name).upload_file(
+        s3().Bucket(bucket_name).upload_file(
             file_path,  # Path to file
             key_name,  # Key name
             ExtraArgs={'ACL': 'public-read'})  # Make it public readable
@@ -286,11 +449,11 @@ def upload_file(bucket_name, key_path, file_path='./photo.jpeg', key_name='photo
                 if not instance_ips:
                     break
                 else:
-                    # Ask user to select instance
-                    public_ip = select_instance(instance_ips)
-                    if public_ip:
+                    # Ask user to select instances
+                    ip_addresses = select_instances(instance_ips)
+                    if ip_addresses:
                         try:
-                            create_index_page(public_ip,
+                            create_index_page(ip_addresses,
                                               key_path,
                                               f"http://s3-eu-west-1.amazonaws.com/{bucket_name}/{key_name}")
                             break
@@ -307,26 +470,48 @@ def upload_file(bucket_name, key_path, file_path='./photo.jpeg', key_name='photo
         print(f"\n{error}\n")
 
 
-def list_instances():
+def sync_directory(bucket_name, directory, prefix=""):
+    print(f"\nSyncing {directory} to bucket {bucket_name}...")
+
+    def print_file(key, uploaded, error):
+        if error:
+            print(f"\nFailed to upload '{key}'.\n{error}")
+        elif uploaded:
+            print(f"Uploaded '{key}'.")
+
+    stats = s3_sync.sync_directory(s3().meta.client, bucket_name, directory, prefix,
+                                   extra_args={'ACL': 'public-read'}, on_file=print_file)
+    print(f"\nUploaded {stats['uploaded']} files ({stats['bytes']} bytes), "
+          f"skipped {stats['skipped']} unchanged files, {len(stats['errors'])} errors.\n"
+          f"URL: http://s3-eu-west-1.amazonaws.com/{bucket_name}/{prefix}")
+    return stats
+
+
+# Build describe filters for instance states and optional name tag / other tags
+def instance_filters(states, name=None, tags=None):
+    filters = [{'Name': 'instance-state-name', 'Values': states}]
+    if name:
+        # Wildcards such as 'web-*' are supported by EC2
+        filters.append({'Name': 'tag:Name', 'Values': [name]})
+    for key, value in (tags or {}).items():
+        filters.append({'Name': f'tag:{key}', 'Values': [value]})
+    return filters
+
+
+def list_instances(name=None, tags=None):
     # Empty dictionary to store IPs for instances
     instance_ips = {}
     # Start the for loop from 1
     i = 1
-    # Iterate through all instances
-    for instance in ec2.instances.all():
-        # Actions to take when first running instance found
-        if instance.state['Name'] == 'running' and i == 1:
-            # Print header
+    # Only running instances, read from the inventory which is shared by every menu option
+    for instance in inventory.instances(['running'], name, tags):
+        # Print header when first running instance found
+        if i == 1:
             print('\n#', '\tInstance ID', '\t\tIP Address')
-            # Map i as key to instance IP address value
-            instance_ips[str(i)] = instance.public_ip_address
-            print(i, '\t' + instance.id, '\t' + instance.public_ip_address)
-            i += 1
-        elif instance.state['Name'] == 'running':
-            # Map i as key to instance IP address value
-            instance_ips[str(i)] = instance.public_ip_address
-            print(i, '\t' + instance.id, '\t' + instance.public_ip_address)
-            i += 1
+        # Map i as key to instance IP address value
+        instance_ips[str(i)] = instance['public_ip']
+        print(i, '\t' + instance['id'], '\t' + str(instance['public_ip']))
+        i += 1
 
     # No instances are running
     if len(instance_ips) == 0:
@@ -346,6 +531,20 @@ def select_instance(instance_ips):
             print(f"\nNot a valid option. Pick a valid number.\n{error}")
 
 
+# Same as select_instance, but 'all' selects every instance
+def select_instances(instance_ips):
+    while True:
+        choice = get_input("\nEnter instance number or enter 'all' to select every instance: ").lower()
+        if choice == "all":
+            print(f"\nYou selected {len(instance_ips)} instances.")
+            return list(instance_ips.values())
+        elif choice in instance_ips:
+            print(f"\nYou selected instance with IP {instance_ips[choice]}")
+            return [instance_ips[choice]]
+        else:
+            print("\nNot a valid option. Pick a valid number.")
+
+
 def list_buckets():
     # Empty dictionary to store bucket names
     buckets_dict = {}
@@ -356,18 +555,18 @@ def list_buckets():
     i = 1
 
     # Iterate through all buckets
-    for bucket in s3.buckets.all():
-        if i == 1 and bucket.name not in avoid_list:
+    for bucket in inventory.buckets():
+        if i == 1 and bucket['name'] not in avoid_list:
             # Print header
             print('\n#', '\tBucket name')
             # Map i as key to bucket name value
-            buckets_dict[str(i)] = bucket.name
-            print(i, '\t' + bucket.name)
+            buckets_dict[str(i)] = bucket['name']
+            print(i, '\t' + bucket['name'])
             i += 1
-        elif bucket.name not in avoid_list:
+        elif bucket['name'] not in avoid_list:
             # Map i as key to bucket name value
-            buckets_dict[str(i)] = bucket.name
-            print(i, '\t' + bucket.name)
+            buckets_dict[str(i)] = bucket['name']
+            print(i, '\t' + bucket['name'])
             i += 1
 
     # No buckets found
@@ -392,143 +591,561 @@ def select_bucket(buckets_dict):
 def delete_bucket():
     buckets_dict = list_buckets()
     if buckets_dict:
-        bucket = s3.Bucket(select_bucket(buckets_dict))
-        for key in bucket.objects.all():
-            key.delete()
+        bucket = s3().Bucket(select_bucket(buckets_dict))
+        # Delete objects, versions and delete markers in batches of 1000, several batches at a time
+        stats = s3_bulk_delete.empty_bucket(s3().meta.client, bucket.name, on_progress=print_delete_progress)
+        print(f"\nDeleted {stats['deleted']} objects in {stats['seconds']:.1f}s "
+              f"({stats['deleted'] / max(stats['seconds'], 0.001):.0f} objects/s).")
+        if stats['aborted_uploads']:
+            print(f"\nAborted {stats['aborted_uploads']} incomplete multipart uploads.")
+        if stats['errors']:
+            for error in stats['errors'][:10]:
+                print(f"\n{error['Key']}: {error['Message']}")
+            print(f"\nFailed to delete {len(stats['errors'])} objects, bucket {bucket.name} was not deleted.\n")
+            return
         bucket.delete()
+        inventory.invalidate('buckets')
         print(f"\nSuccessfully deleted bucket: {bucket.name}\n")
 
 
-def terminate_instances():
-    terminated_count = 0
-    for instance in ec2.instances.all():
-        if not instance.state['Name'] == 'terminated':
-            instance.terminate()
-            print(f"\nTerminated instance: {instance.id}\n")
-            terminated_count += 1
+def print_delete_progress(deleted, seconds):
+    print(f"\rDeleted {deleted} objects ({deleted / max(seconds, 0.001):.0f} objects/s)...", end="", flush=True)
 
-    if not terminated_count == 0:
-        print(f"\nTerminated instances count: {terminated_count}.\n")
-    else:
-        print("\nNo instances to terminate.")
 
+def terminate_instances(name=None, tags=None):
+    # Find the instances which are not terminated yet, filtered by EC2
+    instance_ids = []
+    paginator = ec2_client().get_paginator('describe_instances')
+    filters = instance_filters(['pending', 'running', 'stopping', 'stopped'], name, tags)
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            instance_ids.extend(instance['InstanceId'] for instance in reservation['Instances'])
 
-def create_index_page(public_ip, key_path, url):
-    image_tag = f'<img src="{url}" alt="{url}">'
-    echo_index = f"sudo echo '{image_tag}' > index.html"
-    permissions = f"ssh -t -o StrictHostKeyChecking=no -i {key_path} ec2-user@{public_ip} sudo chmod o+w /var/www/html"
-    transfer_index = \
-        f'rsync --remove-source-files -az -e "ssh -i {key_path}" index.html ec2-user@{public_ip}:/var/www/html'
-
-    # Append <img> tag to index.html
-    (status, output) = subprocess.getstatusoutput(echo_index)
-    if status == 0:
-        print("\nAppended <img> tag with src = image url from your s3 bucket to index.html")
+    terminate_by_id(instance_ids)
+    if instance_ids:
+        print(f"\nTerminated instances count: {len(instance_ids)}.\n")
     else:
-        print("\n", output, "\n")
+        print("\nNo instances to terminate.")
+    return instance_ids
 
-    # Give write access to /var/www/html folder
-    (status, output) = subprocess.getstatusoutput(permissions)
 
-    # Wait until instance is loaded
-    while not status == 0:
-        (status, output) = subprocess.getstatusoutput(permissions)
+# Terminate in chunks, one API call per chunk instead of one per instance
+def terminate_by_id(instance_ids):
+    for start in range(0, len(instance_ids), TERMINATE_BATCH_SIZE):
+        chunk = instance_ids[start:start + TERMINATE_BATCH_SIZE]
+        ec2_client().terminate_instances(InstanceIds=chunk)
+        inventory.invalidate('instances')
+        for instance_id in chunk:
+            print(f"\nTerminated instance: {instance_id}")
+    return instance_ids
 
-    if status == 0:
-        print("\nChanged the permissions for /var/www/html/")
-    else:
-        print("\n", output, "\n")
 
-    # Transfer index.html
-    (status, output) = subprocess.getstatusoutput(transfer_index)
-    if status == 0:
-        print(f"\nTransferred index.html to EC2 instance ({public_ip}).")
-    else:
-        print("\n", output, "\n")
+# Make the security groups, instances and buckets match a spec file (see fleet_spec.py), after showing the plan.
+# The current state is read with one describe per resource type and the changes are applied in parallel.
+def apply_fleet_spec(user_key, spec_path, confirm=True):
+    try:
+        spec = fleet_spec.load_spec(spec_path)
+    except (OSError, ValueError) as error:
+        print(f"\nCould not read the fleet spec.\n{error}")
+        return None
+
+    with metrics.phase("plan"):
+        state = fleet_spec.describe_state(ec2_client(), aws_clients.client("s3"), spec)
+        changes = fleet_spec.plan(spec, state)
+    if not changes:
+        print("\nNo changes. The fleet matches the spec.")
+        return changes
+    print("\n\t*****  PLAN  *****\n")
+    for change in changes:
+        print(f"\t{fleet_spec.describe_change(change)}")
+    if confirm and get_input("\nApply these changes? (y/n)   ").lower() not in ['yes', 'y']:
+        return None
+
+    def launch(change, group_id):
+        image_id = find_golden_image() if change['image'] == "golden" else change['image']
+        return create_instance(user_key, group_id, change['name'], change['count'], image_id)
+
+    def print_change(change):
+        if 'error' in change:
+            print(f"\nFailed: {fleet_spec.describe_change(change)}\n{change['error']}")
+        else:
+            print(f"\nDone: {fleet_spec.describe_change(change)}")
 
-    # Open Apache Web Server localhost in Firefox to view the image
-    subprocess.Popen(['firefox', '-new-tab', public_ip])
-    print(f"\nOpening Apache Web Server home page ({public_ip}) in Firefox.")
+    try:
+        with metrics.phase("apply"):
+            return fleet_spec.apply(changes, state, aws_clients.client("s3"), add_security_group, authorize_ports,
+                                    launch, terminate_by_id, on_change=print_change)
+    finally:
+        inventory.invalidate()
+
+
+# Keep the number of instances named instance_name in line with their request rates until Ctrl+C is pressed
+# (see autoscaler.py). Every decision is printed and appended to autoscaler.DECISIONS_FILE.
+def autoscale(user_key, security_group, instance_name, policy, image_id=None, rounds=None):
+    def list_fleet():
+        # Instances launched or terminated by someone else are seen in the next round
+        inventory.invalidate('instances')
+        return [instance['id'] for instance in inventory.instances(fleet_spec.LIVE_STATES, instance_name)]
+
+    # Returns the number of instances whose web server answered. The others are terminated, they would
+    # count as capacity in the next rounds without serving anything.
+    def launch(count):
+        results = create_instance(user_key, security_group, instance_name, count, image_id)
+        failed = [result['id'] for result in results if not result['web_server']]
+        if failed:
+            terminate(failed)
+        return len(results) - len(failed)
+
+    def terminate(instance_ids):
+        ec2_client().terminate_instances(InstanceIds=instance_ids)
+        inventory.invalidate('instances')
+
+    print(f"\nAutoscaling instances named {instance_name} to {policy['target_rps']} requests/s each, "
+          f"{policy['min_instances']} to {policy['max_instances']} instances. Press Ctrl+C to stop.")
+    try:
+        return autoscaler.run(policy, list_fleet,
+                              lambda instance_ids: sample_request_rates(user_key[1], instance_ids, policy['window']),
+                              launch, terminate, on_decision=print_decision, rounds=rounds)
+    except KeyboardInterrupt:
+        print("\nStopped autoscaling.")
+        return None
+
+
+# Requests per second of every instance over the last window seconds, from the same data query_logs reads:
+# the new lines of each access log are appended to the log store and the requests of the window are counted
+# there. Instances which have no public IP address yet or whose log could not be read have no rate.
+def sample_request_rates(key_path, instance_ids, window):
+    ip_addresses = {}
+    for instance_id in instance_ids:
+        instance = inventory.instance_by_id(instance_id)
+        if instance and instance['public_ip']:
+            ip_addresses[instance['public_ip']] = instance_id
+    with metrics.phase("sample_logs"):
+        results = async_remote.run(async_remote.run_on_hosts(
+            lambda ip_address, limit: store_logs(key_path, ip_address, True, limit),
+            list(ip_addresses), max_connections=LOG_QUERY_MAX_CONNECTIONS))
+
+    now = time.time()
+    rates = {}
+    conn = log_store.open_store()
+    try:
+        for ip_address, result in results.items():
+            if isinstance(result, Exception):
+                print(f"\nFailed to sample the logs of {ip_address}.{result}")
+                continue
+            rates[ip_addresses[ip_address]] = log_store.count_requests(conn, ip_address, now - window) / window
+    finally:
+        conn.close()
+    return rates
+
+
+def print_decision(decision):
+    if 'instances' not in decision:
+        print(f"\n{format_time(decision['time'])}  {decision['reason']}, trying again in the next round.\n"
+              f"{decision['error']}")
+        return
+    print(f"\n{format_time(decision['time'])}  {decision['instances']} instances, "
+          f"{decision['total_rps']} requests/s ({decision['sampled']} sampled): {decision['reason']}")
+    if decision['action'] == 'launch':
+        print(f"\tLaunched {decision.get('launched', 0)} of {decision['count']} instances.")
+    elif decision['action'] == 'terminate':
+        print(f"\tTerminated {', '.join(decision['instance_ids'])}.")
+    if 'error' in decision:
+        print(f"\tFailed to {decision['action']} instances.\n{decision['error']}")
+
+
+# Deploy an index page showing the image to every selected instance at the same time
+def create_index_page(ip_addresses, key_path, url):
+    content = content_deploy.index_page([url]).encode()
+    print(f"\nDeploying index.html to {len(ip_addresses)} instances...")
+    start = time.perf_counter()
+    results = async_remote.run(content_deploy.deploy(key_path, ip_addresses, content))
+    print_deploy_results(results, time.perf_counter() - start)
+    return results
+
+
+def print_deploy_results(results, seconds):
+    print("\n\tIP Address\t\tResult\t\tAttempts\tSeconds")
+    for result in results:
+        print(f"\t{result['host']}\t\t{result['result']}\t\t{result['attempts']}\t\t{result['seconds']:.1f}")
+        if result['error']:
+            print(f"\t\t{result['error']}")
+    updated = sum(result['result'] == "updated" for result in results)
+    unchanged = sum(result['result'] == "unchanged" for result in results)
+    print(f"\nUpdated {updated}, unchanged {unchanged}, failed {len(results) - updated - unchanged} "
+          f"in {seconds:.1f}s. View the page at http://<IP Address>/")
 
 
 def check_web_server(pub_ip, key_path):
-    # Run check_webserver.py
-    (status, output) = subprocess.getstatusoutput("ssh -t -o StrictHostKeyChecking=no -i " + key_path +
-                                                  " ec2-user@" + pub_ip + " -q ./check_webserver.py")
+    return async_remote.run(async_remote.check_web_server(pub_ip, key_path))
+
+
+# Probe every web server with a plain HTTP request, check_webserver.py is only run on the ones that fail
+def check_fleet_health(ip_addresses, key_path):
+    results = health_checks.probe_all(ip_addresses)
+    total_percentiles = health_checks.latency_percentiles(results)
+
+    print("\n\t*****  WEB SERVER HEALTH  *****")
+    print("\n\tIP Address\t\tStatus\tConnect\tTTFB\tTotal (ms)")
+    for result in sorted(results, key=lambda r: r['total'] if r['total'] is not None else float('inf')):
+        if health_checks.is_healthy(result):
+            # Mark web servers slower than 90% of the fleet
+            slow = " *" if len(results) > 2 and result['total'] > total_percentiles[90] else ""
+            print(f"\t{result['host']}\t\t{result['status']}\t{result['connect'] * 1000:.0f}"
+                  f"\t{result['ttfb'] * 1000:.0f}\t{result['total'] * 1000:.0f}{slow}")
+        else:
+            print(f"\t{result['host']}\t\t{result['status'] or 'failed'}\t-\t-\t-\t{result['error'] or ''}")
 
-    # Command was successful
-    if status == 0:
-        print(f"\nSuccessfully ran check_webserver.py on the instance.\n\nStatus: {output}\n")
-    else:
-        print(output)
+    for field in ['connect', 'ttfb', 'total']:
+        field_percentiles = health_checks.latency_percentiles(results, field)
+        if field_percentiles:
+            print(f"\n\t{field.upper()}\t" + "\t".join(f"p{p}: {value * 1000:.0f}ms"
+                                                      for p, value in field_percentiles.items()))
+
+    unhealthy = [result['host'] for result in results if not health_checks.is_healthy(result)]
+    healthy_count = len(results) - len(unhealthy)
+    print(f"\n{healthy_count} of {len(results)} web servers answered over HTTP.")
+    # Fall back to check_webserver.py over SSH, which also restarts Apache if it is not running
+    if unhealthy:
+        print(f"\nRunning check_webserver.py on {', '.join(unhealthy)}.")
+        async_remote.run(async_remote.run_on_hosts(
+            lambda ip_address, limit: async_remote.check_web_server(ip_address, key_path, limit), unhealthy))
 
 
-# https://github.com/rory/apache-log-parser
 def query_logs(key_path):
 
     instances_dict = list_instances()
     if instances_dict:
-        install_pip3()
-        # Import library for parsing logs
-        apache_log_parser = install_log_parser("apache_log_parser")
-        ip_address = select_instance(instances_dict)
-        # Specify logs format for parser
-        line_parser = apache_log_parser.make_parser("%h %l %u %t \"%r\" %>s %b")
-        # Use grep to filter out only the lines with GET Requests
-        ssh = f"ssh -t -o StrictHostKeyChecking=no -i {key_path} " \
-            f"ec2-user@{ip_address} -q sudo cat /var/log/httpd/access_log | grep GET"
-        cmd = subprocess.Popen(ssh, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
-        i = 0
-        # Read each line from output and parse it with apache_log_parser
-        for line in cmd.stdout.readlines():
-            log_line_data = line_parser(line)
-            if i == 0:
-                print("\n\t*****  ALL GET REQUESTS FROM APACHE WEB SERVER ACCESS LOG  *****")
-                print("\n\tIP Address\t\tTime Received\t\t\tStatus")
-                print(f"\t{log_line_data['remote_host']}\t\t{log_line_data['time_received_isoformat']}\t\t{log_line_data['status']}")
-                i += 1
-            else:
-                print(f"\t{log_line_data['remote_host']}\t\t{log_line_data['time_received_isoformat']}\t\t{log_line_data['status']}")
+        ip_addresses = select_instances(instances_dict)
+        # Fetch only the requests made since the last query, unless the user wants the whole log
+        incremental = get_input("\nShow only requests made since the last query? (y/n)   ").lower() in ['yes', 'y']
+        if not incremental:
+            # Older requests are in the rotated logs
+            hours = get_input("\nHow many hours back? Rotated logs are read too. (blank for the current log)   ")
+            if hours.isdigit():
+                query_log_range(key_path, ip_addresses, time.time() - int(hours) * 3600)
+                return
+        if len(ip_addresses) == 1:
+            query_instance_logs(key_path, ip_addresses[0], incremental)
+        else:
+            query_fleet_logs(key_path, ip_addresses, incremental)
+
+
+def query_instance_logs(key_path, ip_address, incremental):
+    return async_remote.run(print_instance_logs(key_path, ip_address, incremental))
+
+
+async def print_instance_logs(key_path, ip_address, incremental):
+    i = 0
+    stats = {}
+    try:
+        # Parse and print each batch of lines as soon as it arrives
+        async for batch in fetch_and_store_logs(key_path, ip_address, incremental, stats=stats):
+            # Filter out only the lines with GET Requests
+            get_requests = log_parser.filter_batch(batch, batch['method'] == "GET")
+            for remote_host, received, method, path, status, response_bytes in \
+                    log_parser.records_from_batch(get_requests):
+                if i == 0:
+                    print("\n\t*****  ALL GET REQUESTS FROM APACHE WEB SERVER ACCESS LOG  *****")
+                    print("\n\tIP Address\t\tTime Received\t\t\tStatus")
+                print(f"\t{remote_host}\t\t{format_time(received)}\t\t{status}")
                 i += 1
+    except Exception as error:
+        print(error)
 
-        if i == 0:
-            print(f"\nNo GET Requests were made to this instance."
-                  f"\nOpen {ip_address} in your browser and come back to check the results.")
+    if i == 0:
+        print(f"\nNo GET Requests were made to this instance."
+              f"\nOpen {ip_address} in your browser and come back to check the results.")
+    print_transfer_stats(stats)
 
 
-def install_pip3():
-    # Check if pip3 is installed
-    (status, output) = subprocess.getstatusoutput("pip3 --version")
+def print_transfer_stats(stats):
+    if stats.get('decoded'):
+        print(f"\nTransferred {stats['received'] / 1024:.1f} KiB for {stats['decoded'] / 1024:.1f} KiB of logs.")
+
+
+# GET requests of one instance are spooled to a temporary file as "time host status" lines, in log order, so
+# the requests of several instances can be merged lazily. Returns the number of requests written.
+def spool_batch(spool, batch):
+    spool.writelines(f"{received} {remote_host} {status}\n" for remote_host, received, method, path, status,
+                     response_bytes in log_parser.records_from_batch(batch))
+    return len(batch['time'])
+
+
+# Fetch, parse and store the new log lines of one instance and spool its GET requests
+async def spool_get_requests(key_path, ip_address, incremental, spool, limit=None, stats=None):
+    count = 0
+    async for batch in fetch_and_store_logs(key_path, ip_address, incremental, limit, stats):
+        count += spool_batch(spool, log_parser.filter_batch(batch, batch['method'] == "GET"))
+    return count
 
-    if "not found" in output:
-        # Install pip3
-        cmd = subprocess.Popen("sudo apt install python3-pip -qq", shell=True)
-        status = cmd.wait()
-        if not status == 0:
-            print("\nProblem installing pip3.")
-        else:
-            print("\nInstalled pip3.")
 
+def read_spool(spool, ip_address):
+    spool.seek(0)
+    for line in spool:
+        received, remote_host, status = line.split()
+        yield int(received), ip_address, remote_host, int(status)
 
-def install_log_parser(package):
-    # Try to import library if it's available
+
+# Run spool_requests(ip_address, limit, spool) on every instance at the same time, so the total time is close
+# to the slowest instance, then print their requests as one stream in time order.
+# Returns the number of requests printed and the result of every instance (count, or the exception raised).
+def print_merged_requests(ip_addresses, spool_requests, title):
+    # Memory use does not depend on the size of the logs: every instance is spooled to disk as it streams,
+    # only one line per instance is read back at a time while they are merged
+    spools = {ip_address: tempfile.TemporaryFile("w+") for ip_address in ip_addresses}
+    try:
+        results = async_remote.run(async_remote.run_on_hosts(
+            lambda ip_address, limit: spool_requests(ip_address, limit, spools[ip_address]),
+            ip_addresses, max_connections=LOG_QUERY_MAX_CONNECTIONS))
+
+        requests = []
+        for ip_address, result in results.items():
+            if isinstance(result, Exception):
+                # One broken instance does not stop the others from being reported
+                print(f"\nFailed to query the logs of {ip_address}.{result}")
+                continue
+            requests.append(read_spool(spools[ip_address], ip_address))
+
+        i = 0
+        # Every log is already in time order, merge them into one stream
+        for received, ip_address, remote_host, status in heapq.merge(*requests):
+            if i == 0:
+                print(f"\n\t*****  {title}  *****")
+                print("\n\tInstance\t\tIP Address\t\tTime Received\t\t\tStatus")
+            print(f"\t{ip_address}\t\t{remote_host}\t\t{format_time(received)}\t\t{status}")
+            i += 1
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return i, results
+
+
+def query_fleet_logs(key_path, ip_addresses, incremental):
+    stats = {}
+    count, results = print_merged_requests(
+        ip_addresses, lambda ip_address, limit, spool: spool_get_requests(key_path, ip_address, incremental, spool,
+                                                                          limit, stats),
+        "ALL GET REQUESTS FROM APACHE WEB SERVER ACCESS LOGS")
+    if count == 0:
+        print("\nNo GET Requests were made to these instances.")
+    print_transfer_stats(stats)
+
+
+# Load the web servers and print throughput, error rate and latency percentiles of each one
+def run_load_test(ip_addresses, concurrency, duration, rate=None, port=80):
+    mode = f"{rate} requests/s" if rate else "as fast as possible"
+    print(f"\nLoading {len(ip_addresses)} web servers for {duration}s with {concurrency} connections each, {mode}...")
+    results = async_remote.run(load_test.run_load(ip_addresses, port, duration=duration, concurrency=concurrency,
+                                                  rate=rate))
+    print_load_results(results)
+    return results
+
+
+def print_load_results(results):
+    print("\n\t*****  LOAD TEST  *****")
+    print("\n\tIP Address\t\tRequests\tReq/s\tErrors\tp50\tp95\tp99 (ms)")
+    for result in results:
+        latency = [f"{result['latency'][p] * 1000:.1f}" if result['latency'] else "-" for p in load_test.PERCENTILES]
+        print(f"\t{result['host']}\t\t{result['requests']}\t\t{result['throughput']:.1f}"
+              f"\t{result['error_rate']:.1%}\t" + "\t".join(latency))
+        if result['error_types']:
+            print("\t\t" + ", ".join(f"{error}: {count}" for error, count in result['error_types'].items()))
+    print(f"\nTotal: {sum(result['requests'] for result in results)} requests, "
+          f"{sum(result['throughput'] for result in results):.1f} requests/s, "
+          f"{sum(result['errors'] for result in results)} errors.")
+
+
+# Count the requests of the load test window in the access log of every web server, on the instances
+def cross_check_load_test(key_path, results):
+    windows = {result['host']: load_test.log_window(result) for result in results}
+    summaries = async_remote.run(async_remote.run_on_hosts(
+        lambda ip_address, limit: async_remote.fetch_log_summary(key_path, ip_address, *windows[ip_address],
+                                                                 limit=limit),
+        list(windows), max_connections=LOG_QUERY_MAX_CONNECTIONS))
+    print("\n\tIP Address\t\tAnswered\tLogged\tNot logged")
+    checks = []
+    for result in results:
+        summary = summaries[result['host']]
+        if isinstance(summary, Exception):
+            print(f"\t{result['host']}\t\tfailed to read the logs.{summary}")
+            continue
+        check = load_test.cross_check(result, summary)
+        print(f"\t{check['host']}\t\t{check['answered']}\t\t{check['logged']}\t{check['not_logged']}")
+        checks.append(check)
+    return checks
+
+
+# Print the GET requests made since a time, read from the rotated logs and the live log of every instance,
+# merged in time order. Every batch is spooled and dropped as soon as it is parsed, memory use does not depend
+# on the size of the logs.
+def query_log_range(key_path, ip_addresses, since, until=None):
+    stats = {}
+    count, results = print_merged_requests(
+        ip_addresses, lambda ip_address, limit, spool: spool_log_range(key_path, ip_address, since, until, spool,
+                                                                       limit, stats),
+        "GET REQUESTS FROM THE ROTATED AND LIVE ACCESS LOGS")
+    for ip_address, result in results.items():
+        if not isinstance(result, Exception):
+            print(f"\n{result} GET Requests were made to {ip_address} since {format_time(since)}.")
+    print_transfer_stats(stats)
+
+
+# Spool the GET requests of one instance made between since and until
+async def spool_log_range(key_path, ip_address, since, until, spool, limit=None, stats=None):
+    count = 0
+    lines = async_remote.stream_log_range(key_path, ip_address, since, until, limit, stats=stats)
+    async for batch in log_parser.parse_async_stream(lines, LOG_BATCH_SIZE):
+        # Rotated files hold whole days, drop the requests outside of the range
+        in_range = (batch['method'] == "GET") & (batch['time'] >= since)
+        if until is not None:
+            in_range &= batch['time'] <= until
+        count += spool_batch(spool, log_parser.filter_batch(batch, in_range))
+    return count
+
+
+# Fetch new lines of the access log, parse them once and append them to the local log store.
+# Yields the parsed batches as they arrive. SQLite runs in a worker thread, the streams of the other
+# instances keep flowing while a batch is written.
+async def fetch_and_store_logs(key_path, ip_address, incremental=True, limit=None, stats=None):
+    conn = await asyncio.to_thread(log_store.open_store)
     try:
-        importlib.import_module(package)
-    # If not found, install library
-    except ImportError:
-        print("\nInstalling apache-log-parser.")
-        cmd = subprocess.Popen("pip3 install apache-log-parser -qq > /dev/null", shell=True)
-        # Wait until install finishes
-        status = cmd.wait()
-        if status == 0:
-            print("\nImported apache-log-parser.")
+        if incremental:
+            position = await asyncio.to_thread(log_store.load_position, conn, ip_address)
+            if position is None:
+                position = access_logs.load_offsets().get(ip_address, {})
         else:
-            print("\nProblem importing apache-log-parser.")
+            # The whole log is fetched again, so the stored records would be duplicated
+            await asyncio.to_thread(log_store.clear_instance, conn, ip_address)
+            position = {}
+        lines = async_remote.stream_log_lines(key_path, ip_address, position, limit, stats=stats)
+        # position is past the last line of the batch, both are stored in one transaction
+        async for batch in log_parser.parse_async_stream(lines, LOG_BATCH_SIZE):
+            await asyncio.to_thread(log_store.append_records, conn, ip_address,
+                                    log_parser.records_from_batch(batch), dict(position))
+            yield batch
+        # The log may have been rotated without any new line
+        await asyncio.to_thread(log_store.append_records, conn, ip_address, [], dict(position))
+        await asyncio.to_thread(log_store.apply_retention, conn)
     finally:
-        return importlib.import_module(package)
+        conn.close()
 
 
-def main():
+# Fetch the new lines of the access log into the log store, returns the number of requests stored
+async def store_logs(key_path, ip_address, incremental=True, limit=None, stats=None):
+    count = 0
+    async for batch in fetch_and_store_logs(key_path, ip_address, incremental, limit, stats):
+        count += len(batch['time'])
+    return count
+
+
+def query_stored_logs(key_path):
+    instances_dict = list_instances()
+    if instances_dict:
+        ip_address = select_instance(instances_dict)
+        # Append only the requests made since the last query, everything else is already in the store
+        new_count = async_remote.run(store_logs(key_path, ip_address))
+        print(f"\nStored {new_count} new requests from {ip_address}.")
+
+        choice = get_input("\n1. Server errors (5xx) in the last minutes\n2. Requests from an IP address today\n"
+                           "3. Traffic summary of the last hours\n\nEnter query number: ")
+        conn = log_store.open_store()
+        if choice == "1":
+            minutes = get_input("\nHow many minutes? (default 15)   ")
+            records = log_store.recent_errors(conn, ip_address, int(minutes) if minutes.isdigit() else 15)
+        elif choice == "2":
+            records = log_store.requests_from_today(conn, ip_address, get_input("\nEnter IP address:   "))
+        elif choice == "3":
+            hours = get_input("\nHow many hours? (default 24)   ")
+            since = time.time() - (int(hours) if hours.isdigit() else 24) * 3600
+            print_log_summary(log_parser.batch_from_records(log_store.query_records(conn, ip_address, since=since)))
+            records = None
+        else:
+            print("\nNot a valid option.")
+            records = None
+        conn.close()
+
+        if records:
+            print("\n\tIP Address\t\tTime Received\t\t\tStatus\tRequest")
+            for remote_host, received, method, path, status, response_bytes in records:
+                print(f"\t{remote_host}\t\t{format_time(received)}\t\t{status}\t{method} {path}")
+        elif choice in ["1", "2"]:
+            print("\nNo matching requests found.")
+
+
+# Summarize the access logs on the instances and merge the summaries. Only a few KiB per instance cross the
+# network and the controller does no parsing, however large the logs are.
+def summarize_fleet_logs(key_path, ip_addresses, since=None):
+    results = async_remote.run(async_remote.run_on_hosts(
+        lambda ip_address, limit: async_remote.fetch_log_summary(key_path, ip_address, since, limit=limit),
+        ip_addresses, max_connections=LOG_QUERY_MAX_CONNECTIONS))
+
+    summaries = []
+    for ip_address, summary in results.items():
+        if isinstance(summary, Exception):
+            print(f"\nFailed to summarize the logs of {ip_address}.{summary}")
+        else:
+            summaries.append(summary)
+    if summaries:
+        merged = summarize_logs.merge_summaries(summaries)
+        print_remote_summary(merged)
+        return merged
+
+
+def print_remote_summary(summary):
+    if summary['requests'] == 0:
+        print(f"\nNo requests found on {summary['instances']} instances.")
+        return
+    print(f"\n\t*****  ACCESS LOG SUMMARY OF {summary['instances']} INSTANCES  *****")
+    print(f"\n\tRequests: {summary['requests']}\tBytes served: {summary['bytes']}"
+          f"\tFrom {format_time(summary['first'])} to {format_time(summary['last'])}")
+    print("\n\tStatus\tRequests")
+    for status, count in sorted(summary['status'].items()):
+        print(f"\t{status}\t{count}")
+    print("\n\tIP Address\t\tRequests")
+    for remote_host, count in summary['clients'][:10]:
+        print(f"\t{remote_host}\t\t{count}")
+    print("\n\tPath\t\t\tRequests")
+    for path, count in summary['paths'][:10]:
+        print(f"\t{path}\t\t\t{count}")
+    print("\n\tMinute\t\t\t\tRequests")
+    for minute, count in summary['per_minute'].items():
+        print(f"\t{format_time(minute)}\t\t{count}")
+
+
+def print_log_summary(batch):
+    if len(batch['time']) == 0:
+        print("\nNo requests found.")
+        return
+    seconds, counts = log_parser.requests_per_second(batch)
+    print("\n\t*****  ACCESS LOG SUMMARY  *****")
+    print(f"\n\tRequests: {len(batch['time'])}\tBytes served: {log_parser.bytes_served(batch)}"
+          f"\tPeak requests/sec: {counts.max()} at {format_time(seconds[counts.argmax()])}")
+    print("\n\tStatus\tRequests")
+    for status, count in log_parser.status_histogram(batch).items():
+        print(f"\t{status}\t{count}")
+    print("\n\tIP Address\t\tRequests")
+    for remote_host, count in log_parser.top_n(batch, 'remote_host'):
+        print(f"\t{remote_host}\t\t{count}")
+    print("\n\tPath\t\t\tRequests")
+    for path, count in log_parser.top_n(batch, 'path'):
+        print(f"\t{path}\t\t\t{count}")
+
+
+# Log times are stored as epoch seconds, display them in UTC
+def format_time(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(epoch))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # With arguments, run one operation without the menu (see batch_cli.py)
+    if argv:
+        # batch_cli imports this module by name, it gets this copy when the file is run as a script
+        sys.modules.setdefault('run_newwebserver', sys.modules[__name__])
+        import batch_cli
+        return batch_cli.main(argv)
+
     # Ask the user for path to their key pair
     key_pair = import_key_pair(get_input("\nEnter the path to your key pair. (including the .pem extension)\n"))
 
@@ -536,47 +1153,109 @@ def main():
         menu()
         menu_choice = get_input("\n        Make a choice, please.     ")
 
-        if menu_choice == "1":
-            security_group = select_security_group(list_security_groups())
-            instance_name = get_input("\nEnter name for your instance, please.\n")
-            create_instance(key_pair, security_group, instance_name)
-        elif menu_choice == "2":
-            create_bucket(key_pair[1])
-        elif menu_choice == "3":
-            # Let the user choose which bucket to upload file to
-            buckets_dict = list_buckets()
-            if buckets_dict:
-                bucket_name = select_bucket(buckets_dict)
-                file_path = os.path.expanduser(input("\nPlease enter the path to the file you want to upload:\n"))
-                # If file doesn't exist prompt the user for valid file
-                while not os.path.isfile(file_path):
-                    file_path = os.path.expanduser(input("\nPlease enter a valid path to the file you want to upload:\n"))
-                # Extract only the file name from the path and use it as a key
-                key_name = str(file_path.split('/')[-1])
-                upload_file(bucket_name, key_pair[1], os.path.expanduser(file_path), key_name)
-        elif menu_choice == "4":
-            list_buckets()
-        elif menu_choice == "5":
-            list_instances()
-        elif menu_choice == "6":
-            list_security_groups()
-        elif menu_choice == "7":
-            delete_bucket()
-        elif menu_choice == "8":
-            terminate_instances()
-        elif menu_choice == "9":
-            instances_dict = list_instances()
-            if instances_dict:
-                ip_address = select_instance(instances_dict)
-                check_web_server(ip_address, key_pair[1])
-        elif menu_choice == "10":
-            query_logs(key_pair[1])
-        elif menu_choice == "0":
-            print("\nClosing...")
-            sys.exit(0)
-        else:
-            print("\n        Please, enter a valid choice.")
+        limits_before = rate_limits.stats()
+        # Time every operation and print a summary of its phases when it is done
+        with metrics.operation(OPERATION_NAMES.get(menu_choice, f"option {menu_choice}")):
+            if menu_choice == "1":
+                security_group = select_security_group(list_security_groups())
+                instance_name = get_input("\nEnter name for your instance, please.\n")
+                create_instance(key_pair, security_group, instance_name, get_instance_count(), select_image())
+            elif menu_choice == "2":
+                create_bucket(key_pair[1])
+            elif menu_choice == "3":
+                # Let the user choose which bucket to upload file to
+                buckets_dict = list_buckets()
+                if buckets_dict:
+                    bucket_name = select_bucket(buckets_dict)
+                    file_path = os.path.expanduser(
+                        input("\nPlease enter the path to the file or directory you want to upload:\n"))
+                    # If file doesn't exist prompt the user for valid file
+                    while not os.path.isfile(file_path) and not os.path.isdir(file_path):
+                        file_path = os.path.expanduser(
+                            input("\nPlease enter a valid path to the file or directory you want to upload:\n"))
+                    if os.path.isdir(file_path):
+                        # Sync the whole directory tree, unchanged files are skipped
+                        prefix = get_input("\nEnter the key prefix to upload to, or press Enter for the bucket root.\n")
+                        sync_directory(bucket_name, file_path, prefix.strip("/"))
+                    else:
+                        # Extract only the file name from the path and use it as a key
+                        key_name = str(file_path.split('/')[-1])
+                        upload_file(bucket_name, key_pair[1], os.path.expanduser(file_path), key_name)
+            elif menu_choice == "4":
+                list_buckets()
+            elif menu_choice == "5":
+                list_instances()
+            elif menu_choice == "6":
+                list_security_groups()
+            elif menu_choice == "7":
+                delete_bucket()
+            elif menu_choice == "8":
+                # Wildcards are allowed, e.g. 'web-*'
+                name = get_input("\nEnter name of the instances to terminate, or press Enter to terminate all.\n")
+                terminate_instances(name or None)
+            elif menu_choice == "9":
+                instances_dict = list_instances()
+                if instances_dict:
+                    ip_addresses = select_instances(instances_dict)
+                    if len(ip_addresses) == 1:
+                        check_web_server(ip_addresses[0], key_pair[1])
+                    else:
+                        check_fleet_health(ip_addresses, key_pair[1])
+            elif menu_choice == "10":
+                query_logs(key_pair[1])
+            elif menu_choice == "11":
+                query_stored_logs(key_pair[1])
+            elif menu_choice == "12":
+                build_golden_image(key_pair, select_security_group(list_security_groups()))
+            elif menu_choice == "13":
+                instances_dict = list_instances()
+                if instances_dict:
+                    ip_addresses = select_instances(instances_dict)
+                    hours = get_input("\nHow many hours back? Rotated logs are read too. (blank for the current log) ")
+                    summarize_fleet_logs(key_pair[1], ip_addresses,
+                                         time.time() - int(hours) * 3600 if hours.isdigit() else None)
+            elif menu_choice == "14":
+                apply_fleet_spec(key_pair, os.path.expanduser(get_input("\nEnter the path to the fleet spec file.\n")))
+            elif menu_choice == "15":
+                instances_dict = list_instances()
+                if instances_dict:
+                    ip_addresses = select_instances(instances_dict)
+                    concurrency = get_input(f"\nConnections per web server? (default {load_test.LOAD_CONCURRENCY})   ")
+                    duration = get_input(f"\nHow many seconds? (default {load_test.LOAD_DURATION})   ")
+                    rate = get_input("\nRequests per second per web server? (blank to send as fast as possible)   ")
+                    results = run_load_test(ip_addresses,
+                                            int(concurrency) if concurrency.isdigit() else load_test.LOAD_CONCURRENCY,
+                                            int(duration) if duration.isdigit() else load_test.LOAD_DURATION,
+                                            int(rate) if rate.isdigit() else None)
+                    if get_input("\nCompare with the access logs? (y/n)   ").lower() in ['yes', 'y']:
+                        cross_check_load_test(key_pair[1], results)
+            elif menu_choice == "16":
+                security_group = select_security_group(list_security_groups())
+                instance_name = get_input("\nEnter name of the instances to autoscale, please.\n")
+                target = get_input(f"\nRequests per second per instance? (default {autoscaler.TARGET_RPS})   ")
+                minimum = get_input(f"\nMinimum number of instances? (default {autoscaler.MIN_INSTANCES})   ")
+                maximum = get_input(f"\nMaximum number of instances? (default {autoscaler.MAX_INSTANCES})   ")
+                try:
+                    policy = autoscaler.make_policy(int(target) if target.isdigit() else autoscaler.TARGET_RPS,
+                                                    int(minimum) if minimum.isdigit() else autoscaler.MIN_INSTANCES,
+                                                    int(maximum) if maximum.isdigit() else autoscaler.MAX_INSTANCES)
+                except ValueError as error:
+                    print(f"\n{error}")
+                else:
+                    autoscale(key_pair, security_group, instance_name, policy, select_image())
+            elif menu_choice == "0":
+                print("\nClosing...")
+                sys.exit(0)
+            else:
+                print("\n        Please, enter a valid choice.")
+
+        # Show the rate limiters when they slowed the operation down
+        limits = rate_limits.stats()
+        if any(values['waited_seconds'] > limits_before.get(service, {}).get('waited_seconds', 0) or
+               values['throttled'] > limits_before.get(service, {}).get('throttled', 0)
+               for service, values in limits.items()):
+            rate_limits.print_stats(limits)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+# Number of DeleteObjects calls in flight at the same time
+MAX_IN_FLIGHT = 8
+
+
+# Yield batches of {'Key', 'VersionId'} covering every object version and delete marker of the bucket.
+# Unversioned buckets list their objects with the 'null' version ID.
+def object_version_batches(client, bucket_name, batch_size=DELETE_BATCH_SIZE):
+    batch = []
+    for page in client.get_paginator('list_object_versions').paginate(Bucket=bucket_name):
+        for version in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            batch.append({'Key': version['Key'], 'VersionId': version['VersionId']})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+# Incomplete multipart uploads are not listed as objects, but they stop the bucket from being deleted
+def abort_multipart_uploads(client, bucket_name):
+    aborted = 0
+    for page in client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket_name):
+        for upload in page.get('Uploads', []):
+            client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+            aborted += 1
+    return aborted
+
+
+def delete_batch(client, bucket_name, batch):
+    response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': batch, 'Quiet': True})
+    errors = response.get('Errors', [])
+    return len(batch) - len(errors), errors
+
+
+# Delete every object, version and delete marker of a bucket and abort its pending multipart uploads.
+# on_progress(deleted, seconds) is called after every finished batch.
+def empty_bucket(client, bucket_name, batch_size=DELETE_BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT, on_progress=None):
+    stats = {'deleted': 0, 'errors': [], 'aborted_uploads': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+
+    def collect(done):
+        for future in done:
+            deleted, errors = future.result()
+            stats['deleted'] += deleted
+            stats['errors'].extend(errors)
+            if on_progress:
+                on_progress(stats['deleted'], time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight = set()
+        # Listing goes on while earlier batches are being deleted
+        for batch in object_version_batches(client, bucket_name, batch_size):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(delete_batch, client, bucket_name, batch))
+        collect(wait(in_flight).done)
+
+    stats['aborted_uploads'] = abort_multipart_uploads(client, bucket_name)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,120 @@
+import hashlib
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+import state_files
+
+# Size, mtime and MD5 of every file uploaded by a sync, per bucket and prefix
+MANIFEST_FILE = os.path.expanduser("~/.aws/s3_sync_manifest.json")
+# Number of files uploaded at the same time
+SYNC_MAX_WORKERS = 16
+# Files larger than this are uploaded in parts, several parts at a time
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+
+
+def load_manifest(path=MANIFEST_FILE):
+    return state_files.load(path)
+
+
+# Imported on first use, boto3 takes a while to load
+def transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_THRESHOLD,
+                          max_concurrency=MULTIPART_CONCURRENCY)
+
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Map every file of the directory tree to its key under the prefix
+def local_files(directory, prefix=""):
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            file_path = os.path.join(root, name)
+            relative_path = os.path.relpath(file_path, directory).replace(os.sep, "/")
+            files[prefix.rstrip("/") + "/" + relative_path if prefix else relative_path] = file_path
+    return files
+
+
+# Size and ETag of every object under the prefix
+def remote_objects(client, bucket_name, prefix=""):
+    objects = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = {'size': obj['Size'], 'etag': obj['ETag'].strip('"')}
+    return objects
+
+
+# A file is unchanged only if its object still exists with the same size and the same content: the MD5 of the
+# file (from the manifest when its size and mtime match, hashed otherwise) matches the remote ETag, which is the
+# MD5 of a single part upload. A multipart ETag is not an MD5, the manifest MD5 is used then.
+# Returns (unchanged, md5 or None).
+def is_unchanged(file_path, known, remote):
+    stat = os.stat(file_path)
+    # Deleted, or the bucket was emptied or recreated since the manifest was written
+    if not remote or remote['size'] != stat.st_size:
+        return False, None
+    if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        md5 = known['md5']
+    else:
+        md5 = file_md5(file_path)
+    if "-" not in remote['etag']:
+        return md5 == remote['etag'], md5
+    return md5 == (known or {}).get('md5'), md5
+
+
+def sync_file(client, bucket_name, key, file_path, known, remote, extra_args):
+    unchanged, md5 = is_unchanged(file_path, known, remote)
+    stat = os.stat(file_path)
+    if not unchanged:
+        args = dict(extra_args)
+        content_type = mimetypes.guess_type(file_path)[0]
+        if content_type:
+            args['ContentType'] = content_type
+        client.upload_file(file_path, bucket_name, key, ExtraArgs=args, Config=transfer_config())
+        md5 = md5 or file_md5(file_path)
+    return not unchanged, stat.st_size, {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}
+
+
+# Upload a directory tree to a bucket prefix, skipping the files which did not change since the last sync.
+# on_file(key, uploaded, error) is called after every file.
+def sync_directory(client, bucket_name, directory, prefix="", max_workers=SYNC_MAX_WORKERS,
+                   extra_args=None, manifest_path=MANIFEST_FILE, on_file=None):
+    stats = {'uploaded': 0, 'skipped': 0, 'bytes': 0, 'errors': {}}
+    files = local_files(directory, prefix)
+    remote = remote_objects(client, bucket_name, prefix)
+    manifest_key = f"{bucket_name}/{prefix}"
+    manifest = load_manifest(manifest_path)
+    known_files = manifest.get(manifest_key, {})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {key: executor.submit(sync_file, client, bucket_name, key, file_path, known_files.get(key),
+                                        remote.get(key), extra_args or {})
+                   for key, file_path in files.items()}
+        for key, future in futures.items():
+            try:
+                uploaded, size, entry = future.result()
+            except Exception as error:
+                stats['errors'][key] = error
+                if on_file:
+                    on_file(key, False, error)
+                continue
+            known_files[key] = entry
+            if uploaded:
+                stats['uploaded'] += 1
+                stats['bytes'] += size
+            else:
+                stats['skipped'] += 1
+            if on_file:
+                on_file(key, uploaded, None)
+
+    # Only this bucket and prefix is replaced, syncs of other directories may have run meanwhile
+    state_files.update(manifest_path, lambda manifest: manifest.update({manifest_key: known_files}))
+    return stats
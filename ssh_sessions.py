@@ -0,0 +1,74 @@
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# Hosts with an open master connection, as (key_path, pub_ip) pairs
+open_sessions = set()
+sessions_lock = threading.Lock()
+control_dir = None
+# Master connections are closed by close_all when the process exits. This is only the idle time after which
+# they close by themselves if close_all never runs (e.g. the process is killed), long enough to outlast any
+# pause at a menu prompt.
+CONTROL_PERSIST = "10m"
+
+
+def get_control_dir():
+    global control_dir
+    with sessions_lock:
+        if control_dir is None:
+            # Keep the path short, unix sockets are limited to ~100 characters
+            control_dir = tempfile.mkdtemp(prefix="aws-ssh-")
+        return control_dir
+
+
+# Options shared by ssh and scp. The first connection to a host becomes the master,
+# every later command to the same host is multiplexed over it and skips the TCP and key handshake.
+# BatchMode fails instead of prompting for a password or passphrase, commands run many at a time.
+def ssh_options(key_path):
+    return (f"-o StrictHostKeyChecking=no -o BatchMode=yes -i {key_path} "
+            f"-o ControlMaster=auto -o ControlPath={os.path.join(get_control_dir(), '%C')} "
+            f"-o ControlPersist={CONTROL_PERSIST}")
+
+
+def register_session(key_path, pub_ip):
+    with sessions_lock:
+        open_sessions.add((key_path, pub_ip))
+
+
+# No pseudo-terminal by default, commands to many hosts run at the same time and would share the local one.
+# Give flags="-tt" for a command which really needs a terminal on the instance.
+def ssh_command(key_path, pub_ip, command, flags="-T"):
+    register_session(key_path, pub_ip)
+    return f"ssh {flags} {ssh_options(key_path)} ec2-user@{pub_ip} {command}"
+
+
+def scp_command(key_path, pub_ip, source, destination="."):
+    register_session(key_path, pub_ip)
+    return f"scp {ssh_options(key_path)} {source} ec2-user@{pub_ip}:{destination}"
+
+
+# Close the master connection of one host
+def close_session(key_path, pub_ip):
+    with sessions_lock:
+        open_sessions.discard((key_path, pub_ip))
+    subprocess.getstatusoutput(f"ssh {ssh_options(key_path)} -O exit ec2-user@{pub_ip}")
+
+
+# Close every master connection and remove the control directory, called when the process exits
+def close_all():
+    global control_dir
+    with sessions_lock:
+        sessions = list(open_sessions)
+    for key_path, pub_ip in sessions:
+        close_session(key_path, pub_ip)
+    with sessions_lock:
+        if control_dir is not None:
+            shutil.rmtree(control_dir, ignore_errors=True)
+            control_dir = None
+
+
+# Sessions stay open for the life of the process, the menu loop or one batch_cli.py run
+atexit.register(close_all)
@@ -0,0 +1,52 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+# JSON files under ~/.aws which remember state between runs, e.g. the access log offsets and the S3 sync
+# manifest. The menu, batch_cli.py runs and their threads can update the same file at the same time.
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# The new content is written to a temporary file which replaces the old one, so a reader never sees a
+# half-written file and a crash leaves the previous content in place
+def save(data, path):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=os.path.basename(path), suffix=".tmp",
+                                     delete=False) as f:
+        try:
+            json.dump(data, f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+# Exclusive lock on path + ".lock", held until the block exits. flock() locks belong to the open file,
+# so threads of one process exclude each other as well as other processes do.
+@contextlib.contextmanager
+def locked(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+# Read, change and write back the file under the lock, so concurrent updates of different keys are all kept.
+# change(data) changes the loaded content in place.
+def update(path, change):
+    with locked(path):
+        data = load(path)
+        change(data)
+        save(data, path)
+        return data
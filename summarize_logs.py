@@ -0,0 +1,133 @@
+#!/usr/bin/env python36
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+
+ACCESS_LOG = "/var/log/httpd/access_log"
+# Number of clients and paths sent back by every instance
+TOP_N = 100
+# Requests per minute are only sent for the last minutes of the summary
+PER_MINUTE_WINDOW = 60
+
+# Same as log_parser.LOG_LINE, the instance has no numpy so every line is matched on its own
+LOG_LINE = re.compile(
+    r'^(\S+) \S+ \S+ \[(\d{2}/(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)/\d{4}'
+    r':\d{2}:\d{2}:\d{2} [+-]\d{4})\] '
+    r'"(?:(\S+) ((?:[^\s?"\\]|\\.)*)(?:\?(?:[^\s"\\]|\\.)*)?(?: (?:[^"\\]|\\.)*)?|(?:[^"\\]|\\.)*)" (\d{3}) (\d+|-)'
+    r'(?: "(?:[^"\\]|\\.)*" "(?:[^"\\]|\\.)*")?\s*$', re.ASCII)
+
+# Requests come in bursts, most lines have the same timestamp as the line before
+last_timestamp = [None, None]
+
+
+def parse_time(timestamp):
+    if timestamp != last_timestamp[0]:
+        last_timestamp[0] = timestamp
+        last_timestamp[1] = int(datetime.strptime(timestamp, "%d/%b/%Y:%H:%M:%S %z").timestamp())
+    return last_timestamp[1]
+
+
+# The live log, and the rotated access_log-* files (plain or .gz) if the summary goes back in time.
+# A rotated file holds the requests made between the mtime of the file before it and its own mtime.
+def log_files(log_path=ACCESS_LOG, since=None, until=None):
+    if since is None:
+        return [log_path] if os.path.exists(log_path) else []
+    files = sorted(glob.glob(log_path + "-*") + glob.glob(log_path), key=os.path.getmtime)
+    selected = []
+    previous = 0
+    for path in files:
+        mtime = os.path.getmtime(path)
+        if mtime >= since and (until is None or previous <= until):
+            selected.append(path)
+        previous = mtime
+    return selected
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, errors="replace")
+
+
+# Scan the log files once, line by line, and count what the controller asks about.
+# Memory use depends on the number of distinct clients and paths, not on the size of the logs.
+def summarize(paths, since=None, until=None, top=TOP_N, minutes=PER_MINUTE_WINDOW):
+    summary = {'requests': 0, 'unparsed': 0, 'bytes': 0, 'first': None, 'last': None}
+    statuses, methods, clients, request_paths, per_minute = Counter(), Counter(), Counter(), Counter(), Counter()
+    for path in paths:
+        with open_log(path) as f:
+            for line in f:
+                match = LOG_LINE.match(line)
+                if not match:
+                    summary['unparsed'] += 1
+                    continue
+                remote_host, timestamp, method, request_path, status, response_bytes = match.groups()
+                received = parse_time(timestamp)
+                if (since is not None and received < since) or (until is not None and received > until):
+                    continue
+                summary['requests'] += 1
+                summary['bytes'] += int(response_bytes) if response_bytes != "-" else 0
+                summary['first'] = min(summary['first'] or received, received)
+                summary['last'] = max(summary['last'] or received, received)
+                statuses[status] += 1
+                methods[method or "-"] += 1
+                clients[remote_host] += 1
+                request_paths[request_path or "-"] += 1
+                per_minute[received - received % 60] += 1
+
+    summary['status'] = dict(statuses)
+    summary['methods'] = dict(methods)
+    summary['distinct_clients'] = len(clients)
+    summary['clients'] = clients.most_common(top)
+    summary['paths'] = request_paths.most_common(top)
+    summary['per_minute'] = {str(minute): count for minute, count in per_minute.items()
+                             if minute > summary['last'] - minutes * 60}
+    return summary
+
+
+# Merge the summaries of several instances on the controller.
+# The top lists are merged from the top lists of every instance, a client which is not in the top of
+# any instance is missing from the merged list even if its total would place it there.
+def merge_summaries(summaries, top=TOP_N):
+    merged = {'instances': len(summaries), 'requests': 0, 'unparsed': 0, 'bytes': 0, 'first': None, 'last': None}
+    counters = {field: Counter() for field in ['status', 'methods', 'clients', 'paths', 'per_minute']}
+    for summary in summaries:
+        for field in ['requests', 'unparsed', 'bytes']:
+            merged[field] += summary[field]
+        if summary['first'] is not None:
+            merged['first'] = min(merged['first'] or summary['first'], summary['first'])
+            merged['last'] = max(merged['last'] or summary['last'], summary['last'])
+        for field, counter in counters.items():
+            counter.update(dict(summary[field]))
+
+    merged['status'] = dict(counters['status'])
+    merged['methods'] = dict(counters['methods'])
+    merged['clients'] = counters['clients'].most_common(top)
+    merged['paths'] = counters['paths'].most_common(top)
+    merged['per_minute'] = {int(minute): count for minute, count in sorted(counters['per_minute'].items())}
+    return merged
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Print a JSON summary of the Apache access log.")
+    parser.add_argument("--since", type=int, help="epoch seconds, rotated logs are read too")
+    parser.add_argument("--until", type=int, help="epoch seconds")
+    parser.add_argument("--top", type=int, default=TOP_N)
+    parser.add_argument("--minutes", type=int, default=PER_MINUTE_WINDOW)
+    parser.add_argument("--log", default=ACCESS_LOG)
+    args = parser.parse_args(args)
+
+    paths = log_files(args.log, args.since, args.until)
+    summary = summarize(paths, args.since, args.until, args.top, args.minutes)
+    summary['files'] = len(paths)
+    sys.stdout.write(json.dumps(summary, separators=(",", ":")) + "\n")
+
+
+if __name__ == '__main__':
+    main()
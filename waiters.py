@@ -0,0 +1,59 @@
+import random
+import time
+import metrics
+from botocore.exceptions import ClientError
+
+# Default backoff settings (seconds)
+BASE_DELAY = 1
+MAX_DELAY = 20
+
+
+# Exponential backoff with "full jitter": every delay is a random value between 0 and base * 2^attempt
+def backoff_delays(base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        attempt += 1
+
+
+# Call check() until it returns something truthy or the deadline (in seconds) runs out.
+# Returns the result of the last call, which is falsy if the deadline was reached.
+def wait_until(check, deadline, base_delay=BASE_DELAY, max_delay=MAX_DELAY, sleep=time.sleep, clock=time.monotonic):
+    end = clock() + deadline
+    delays = backoff_delays(base_delay, max_delay)
+    while True:
+        result = check()
+        if result or clock() >= end:
+            return result
+        # Never sleep past the deadline
+        sleep(min(next(delays), max(0, end - clock())))
+
+
+# Poll many pending instances with a single DescribeInstances call per round.
+# Returns a dictionary of instance ID -> public IP address for every instance that got one before the deadline.
+def wait_for_public_ips(client, instance_ids, deadline=300, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                        sleep=time.sleep, clock=time.monotonic):
+    public_ips = {}
+    pending = list(instance_ids)
+    polls = []
+
+    def poll():
+        if polls:
+            metrics.count('retries')
+        polls.append(1)
+        try:
+            response = client.describe_instances(InstanceIds=list(pending))
+        except ClientError as e:
+            # Freshly launched instances are not always visible to the API straight away
+            if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                return False
+            raise
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                if instance.get('PublicIpAddress'):
+                    public_ips[instance['InstanceId']] = instance['PublicIpAddress']
+                    pending.remove(instance['InstanceId'])
+        return not pending
+
+    wait_until(poll, deadline, base_delay, max_delay, sleep, clock)
+    return public_ips